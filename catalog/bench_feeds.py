@@ -0,0 +1,252 @@
+"""Compare the XML, Atom and RSS serializers in catalog/utils.py with the
+xml.dom.minidom versions they replaced: check that both produce the same
+bytes, then time them and measure their peak memory on a large feed.
+
+Usage: python bench_feeds.py [number of books]
+"""
+import datetime
+import os
+import re
+import resource
+import sys
+import time
+
+from flask import url_for
+from xml.dom.minidom import Document as xmldoc
+
+from catalog import app
+from catalog.utils import iter_atom, iter_rss, iter_xml
+
+dt = datetime.datetime
+
+
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+ THE MINIDOM SERIALIZERS, AS THEY WERE
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+
+
+def minidom_xml(model, q):
+    doc = xmldoc()
+    _xml = doc.appendChild(doc.createElement(model + 's'))
+    for obj in q:
+        node = _xml.appendChild(doc.createElement(model))
+        for key, value in obj.iteritems():
+            nodesub = node.appendChild(doc.createElement(key))
+            nodesub.appendChild(doc.createTextNode(unicode(value)))
+    return doc.toprettyxml(indent='    ', encoding='utf-8')
+
+
+def minidom_atom(q):
+    doc = xmldoc()
+    _xml = doc.appendChild(doc.createElement('feed'))
+    _xml.setAttribute('xmlns', 'http://www.w3.org/2005/Atom')
+    title = _xml.appendChild(doc.createElement('title'))
+    title.appendChild(doc.createTextNode('Book List from Lending Library'))
+    link = _xml.appendChild(doc.createElement('link'))
+    link.setAttribute('href', url_for('home.booksAPI', _external=True))
+    link.setAttribute('rel', 'self')
+    feed_id = _xml.appendChild(doc.createElement('id'))
+    feed_id.appendChild(
+        doc.createTextNode(url_for('home.catalogHome', _external=True)))
+    update_date = dt.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+    updated = _xml.appendChild(doc.createElement('updated'))
+    updated.appendChild(doc.createTextNode(update_date))
+
+    for obj in q:
+        entry = _xml.appendChild(doc.createElement('entry'))
+        entry_title = entry.appendChild(doc.createElement('title'))
+        entry_title.appendChild(doc.createTextNode(obj['title']))
+        eLink = url_for('home.bookInfo', book_id=obj['id'], _external=True)
+        entry_link = entry.appendChild(doc.createElement('link'))
+        entry_link.setAttribute('href', eLink)
+        host = re.search(r'//(.+?)/(.+)/', eLink)
+        entry_tag = 'tag:' + host.group(1) + ','
+        entry_tag += obj['date_added'].strftime('%Y-%m-%d')
+        entry_tag += ':/' + host.group(2)
+        entry_id = entry.appendChild(doc.createElement('id'))
+        entry_id.appendChild(doc.createTextNode(entry_tag))
+        entry_date = obj['date_added'].strftime('%Y-%m-%dT%H:%M:%SZ')
+        entry_updated = entry.appendChild(doc.createElement('updated'))
+        entry_updated.appendChild(doc.createTextNode(entry_date))
+        entry_summary = entry.appendChild(doc.createElement('summary'))
+        entry_summary.appendChild(doc.createTextNode(obj['synopsis']))
+        author = entry.appendChild(doc.createElement('author'))
+        author_name = author.appendChild(doc.createElement('name'))
+        author_name.appendChild(doc.createTextNode(obj['author']))
+        year_pub = entry.appendChild(doc.createElement('yearpublished'))
+        year_pub.appendChild(doc.createTextNode(str(obj['year_published'])))
+        picture = entry.appendChild(doc.createElement('picture'))
+        picture.appendChild(doc.createTextNode(obj['picture']))
+        avail = entry.appendChild(doc.createElement('isavailable'))
+        avail.appendChild(doc.createTextNode(str(obj['is_available'])))
+        if (obj['due_date'] is not None):
+            ts = time.strptime(obj['due_date'], '%m/%d/%Y')
+            due_date = dt.fromtimestamp(time.mktime(ts))
+            entry_due_date = due_date.strftime('%Y-%m-%dT%H:%M:%SZ')
+            due_date = entry.appendChild(doc.createElement('duedate'))
+            due_date.appendChild(doc.createTextNode(entry_due_date))
+        lender = entry.appendChild(doc.createElement('lender'))
+        lender_email = lender.appendChild(doc.createElement('email'))
+        lender_email.appendChild(doc.createTextNode(obj['lender']))
+        if (obj['borrower'] is not None):
+            borrower = entry.appendChild(doc.createElement('borrower'))
+            borrower_name = borrower.appendChild(doc.createElement('name'))
+            borrower_name.appendChild(
+                doc.createTextNode(obj['borrower']['name']))
+            borrower_email = borrower.appendChild(doc.createElement('email'))
+            borrower_email.appendChild(
+                doc.createTextNode(obj['borrower']['email']))
+    return doc.toprettyxml(indent='    ', encoding='utf-8')
+
+
+def minidom_rss(q):
+    doc = xmldoc()
+    _rss = doc.appendChild(doc.createElement('rss'))
+    _rss.setAttribute('version', '2.0')
+    channel = _rss.appendChild(doc.createElement('channel'))
+    title = channel.appendChild(doc.createElement('title'))
+    title.appendChild(doc.createTextNode('Book List from Lending Library'))
+    desc = channel.appendChild(doc.createElement('description'))
+    desc.appendChild(
+        doc.createTextNode('A list of books from the Lending Library.'))
+    link = channel.appendChild(doc.createElement('link'))
+    link.appendChild(
+        doc.createTextNode(url_for('home.booksAPI', _external=True)))
+    date_format = '%a, %d %b %Y %H:%M:%S +0000'
+    update_date = dt.utcnow().strftime(date_format)
+    pub_date = channel.appendChild(doc.createElement('pubDate'))
+    pub_date.appendChild(doc.createTextNode(update_date))
+
+    for obj in q:
+        item = channel.appendChild(doc.createElement('item'))
+        item_title = item.appendChild(doc.createElement('title'))
+        item_title.appendChild(doc.createTextNode(obj['title']))
+        eLink = url_for('home.bookInfo', book_id=obj['id'], _external=True)
+        item_link = item.appendChild(doc.createElement('link'))
+        item_link.appendChild(doc.createTextNode(eLink))
+        item_date = obj['date_added'].strftime(date_format)
+        item_updated = item.appendChild(doc.createElement('pubDate'))
+        item_updated.appendChild(doc.createTextNode(item_date))
+        item_summary = item.appendChild(doc.createElement('description'))
+        item_summary.appendChild(doc.createTextNode(obj['synopsis']))
+        author = item.appendChild(doc.createElement('author'))
+        author.appendChild(doc.createTextNode(obj['author']))
+        year_pub = item.appendChild(doc.createElement('yearpublished'))
+        year_pub.appendChild(doc.createTextNode(str(obj['year_published'])))
+        picture = item.appendChild(doc.createElement('picture'))
+        picture.appendChild(doc.createTextNode(obj['picture']))
+        avail = item.appendChild(doc.createElement('isavailable'))
+        avail.appendChild(doc.createTextNode(str(obj['is_available'])))
+        if (obj['due_date'] is not None):
+            ts = time.strptime(obj['due_date'], '%m/%d/%Y')
+            due_date = dt.fromtimestamp(time.mktime(ts))
+            item_due_date = due_date.strftime(date_format)
+            due_date = item.appendChild(doc.createElement('duedate'))
+            due_date.appendChild(doc.createTextNode(item_due_date))
+        lender = item.appendChild(doc.createElement('lender'))
+        lender.appendChild(doc.createTextNode(obj['lender']))
+        if (obj['borrower'] is not None):
+            borrower_str = obj['borrower']['email'] + ' ('
+            borrower_str += obj['borrower']['name'] + ')'
+            borrower = item.appendChild(doc.createElement('borrower'))
+            borrower.appendChild(doc.createTextNode(borrower_str))
+    return doc.toprettyxml(indent='    ', encoding='utf-8')
+
+
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+ BENCHMARK
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+
+
+def make_books(n):
+    """Return `n` serialized books, like `Book.serialize` gives, with
+    every third one on loan and some text that needs escaping.
+    """
+    books = []
+    for i in range(1, n + 1):
+        on_loan = (i % 3 == 0)
+        books.append({
+            'id': i,
+            'title': u'Book %d: Fish & Chips <Deluxe>' % i,
+            'author': u'Author "%d" Caf\xe9' % i,
+            'synopsis': u'A synopsis of book %d. ' % i * 8,
+            'year_published': 1900 + i % 100,
+            'date_added': dt(2016, 1, 4, 18, 46, 3),
+            'picture': 'http://books.google.com/books/content?id=%d&img=1' % i,
+            'lender': 'lender%d@catalog.com' % (i % 50),
+            'is_available': not on_loan,
+            'due_date': '02/01/2016' if on_loan else None,
+            'borrower': {
+                'name': u'Borrower %d' % i,
+                'email': 'borrower%d@catalog.com' % i
+            } if on_loan else None
+        })
+    return books
+
+
+def without_timestamps(feed):
+    """Blank out the feed-level timestamp, which differs between runs."""
+    return re.sub(
+        r'<(updated|pubDate)>[^<]*</\1>', '', feed, count=1)
+
+
+def measure(func):
+    """Run `func` in a child process; return its run time in seconds
+    and how far it raised the process's peak memory, in kB.
+    """
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if (pid == 0):
+        os.close(read_end)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(write_end, '%f %d' % (elapsed, after - before))
+        os._exit(0)
+    os.close(write_end)
+    result = os.read(read_end, 100)
+    os.waitpid(pid, 0)
+    elapsed, memory = result.split()
+    return float(elapsed), int(memory)
+
+
+def main(n):
+    books = make_books(n)
+    paths = [
+        ('XML', lambda: minidom_xml('book', books),
+            lambda: iter_xml('book', books)),
+        ('Atom', lambda: minidom_atom(books), lambda: iter_atom(books)),
+        ('RSS', lambda: minidom_rss(books), lambda: iter_rss(books)),
+    ]
+
+    with app.test_request_context('/'):
+        # measure first, so the parent process's heap hasn't already
+        # grown to fit a whole feed when the children fork
+        results = []
+        for name, old, new in paths:
+            results.append(measure(old) + measure(lambda: drain(new())))
+
+        for name, old, new in paths:
+            expected = without_timestamps(old())
+            actual = without_timestamps(''.join(new()))
+            if (expected != actual):
+                sys.exit('%s output differs from minidom\'s!' % name)
+
+    print '%d books; output is byte-identical.' % n
+    print '%-6s %22s %22s' % ('', 'minidom', 'XMLWriter')
+    for (name, old, new), result in zip(paths, results):
+        print '%-6s %8.2fs %10d kB %8.2fs %10d kB' % ((name,) + result)
+
+
+def drain(chunks):
+    """Consume a streamed feed the way a chunked response would,
+    without keeping it.
+    """
+    for chunk in chunks:
+        pass
+
+
+if (__name__) == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
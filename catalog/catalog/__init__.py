@@ -14,6 +14,12 @@ app.config.from_pyfile('config.py')
 
 db = SQLAlchemy(app)
 
+# after_request functions run in the reverse of the order they're added;
+# compress responses last, after the debug toolbar has added itself to
+# the pages
+from catalog.compression import compress_response
+app.after_request(compress_response)
+
 toolbar = DebugToolbarExtension(app)
 
 if not (app.debug):
@@ -34,3 +40,5 @@ from catalog.views.test import test
 app.register_blueprint(auth)
 app.register_blueprint(home)
 app.register_blueprint(test)
+
+import catalog.commands
@@ -0,0 +1,84 @@
+from flask import g, request
+
+from . import app
+from .cache import TTLCache
+from .compression import compress_response, negotiate
+from .utils import PAGED_FILTERS
+
+# Responses from `booksAPI`, cached in-process. Each response belongs to
+# a list (a "group"): (filter, category, user), where the user is only
+# set for the lists that depend on who's asking (mybooks, favorites).
+# Cache keys include the catalog version the response was made at (see
+# `models.CatalogVersion`, which `utils.conditional` has already read
+# for the request), so any write to the catalog, made through any
+# process, leaves the old entries unfindable; they age out of the cache
+# on their own. A cached response is therefore always current, and is
+# served with the same ETag the view would give it.
+
+USER_FILTERS = ('mybooks', 'favorites')
+
+# the headers of a response that are cached along with it
+CACHED_HEADERS = (
+    'Content-Type', 'Link', 'X-Since', 'Content-Encoding', 'Vary')
+
+responses = TTLCache(
+    maxsize=app.config['API_CACHE_SIZE'], ttl=app.config['API_CACHE_TTL'])
+
+
+def group(bookfilter, thisCategory=None, user_id=None):
+    """Return the cache group of a book list."""
+    if (bookfilter not in PAGED_FILTERS):
+        # anything else is the recent books list
+        return ('recent', None, None)
+    elif (bookfilter in USER_FILTERS):
+        return (bookfilter, None, user_id)
+    elif (bookfilter == 'category'):
+        return (bookfilter, thisCategory, None)
+    return (bookfilter, None, None)
+
+
+def cache_key(bookfilter, thisCategory, apiFormat):
+    """Return the key the current `booksAPI` request's response is
+    cached under.
+    """
+    user = g.get('user')
+    key_group = group(bookfilter, thisCategory, user.id if user else None)
+    # the output has absolute URLs in it, so the host counts too; and
+    # responses are cached compressed, so the encoding does
+    return (
+        g.catalog_version[0],
+        key_group,
+        apiFormat,
+        negotiate(),
+        request.host_url,
+        tuple(sorted(request.args.iteritems(multi=True)))
+    )
+
+
+def get_response(key):
+    """Return a new response made from the one cached under `key`, or
+    None if there isn't one.
+    """
+    cached = responses.get(key)
+    if (cached is None):
+        return None
+    data, headers = cached
+    resp = app.response_class(data, headers=headers)
+    resp.headers['X-Cache'] = 'HIT'
+    return resp
+
+
+def set_response(key, resp):
+    """Cache a successful, unstreamed response under `key`. The response
+    is compressed first, if the client accepts it, so the cached copy is
+    stored compressed.
+    """
+    if (resp.status_code == 200 and not resp.is_streamed):
+        compress_response(resp)
+        headers = [
+            (name, value) for name, value in resp.headers
+            if name in CACHED_HEADERS
+        ]
+        responses.set(key, (resp.get_data(), headers))
+    resp.headers['X-Cache'] = 'MISS'
+    return resp
@@ -0,0 +1,68 @@
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """A small in-process cache with a bound on the number of entries
+    and on how long each entry lives. When the cache is full, the least
+    recently used entry makes way for the new one. Safe to share between
+    threads. Keeps hit/miss counters so its effectiveness can be checked.
+    """
+
+    def __init__(self, maxsize=128, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return the value cached under `key`, or `default` if there is
+        none or it has expired.
+        """
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if (entry is None or entry[0] < time.time()):
+                self.misses += 1
+                return default
+            # re-insert to mark the entry as most recently used
+            self._data[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        """Cache `value` under `key` for `ttl` seconds. A cache with a
+        `maxsize` of 0 caches nothing.
+        """
+        if (self.maxsize < 1):
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            while (len(self._data) >= self.maxsize):
+                self._data.popitem(last=False)
+            self._data[key] = (time.time() + self.ttl, value)
+
+    def pop(self, key):
+        """Drop the entry cached under `key`, if any."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Drop every entry."""
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """Return the number of entries and the hit and miss counts."""
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+    def __len__(self):
+        return len(self._data)
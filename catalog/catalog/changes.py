@@ -0,0 +1,60 @@
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+# In-process structures that mirror the database (search indexes, caches)
+# need to hear about rows that change, but only once the change is
+# committed, and with the values the rows were committed with: by the
+# time a commit's listeners run, the session has already expired its
+# objects. `after_commit` collects what each registered listener wants
+# to know about at flush time and hands it over after the commit;
+# rolled back changes are dropped.
+
+_listeners = []
+
+
+def after_commit(model, capture=None):
+    """Decorator registering `func(changes)` to be called after every
+    commit that inserted, updated or deleted `model` objects. `changes`
+    maps each changed object's primary key to `capture(obj)` as of its
+    last flush, or to None if the object was deleted. Without `capture`,
+    every value is the object's primary key.
+
+    Only changes made through the ORM session are seen; bulk
+    `query.update()` and `query.delete()` calls are not.
+    """
+    def decorator(func):
+        _listeners.append((model, capture, func))
+        return func
+    return decorator
+
+
+def _primary_key(obj):
+    identity = obj.__mapper__.primary_key_from_instance(obj)
+    return identity[0] if len(identity) == 1 else tuple(identity)
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_changes(session, flush_context):
+    pending = session.info.setdefault('pending_changes', {})
+    changed = session.new.union(session.dirty)
+    for i, (model, capture, func) in enumerate(_listeners):
+        for obj in changed:
+            if (isinstance(obj, model)):
+                key = _primary_key(obj)
+                pending.setdefault(i, {})[key] = (
+                    capture(obj) if capture else key)
+        for obj in session.deleted:
+            if (isinstance(obj, model)):
+                pending.setdefault(i, {})[_primary_key(obj)] = None
+
+
+@event.listens_for(Session, 'after_commit')
+def _dispatch_changes(session):
+    pending = session.info.pop('pending_changes', None)
+    for i, changes in (pending or {}).iteritems():
+        _listeners[i][2](changes)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_changes(session, previous_transaction):
+    session.info.pop('pending_changes', None)
@@ -0,0 +1,68 @@
+import click
+
+from . import app
+from .models import (
+    create_missing_indexes,
+    create_missing_tables,
+    rebuild_rating_aggregates
+)
+from .feeds import build_all as build_all_feeds
+from .search import create_search_index
+from .search_index import save_snapshot
+
+
+@app.cli.command('rebuild-ratings')
+def rebuild_ratings():
+    """Recompute every book's rating count and total from the
+    book_rating table.
+    """
+    rebuild_rating_aggregates()
+    click.echo('Rating aggregates rebuilt.')
+
+
+@app.cli.command('create-indexes')
+def create_indexes():
+    """Create any tables and indexes the models declare that the
+    database is missing, and rebuild any index a failed run left
+    invalid. Safe to run against a live database.
+    """
+    for name in create_missing_tables():
+        click.echo('Created table %s.' % name)
+    created = create_missing_indexes()
+    for name in created:
+        click.echo('Created index %s.' % name)
+    if not (created):
+        click.echo('All indexes present.')
+
+
+@app.cli.command('create-search-index')
+def create_search_index_command():
+    """Set up full-text search for books on an existing database and
+    index every book.
+    """
+    if (create_search_index()):
+        click.echo('Search index created.')
+    else:
+        click.echo('This database has no full-text search support.')
+
+
+@app.cli.command('save-search-index')
+def save_search_index():
+    """Build the in-memory search index and save it to
+    SEARCH_INDEX_SNAPSHOT, for processes to load at startup.
+    """
+    if not (app.config['SEARCH_INDEX_SNAPSHOT']):
+        click.echo('SEARCH_INDEX_SNAPSHOT is not set.')
+        return
+    click.echo('Saved %d books to the search index snapshot.' % (
+        save_snapshot()))
+
+
+@app.cli.command('build-feeds')
+def build_feeds():
+    """Build every materialized feed in FEED_DIR."""
+    if not (app.config['FEED_DIR'] and app.config['FEED_BASE_URL']):
+        click.echo('Set FEED_DIR and FEED_BASE_URL to materialize feeds.')
+        return
+    count = build_all_feeds()
+    click.echo('Feeds built for %d book lists.' % count)
@@ -0,0 +1,95 @@
+import zlib
+
+from flask import request
+
+from . import app
+
+# Responses are compressed with gzip or deflate when the client says it
+# accepts them (Accept-Encoding). Pages, the API's JSON and the feeds
+# shrink a lot: a long feed is mostly the same tags over and over.
+# `compress_response` runs after every request; `api_cache` also calls
+# it before caching a response, so cached responses are kept compressed
+# and serving one from the cache doesn't compress it again.
+
+ENCODINGS = ('gzip', 'deflate')
+
+COMPRESSIBLE_TYPES = (
+    'text/html',
+    'text/plain',
+    'text/csv',
+    'application/json',
+    'application/x-ndjson',
+    'application/xml',
+    'application/atom+xml',
+    'application/rss+xml',
+)
+
+# zlib's window size argument for each encoding: gzip wraps the
+# compressed data in a gzip header and trailer, deflate (as HTTP means
+# it) in a zlib one
+WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+
+def negotiate():
+    """Return the encoding the current request's response should be
+    compressed with, or None if it shouldn't be.
+    """
+    if (app.config['COMPRESS_LEVEL'] < 1):
+        return None
+    return request.accept_encodings.best_match(ENCODINGS)
+
+
+def compressor(encoding):
+    """Return a zlib compression object for `encoding`."""
+    return zlib.compressobj(
+        app.config['COMPRESS_LEVEL'], zlib.DEFLATED, WBITS[encoding])
+
+
+def compress(data, encoding):
+    """Return `data` compressed with `encoding`."""
+    c = compressor(encoding)
+    return c.compress(data) + c.flush()
+
+
+def compress_chunks(chunks, encoding):
+    """Compress a streamed response's chunks with `encoding` as they're
+    sent, flushing after each so the client gets them straight away.
+    """
+    c = compressor(encoding)
+    for chunk in chunks:
+        if (isinstance(chunk, unicode)):
+            chunk = chunk.encode('utf-8')
+        data = c.compress(chunk) + c.flush(zlib.Z_SYNC_FLUSH)
+        if (data):
+            yield data
+    yield c.flush()
+
+
+def compress_response(resp):
+    """Compress `resp` in place with the encoding negotiated for the
+    current request, if it's worth compressing and not compressed
+    already. Files sent with send_file are left alone.
+    """
+    if (resp.status_code != 200 or
+            resp.direct_passthrough or
+            'Content-Encoding' in resp.headers or
+            resp.mimetype not in COMPRESSIBLE_TYPES):
+        return resp
+    if (resp.is_streamed):
+        # no way to tell how big it will be; streamed lists are long
+        resp.vary.add('Accept-Encoding')
+        encoding = negotiate()
+        if (encoding is not None):
+            resp.response = compress_chunks(resp.response, encoding)
+            resp.headers['Content-Encoding'] = encoding
+        return resp
+
+    data = resp.get_data()
+    if (len(data) < app.config['COMPRESS_MIN_SIZE']):
+        return resp
+    resp.vary.add('Accept-Encoding')
+    encoding = negotiate()
+    if (encoding is not None):
+        resp.set_data(compress(data, encoding))
+        resp.headers['Content-Encoding'] = encoding
+    return resp
@@ -0,0 +1,291 @@
+import fcntl
+import os
+import Queue
+import tempfile
+import threading
+import urllib
+
+from flask import abort, request, send_file, url_for
+from functools import wraps
+from sqlalchemy.orm import attributes
+
+from . import app, db
+from .changes import after_commit
+from .compression import compress, negotiate
+from .models import (
+    Book,
+    BookBorrower,
+    Category,
+    book_category,
+    catalog_version
+)
+from .serializers import book_rows, serialize_books
+from .utils import filter_books, iter_atom, iter_rss, next_page_url
+
+# Feed materialization: an optional mode, on when FEED_DIR and
+# FEED_BASE_URL are set in the instance config, where the Atom and RSS
+# feeds of the book lists most read by feed readers (all books, recent
+# books and each category) are kept as files in FEED_DIR. `booksAPI`
+# sends the file (see `serve_materialized`) rather than build the feed,
+# so reading one doesn't touch the database at all.
+#
+# After each commit that changes books or loans, the feeds the change
+# shows up in are rebuilt by a background thread, and each file is
+# replaced atomically. Every process rebuilds the feeds after its own
+# commits, and they all serve the same files; each feed's catalog
+# version is kept next to it, so a slow rebuild never replaces a feed
+# built from a later version. A feed whose file is missing is served
+# the usual way while the thread builds it; the `build-feeds` command
+# builds them all up front.
+
+FEED_FORMATS = {
+    'Atom': ('atom', 'application/atom+xml', iter_atom),
+    'RSS': ('rss', 'application/rss+xml', iter_rss),
+}
+
+FEED_FILTERS = ('all', 'recent', 'category')
+
+# every category's feed, for changes we can't tell the categories of
+EVERY_CATEGORY = ('category', None)
+
+_jobs = Queue.Queue()
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def enabled():
+    return bool(app.config['FEED_DIR'] and app.config['FEED_BASE_URL'])
+
+
+def feed_path(bookfilter, thisCategory, apiFormat):
+    """Return the path of the file a feed is kept in."""
+    name = bookfilter
+    if (bookfilter == 'category'):
+        name += '-' + urllib.quote(thisCategory.encode('utf-8'), safe='')
+    return os.path.join(
+        app.config['FEED_DIR'], name + '.' + FEED_FORMATS[apiFormat][0])
+
+
+def serve_materialized(func):
+    """Answer `booksAPI` requests for a materialized feed with its file,
+    when there is one, instead of calling the view. Only requests for
+    the feed's first page, with no parameters, made to FEED_BASE_URL
+    (the feed's links point there) qualify. This is used as a decorator,
+    outside `conditional`, which would ask the database for the catalog
+    version.
+    """
+    @wraps(func)
+    def decorated_view(bookfilter, thisCategory, apiFormat):
+        if (enabled() and
+                bookfilter in FEED_FILTERS and
+                apiFormat in FEED_FORMATS and
+                not request.args and
+                request.host_url == app.config['FEED_BASE_URL']):
+            resp = _send_feed(bookfilter, thisCategory, apiFormat)
+            if (resp is not None):
+                return resp
+            if (bookfilter == 'category' and Category.query.filter_by(
+                    name=thisCategory).first() is None):
+                # there's no such feed to build
+                abort(404)
+            schedule([(bookfilter, thisCategory)])
+        return func(bookfilter, thisCategory, apiFormat)
+
+    return decorated_view
+
+
+def _send_feed(bookfilter, thisCategory, apiFormat):
+    path = feed_path(bookfilter, thisCategory, apiFormat)
+    mimetype = FEED_FORMATS[apiFormat][1]
+    # a compressed copy is kept next to each feed
+    encoding = negotiate()
+    try:
+        if (encoding == 'gzip' and os.path.exists(path + '.gz')):
+            resp = send_file(
+                path + '.gz', mimetype=mimetype, conditional=True)
+            resp.headers['Content-Encoding'] = 'gzip'
+        else:
+            resp = send_file(path, mimetype=mimetype, conditional=True)
+    except (IOError, OSError):
+        return None
+    resp.vary.add('Accept-Encoding')
+    # always check back; send_file answers with a 304 when the file
+    # hasn't changed
+    resp.cache_control.public = True
+    resp.cache_control.no_cache = True
+    return resp
+
+
+def build_feed(bookfilter, thisCategory, apiFormat):
+    """Write a feed's file (and its compressed copy), the same as
+    `booksAPI` would serve it, and replace the old one atomically,
+    unless it's newer (see `replace_feed`). Returns whether it was replaced.
+    """
+    serialize = FEED_FORMATS[apiFormat][2]
+    url = url_for(
+        'home.booksAPI',
+        bookfilter=bookfilter,
+        thisCategory=thisCategory,
+        apiFormat=apiFormat
+    )
+    with app.test_request_context(
+            url, base_url=app.config['FEED_BASE_URL']):
+        # read before the books, so they're at least as new as it
+        version, updated = catalog_version()
+        rows, next_cursor = filter_books(
+            bookfilter,
+            thisCategory,
+            limit=app.config['API_PAGE_SIZE'],
+            query=book_rows()
+        )
+        next_url = next_page_url(next_cursor) if next_cursor else None
+        books = list(serialize_books(rows))
+        if (apiFormat == 'Atom'):
+            data = ''.join(serialize(books, next_url, updated))
+        else:
+            data = ''.join(serialize(books, updated))
+
+    path = feed_path(bookfilter, thisCategory, apiFormat)
+    files = [(path, data)]
+    if (app.config['COMPRESS_LEVEL'] > 0):
+        files.append((path + '.gz', compress(data, 'gzip')))
+    return replace_feed(path, files, version)
+
+
+def replace_feed(path, files, version):
+    """Replace the (path, data) `files` of the feed at `path`, unless it
+    was last built from a later catalog version than `version`, and
+    record `version` as the feed's. Returns whether they were replaced.
+    """
+    written = []
+    try:
+        for file_path, data in files:
+            written.append((_write_temp(file_path, data), file_path))
+        # other processes may be rebuilding the same feed
+        with open(path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if (_feed_version(path) > version):
+                return False
+            for tmp_path, file_path in written:
+                os.rename(tmp_path, file_path)
+            written = []
+            version_path = _write_temp(path + '.version', str(version))
+            os.rename(version_path, path + '.version')
+        return True
+    finally:
+        for tmp_path, file_path in written:
+            os.remove(tmp_path)
+
+
+def _feed_version(path):
+    try:
+        with open(path + '.version') as f:
+            return int(f.read())
+    except (IOError, ValueError):
+        return -1
+
+
+def _write_temp(path, data):
+    """Write `data` to a new temporary file next to `path`, and return
+    the temporary file's path.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.chmod(tmp_path, 0644)
+    return tmp_path
+
+
+def rebuild(lists=(), book_ids=()):
+    """Rebuild the feeds of the book lists in `lists`, (filter,
+    category) pairs, and those of the lists the books with `book_ids`
+    are in. `EVERY_CATEGORY` stands for all the category lists.
+    """
+    lists = set(lists)
+    if (book_ids):
+        lists.update([('all', None), ('recent', None)])
+        categories = db.session.query(Category.name).join(
+            book_category).filter(book_category.c.book_id.in_(book_ids))
+        lists.update(('category', name) for name, in categories)
+    if (EVERY_CATEGORY in lists):
+        lists.discard(EVERY_CATEGORY)
+        lists.update(
+            ('category', name) for name, in db.session.query(Category.name))
+
+    with app.test_request_context(base_url=app.config['FEED_BASE_URL']):
+        for bookfilter, thisCategory in lists:
+            for apiFormat in FEED_FORMATS:
+                build_feed(bookfilter, thisCategory, apiFormat)
+    return lists
+
+
+def build_all():
+    """Build every materialized feed now. Returns the number of book
+    lists built.
+    """
+    return len(rebuild([('all', None), ('recent', None), EVERY_CATEGORY]))
+
+
+def schedule(lists=(), book_ids=()):
+    """Have the background thread `rebuild` these feeds."""
+    global _worker
+    _jobs.put((lists, book_ids))
+    with _worker_lock:
+        if (_worker is None or not _worker.is_alive()):
+            _worker = threading.Thread(target=_rebuild_forever)
+            _worker.daemon = True
+            _worker.start()
+
+
+def wait():
+    """Block until every scheduled rebuild is done."""
+    _jobs.join()
+
+
+def _rebuild_forever():
+    while True:
+        jobs = [_jobs.get()]
+        # rebuild once for everything that was queued meanwhile
+        while True:
+            try:
+                jobs.append(_jobs.get_nowait())
+            except Queue.Empty:
+                break
+        lists, book_ids = set(), set()
+        for job_lists, job_book_ids in jobs:
+            lists.update(job_lists)
+            book_ids.update(job_book_ids)
+        try:
+            with app.app_context():
+                rebuild(lists, book_ids)
+        except Exception:
+            app.logger.exception('Rebuilding feeds failed.')
+        finally:
+            for job in jobs:
+                _jobs.task_done()
+
+
+def _book_categories(book):
+    # the categories the book was in before the flush as well as after
+    history = attributes.get_history(book, 'category')
+    return set(c.name for c in history.sum())
+
+
+@after_commit(Book, capture=_book_categories)
+def _book_changes(changes):
+    if not (enabled()):
+        return
+    lists = [('all', None), ('recent', None)]
+    for categories in changes.itervalues():
+        if (categories is None):
+            # a deleted book; its categories are gone with it
+            lists.append(EVERY_CATEGORY)
+            break
+        lists.extend(('category', name) for name in categories)
+    schedule(lists)
+
+
+@after_commit(BookBorrower, capture=lambda loan: loan.book_id)
+def _loan_changes(changes):
+    if (enabled()):
+        schedule(book_ids=[b for b in changes.itervalues() if b])
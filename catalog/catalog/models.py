@@ -1,5 +1,9 @@
 from datetime import datetime
 from flask import url_for
+from sqlalchemy import event
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateIndex
 
 from . import db
 
@@ -17,16 +21,46 @@ relationship = db.relationship
 backref = db.backref
 Model = db.Model
 
+Index = db.Index
+
+# the databases the partial indexes below (`postgresql_where`,
+# `sqlite_where`) are built as such on; see `create_index`
+PARTIAL_INDEX_DIALECTS = ('postgresql', 'sqlite')
+
+
+@compiles(CreateIndex)
+def create_index(create, compiler, **kw):
+    """Compile CREATE INDEX as the database would, except that a unique
+    index marked `partial` in its info is made a plain one on databases
+    that can't index part of a table: unique over the whole table, it
+    would allow only one row ever, not one at a time.
+    """
+    ddl = compiler.visit_create_index(create)
+    index = create.element
+    if (index.unique and index.info.get('partial') and
+            compiler.dialect.name not in PARTIAL_INDEX_DIALECTS):
+        ddl = ddl.replace('CREATE UNIQUE INDEX', 'CREATE INDEX', 1)
+    return ddl
+
+
 book_category = Table(
     'book_category',
     Col('book_id', Integer, ForeignKey('book.id')),
-    Col('category_id', Integer, ForeignKey('category.id'))
+    Col('category_id', Integer, ForeignKey('category.id')),
+    # books in a category, and categories of a book; both columns in
+    # each so the lookup never has to visit the table itself
+    Index('ix_book_category_category_book', 'category_id', 'book_id'),
+    Index('ix_book_category_book_category', 'book_id', 'category_id')
 )
 
 book_favorite = Table(
     'book_favorite',
     Col('book_id', Integer, ForeignKey('book.id')),
-    Col('user_id', Integer, ForeignKey('user.id'))
+    Col('user_id', Integer, ForeignKey('user.id')),
+    # a user can only favorite a book once
+    Index('ux_book_favorite_book_user', 'book_id', 'user_id', unique=True),
+    # a user's favorites
+    Index('ix_book_favorite_user_book', 'user_id', 'book_id')
 )
 
 
@@ -44,6 +78,26 @@ class BookBorrower(Model):
     returned = Col(Boolean, default=False)
     borrower = relationship('User')
 
+    __table_args__ = (
+        # a user's loans (`mybooks`, `returnBook`)
+        Index('ix_book_borrower_user_returned', user_id, returned, book_id),
+        # a book's loan history
+        Index('ix_book_borrower_book', book_id),
+        # a book can only be out on one loan at a time; this partial
+        # index also serves `Book.current_loan`, so checking whether a
+        # book is available never has to scan its loan history. Other
+        # databases get a plain index, and only `borrowBook`'s check
+        # (see `create_index`)
+        Index(
+            'ix_book_borrower_open_loan',
+            book_id,
+            unique=True,
+            info={'partial': True},
+            postgresql_where=(returned == db.false()),
+            sqlite_where=(returned == db.false())
+        ),
+    )
+
 
 class BookRating(Model):
     """Model that represents a user rating a book, including an optional
@@ -52,10 +106,17 @@ class BookRating(Model):
     __tablename__ = 'book_rating'
     user_id = Col(Integer, ForeignKey('user.id'), primary_key=True)
     book_id = Col(Integer, ForeignKey('book.id'), primary_key=True)
-    rating = Col(Numeric)
+    # keep the old value around on change; Book's rating aggregates
+    # need it (see `rating_updated` below)
+    rating = db.column_property(Col(Numeric), active_history=True)
     review = Col(String)
     rater = relationship('User')
 
+    __table_args__ = (
+        # a book's ratings (the primary key leads with user_id)
+        Index('ix_book_rating_book', book_id),
+    )
+
 
 class User(Model):
     """Model that represents a user. Nothing fancy."""
@@ -88,16 +149,29 @@ class Book(Model):
     __tablename__ = 'book'
     title = Col(String(250), nullable=False)
     id = Col(Integer, primary_key=True)
-    date_added = Col(DateTime, default=datetime.now)
+    date_added = Col(DateTime, default=datetime.now, index=True)
+    # when (UTC) the book was added, or last changed in a way the API
+    # shows; see `touch_modified_books`
+    date_modified = Col(DateTime, default=datetime.utcnow)
     author = Col(String(250), nullable=False)
     picture = Col(String(250))
     year_published = Col(Integer)
     synopsis = Col(String)
-    lender_id = Col(Integer, ForeignKey('user.id'), nullable=False)
+    lender_id = Col(
+        Integer, ForeignKey('user.id'), nullable=False, index=True)
+    rating_count = Col(Integer, nullable=False, default=0, server_default='0')
+    rating_sum = Col(Numeric, nullable=False, default=0, server_default='0')
     lender = relationship('User')
     category = relationship(
         'Category', secondary=book_category, backref=backref('books'))
     borrower = relationship('BookBorrower')
+    current_loan = relationship(
+        'BookBorrower',
+        primaryjoin=db.and_(
+            id == BookBorrower.book_id, BookBorrower.returned == db.false()),
+        uselist=False,
+        viewonly=True
+    )
     rating = relationship('BookRating')
     favorite = relationship(
         'User', secondary=book_favorite, backref=backref('favorite_books'))
@@ -106,6 +180,13 @@ class Book(Model):
         'order_by': title  # order lists of books by title by default
     }
 
+    __table_args__ = (
+        # book lists are paged through in (title, id) order
+        Index('ix_book_title_id', title, id),
+        # and synced from in (date_modified, id) order; see `booksAPI`
+        Index('ix_book_date_modified_id', date_modified, id),
+    )
+
     def __unicode__(self):
         # return book's title when calling the object
         return self.title
@@ -118,35 +199,29 @@ class Book(Model):
             o When it's due back if False (date as string)
             o Who currently has it out (dict of name and email)
         """
-        borrowers = self.borrower
-        available = [True, None, None]
-        for b in borrowers:
-            # iterate through the list of borrowers and look for
-            # `returned` = False
-            if not b.returned:
-                available = [
-                    False,
-                    b.due_date.strftime('%m/%d/%Y'),
-                    {
-                        'name': b.borrower.name,
-                        'email': b.borrower.email
-                    }
-                ]
-        return available
+        loan = self.current_loan
+        if (loan is None):
+            return [True, None, None]
+        else:
+            return [
+                False,
+                loan.due_date.strftime('%m/%d/%Y'),
+                {
+                    'name': loan.borrower.name,
+                    'email': loan.borrower.email
+                }
+            ]
 
     def calc_rating(self):
         """Calculate average rating for the book based on individual
-        ratings.
+        ratings. Uses the `rating_count` and `rating_sum` aggregates,
+        which are kept up to date whenever a BookRating is written (see
+        the event listeners below), so no ratings need to be loaded.
         """
-        ratings = self.rating
-        rateVal = 0.0
-        for r in ratings:
-            rateVal = rateVal + float(r.rating)
-
-        if (rateVal == 0 or len(ratings) == 0):
+        if not (self.rating_count and self.rating_sum):
             return 0
         else:
-            return round((rateVal / len(ratings)), 2)
+            return round(float(self.rating_sum) / self.rating_count, 2)
 
     @property
     def serialize(self):
@@ -181,7 +256,9 @@ class Book(Model):
 class Category(Model):
     """Model representinga Category, or Genre, of a book. Books can be
     associated with more than one Category. Includes a column_property
-    for the number of books in a particular Category
+    for the number of books in a particular Category. It's deferred, so
+    it's only counted when asked for; the sidebar uses the cached counts
+    from `utils.category_book_counts` instead.
     """
     __tablename__ = 'category'
     id = Col(Integer, primary_key=True)
@@ -190,7 +267,9 @@ class Category(Model):
         db.select(
             [db.func.count(book_category.c.book_id)]
         ).where(
-            book_category.c.category_id == id).correlate_except(book_category))
+            book_category.c.category_id == id).correlate_except(book_category),
+        deferred=True
+    )
 
     __mapper_args__ = {
         'order_by': name  # order lists of categories by name by default
@@ -199,3 +278,250 @@ class Category(Model):
     def __unicode__(self):
         # return the category name when calling the object
         return self.name
+
+
+class CatalogVersion(Model):
+    """A single row counting the writes to the catalog (books, loans,
+    ratings and favorites) and recording when the last one was. The
+    API's ETag and Last-Modified headers are made from it (see
+    `utils.conditional`), so clients can ask whether anything changed
+    without the catalog itself being read.
+    """
+    __tablename__ = 'catalog_version'
+    id = Col(Integer, primary_key=True)
+    version = Col(Integer, nullable=False, default=0)
+    updated = Col(DateTime, nullable=False, default=datetime.utcnow)
+
+
+@event.listens_for(CatalogVersion.__table__, 'after_create')
+def catalog_version_created(target, connection, **kw):
+    connection.execute(
+        target.insert().values(id=1, version=0, updated=datetime.utcnow()))
+
+
+def catalog_version():
+    """Return the catalog's (version, last updated) pair, or (0, None)
+    if it has never been written to.
+    """
+    row = db.session.query(
+        CatalogVersion.version, CatalogVersion.updated).filter_by(id=1).first()
+    return (row.version, row.updated) if row else (0, None)
+
+
+def bump_catalog_version(connection):
+    """Count a write to the catalog, on `connection`."""
+    table = CatalogVersion.__table__
+    now = datetime.utcnow()
+    result = connection.execute(
+        table.update().where(table.c.id == 1).values(
+            version=table.c.version + 1, updated=now))
+    if (result.rowcount == 0):
+        connection.execute(table.insert().values(id=1, version=1, updated=now))
+
+
+def mark_catalog_written(session):
+    """Have the catalog version bumped once `session` commits (for
+    writes `catalog_written` can't see, such as inserting into
+    book_favorite directly).
+    """
+    session.info['catalog_written'] = True
+
+
+@event.listens_for(Session, 'after_flush')
+def catalog_written(session, flush_context):
+    """Mark the session's transaction as a write to the catalog whenever
+    a flush writes a book, loan or rating (favorites added through a
+    Book's `favorite` list change the Book).
+    """
+    versioned = (Book, BookBorrower, BookRating)
+    changed = any(
+        isinstance(obj, versioned)
+        for obj in session.new.union(session.deleted)
+    ) or any(
+        isinstance(obj, versioned) and session.is_modified(obj)
+        for obj in session.dirty
+    )
+    if (changed):
+        mark_catalog_written(session)
+
+
+@event.listens_for(Session, 'after_commit')
+def bump_after_commit(session):
+    """Bump the catalog version after each commit that wrote to the
+    catalog. It's bumped in a short transaction of its own rather than
+    in the writing one, so writers don't queue up for the version row's
+    lock while their transactions run; and only once the write is
+    committed, so a new version never comes before the data it covers.
+    """
+    if (session.info.pop('catalog_written', False)):
+        with session.get_bind().begin() as connection:
+            bump_catalog_version(connection)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def catalog_write_rolled_back(session, previous_transaction):
+    session.info.pop('catalog_written', None)
+
+
+# the Book attributes that show in the API (or decide which lists the
+# book is in); changing any other, such as the rating aggregates or who
+# favorited the book, doesn't count as modifying it
+MODIFYING_ATTRIBUTES = (
+    'title',
+    'author',
+    'synopsis',
+    'year_published',
+    'picture',
+    'lender_id',
+    'lender',
+    'category'
+)
+
+
+@event.listens_for(Session, 'before_flush')
+def touch_modified_books(session, flush_context, instances):
+    """Keep `Book.date_modified` up to date: set it on books whose API
+    output is about to change, either because the book itself was
+    edited or because it was lent out or returned. Times are UTC, as
+    `since` timestamps are.
+    """
+    now = datetime.utcnow()
+    for obj in session.dirty:
+        if (isinstance(obj, Book)):
+            state = db.inspect(obj)
+            if any(state.attrs[key].history.has_changes()
+                   for key in MODIFYING_ATTRIBUTES):
+                obj.date_modified = now
+
+    book_ids = set(
+        obj.book_id
+        for obj in session.new.union(session.dirty).union(session.deleted)
+        if isinstance(obj, BookBorrower) and obj.book_id is not None
+    )
+    for book_id in book_ids:
+        # usually already in the session's identity map
+        book = session.query(Book).get(book_id)
+        if (book is not None):
+            book.date_modified = now
+
+
+def _adjust_rating_aggregates(connection, book_id, count, added, removed=0):
+    """Apply a change to a book's rating aggregates as a single UPDATE,
+    so it lands in the same transaction as the BookRating write.
+    """
+    book = Book.__table__
+    connection.execute(
+        book.update().where(book.c.id == book_id).values(
+            rating_count=book.c.rating_count + count,
+            rating_sum=book.c.rating_sum + added - removed
+        )
+    )
+
+
+@event.listens_for(BookRating, 'after_insert')
+def rating_inserted(mapper, connection, target):
+    _adjust_rating_aggregates(connection, target.book_id, 1, target.rating)
+
+
+@event.listens_for(BookRating, 'after_update')
+def rating_updated(mapper, connection, target):
+    history = db.inspect(target).attrs.rating.history
+    if (history.deleted and history.added):
+        # only a change to the rating value matters for the aggregates
+        _adjust_rating_aggregates(
+            connection, target.book_id, 0,
+            history.added[0], history.deleted[0])
+
+
+@event.listens_for(BookRating, 'after_delete')
+def rating_deleted(mapper, connection, target):
+    _adjust_rating_aggregates(connection, target.book_id, -1, 0, target.rating)
+
+
+def rebuild_rating_aggregates():
+    """Recompute `rating_count` and `rating_sum` for every book from the
+    book_rating table. Useful after adding the columns to an existing
+    database, or if the aggregates are ever suspected of drifting.
+    """
+    book = Book.__table__
+    rating = BookRating.__table__
+    ratings = db.select([
+        db.func.count(rating.c.book_id)
+    ]).where(rating.c.book_id == book.c.id).as_scalar()
+    rating_total = db.select([
+        db.func.coalesce(db.func.sum(rating.c.rating), 0)
+    ]).where(rating.c.book_id == book.c.id).as_scalar()
+    db.session.execute(
+        book.update().values(rating_count=ratings, rating_sum=rating_total))
+    db.session.commit()
+
+
+def create_missing_tables():
+    """Create any table the models declare that the database doesn't
+    have yet, and return their names.
+    """
+    existing = set(db.inspect(db.engine).get_table_names())
+    missing = [
+        t for t in db.metadata.sorted_tables if t.name not in existing
+    ]
+    db.metadata.create_all(db.engine, tables=missing)
+    return [t.name for t in missing]
+
+
+def invalid_indexes(engine):
+    """Return the names of the indexes PostgreSQL has marked invalid:
+    those left behind by a CREATE INDEX CONCURRENTLY that failed part
+    way (on duplicate rows for a unique index, say). They're kept up to
+    date on writes but never used by queries. Other databases don't
+    leave indexes half-built, so have none.
+    """
+    if (engine.dialect.name != 'postgresql'):
+        return set()
+    rows = engine.execute(db.text(
+        'SELECT c.relname FROM pg_index i '
+        'JOIN pg_class c ON c.oid = i.indexrelid '
+        'WHERE NOT i.indisvalid AND pg_table_is_visible(c.oid)'
+    ))
+    return set(row[0] for row in rows)
+
+
+def create_missing_indexes():
+    """Create any index declared on the models that the database doesn't
+    have yet, or has only an invalid copy of (see `invalid_indexes`),
+    and return their names. On PostgreSQL the indexes are built with
+    CREATE INDEX CONCURRENTLY, so reads and writes carry on while they
+    build; an invalid copy is dropped first. Other databases lock the
+    table for the duration.
+    """
+    engine = db.engine
+    inspector = db.inspect(engine)
+    concurrently = (engine.dialect.name == 'postgresql')
+    invalid = invalid_indexes(engine)
+    created = []
+    for table in db.metadata.sorted_tables:
+        existing = set(i['name'] for i in inspector.get_indexes(table.name))
+        existing -= invalid
+        for index in sorted(table.indexes, key=lambda i: i.name):
+            if (index.name in existing):
+                continue
+            if (concurrently):
+                # the index's own DDL, made concurrent; the Index itself
+                # is left as the models declare it
+                ddl = str(CreateIndex(index).compile(dialect=engine.dialect))
+                ddl = ddl.replace(' INDEX ', ' INDEX CONCURRENTLY ', 1)
+                # CONCURRENTLY can't run inside a transaction
+                conn = engine.connect().execution_options(
+                    isolation_level='AUTOCOMMIT')
+                try:
+                    if (index.name in invalid):
+                        conn.execute(
+                            'DROP INDEX CONCURRENTLY %s' %
+                            engine.dialect.identifier_preparer.quote(
+                                index.name))
+                    conn.execute(ddl)
+                finally:
+                    conn.close()
+            else:
+                index.create(engine)
+            created.append(index.name)
+    return created
@@ -0,0 +1,219 @@
+import cookielib
+import threading
+import time
+import urlparse
+
+import httplib2
+from requests import RequestException, Session
+from requests.adapters import HTTPAdapter
+
+from . import app
+
+# All the app's calls to other services (Google and Facebook sign-in, the
+# Google Books API) go through one shared requests Session. Its adapter
+# keeps a pool of open (keep-alive) connections for each host, so only
+# the first call to a host pays for the TCP and TLS handshakes; later
+# calls, from any request or thread, reuse a pooled connection. Cookies
+# aren't kept, so no call carries another's.
+#
+# Calls are made with `get` (or `request`), which bounds how long each can take
+# (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT) and keeps a circuit breaker
+# for each endpoint: after HTTP_BREAKER_THRESHOLD failures in a row, calls
+# to the endpoint fail straight away, with CircuitOpen, for
+# HTTP_BREAKER_RESET seconds. A slow or broken provider then costs a
+# request a few seconds at most, and after that nothing, instead of
+# tying up every worker waiting on it.
+#
+# Libraries that make their own calls with an httplib2.Http (oauth2client)
+# are given an `Http` instead, which makes them the same way.
+#
+# Setting HTTP_STUB_URL sends every call to that server instead, keeping
+# the path and query string (tests point it at the mock server).
+
+_client = None
+_client_lock = threading.Lock()
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+class CircuitOpen(RequestException):
+    """Raised by `get` instead of calling an endpoint whose circuit
+    breaker is open.
+    """
+
+
+class CircuitBreaker(object):
+    """Counts an endpoint's failures in a row. Once there have been
+    `threshold` of them, the breaker opens: `allow` says no until `reset`
+    seconds have passed, then lets a single trial call through. If that
+    fails, the breaker stays open for another `reset` seconds; if it
+    succeeds, the breaker closes.
+    """
+
+    def __init__(self, threshold, reset):
+        self.threshold = threshold
+        self.reset = reset
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        with self._lock:
+            if (self.opened_at is None):
+                return True
+            if (time.time() - self.opened_at < self.reset):
+                return False
+            # let this call try the endpoint; others keep failing fast
+            # until it's done (or another `reset` seconds pass)
+            self.opened_at = time.time()
+            return True
+
+    def succeeded(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failed(self):
+        with self._lock:
+            self.failures += 1
+            if (self.failures >= self.threshold):
+                self.opened_at = time.time()
+
+
+class StubAdapter(HTTPAdapter):
+    """An adapter that sends every request to the HTTP_STUB_URL server,
+    with the original URL's path appended to the stub URL's.
+    """
+
+    def __init__(self, stub_url, **kwargs):
+        self.stub_url = urlparse.urlsplit(stub_url)
+        super(StubAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        url = urlparse.urlsplit(request.url)
+        request.url = urlparse.urlunsplit((
+            self.stub_url.scheme,
+            self.stub_url.netloc,
+            self.stub_url.path.rstrip('/') + url.path,
+            url.query,
+            ''
+        ))
+        return super(StubAdapter, self).send(request, **kwargs)
+
+
+def make_client():
+    """Return a new Session set up from the config: HTTP_POOL_HOSTS is
+    the number of hosts connections are pooled for, HTTP_POOL_SIZE the
+    number of connections kept open to each.
+    """
+    options = dict(
+        pool_connections=app.config['HTTP_POOL_HOSTS'],
+        pool_maxsize=app.config['HTTP_POOL_SIZE']
+    )
+    if (app.config['HTTP_STUB_URL']):
+        adapter = StubAdapter(app.config['HTTP_STUB_URL'], **options)
+    else:
+        adapter = HTTPAdapter(**options)
+    session = Session()
+    # the client is shared by every user's calls; a cookie one provider
+    # sets during one user's sign-in mustn't go out with the next's
+    session.cookies.set_policy(cookielib.DefaultCookiePolicy(
+        allowed_domains=[]))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def client():
+    """Return the app's shared HTTP client, making it the first time."""
+    global _client
+    if (_client is None):
+        with _client_lock:
+            if (_client is None):
+                _client = make_client()
+    return _client
+
+
+def reset_client(breakers=True):
+    """Close the shared client's connections and, unless `breakers` is
+    False, forget the circuit breakers; the next `client()` call makes
+    a new client, from the config as it is then.
+    """
+    global _client
+    with _client_lock:
+        if (_client is not None):
+            _client.close()
+        _client = None
+    if (breakers):
+        with _breakers_lock:
+            _breakers.clear()
+
+
+def endpoint(url):
+    """Return the endpoint `url` is on: its host and path, without the
+    query string (which holds tokens and keys).
+    """
+    url = urlparse.urlsplit(url)
+    return url.netloc + url.path
+
+
+def breaker_for(url):
+    """Return the circuit breaker for the endpoint `url` is on."""
+    key = endpoint(url)
+    with _breakers_lock:
+        breaker = _breakers.get(key)
+        if (breaker is None):
+            breaker = _breakers[key] = CircuitBreaker(
+                app.config['HTTP_BREAKER_THRESHOLD'],
+                app.config['HTTP_BREAKER_RESET']
+            )
+    return breaker
+
+
+def request(method, url, **kwargs):
+    """Make a `method` request to `url` with the shared client, with the
+    configured timeouts, and return the response. Raises a
+    RequestException if the call fails or times out, or CircuitOpen
+    (without calling) if the endpoint's circuit breaker is open. Server
+    errors (5xx) count as failures for the breaker, but are returned
+    like any other response.
+    """
+    breaker = breaker_for(url)
+    if not (breaker.allow()):
+        raise CircuitOpen('Circuit open for %s' % endpoint(url))
+    kwargs.setdefault('timeout', (
+        app.config['HTTP_CONNECT_TIMEOUT'], app.config['HTTP_READ_TIMEOUT']))
+    try:
+        resp = client().request(method, url, **kwargs)
+    except RequestException:
+        breaker.failed()
+        raise
+    if (resp.status_code >= 500):
+        breaker.failed()
+    else:
+        breaker.succeeded()
+    return resp
+
+
+def get(url, **kwargs):
+    """GET `url`; see `request`."""
+    return request('GET', url, **kwargs)
+
+
+class Http(object):
+    """A stand-in for httplib2.Http, for libraries that take one, whose
+    `request` makes the call with `request` (above) and returns what
+    httplib2's would: the response's status and headers, and its body.
+    Failures raise a RequestException, not httplib2's or socket's.
+    """
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        resp = request(method, uri, data=body, headers=headers)
+        info = dict(resp.headers)
+        info['status'] = resp.status_code
+        return httplib2.Response(info), resp.content
@@ -0,0 +1,180 @@
+import re
+
+from sqlalchemy import DDL, event, or_, text
+
+from . import app, db
+from .models import Book
+from .search_index import get_index
+
+# Book search is backed by the database's own full-text search: an FTS5
+# table on SQLite and a GIN expression index on PostgreSQL. Either one
+# is kept in sync by the database itself (triggers for FTS5; PostgreSQL
+# maintains expression indexes on every write), so the views don't need
+# to do anything when books are added, edited or deleted. Databases
+# without either fall back to a LIKE scan, unless SEARCH_BACKEND is set
+# to 'memory' (see search_index.py).
+
+# relative weights of matches in the title, author and synopsis
+SQLITE_WEIGHTS = (10.0, 10.0, 1.0)
+
+SQLITE_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS book_fts USING fts5(
+        title, author, synopsis,
+        content='book', content_rowid='id', tokenize='porter unicode61')""",
+    """CREATE TRIGGER IF NOT EXISTS book_fts_insert AFTER INSERT ON book
+    BEGIN
+        INSERT INTO book_fts(rowid, title, author, synopsis)
+        VALUES (new.id, new.title, new.author, new.synopsis);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS book_fts_delete AFTER DELETE ON book
+    BEGIN
+        INSERT INTO book_fts(book_fts, rowid, title, author, synopsis)
+        VALUES ('delete', old.id, old.title, old.author, old.synopsis);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS book_fts_update
+    AFTER UPDATE OF title, author, synopsis ON book
+    BEGIN
+        INSERT INTO book_fts(book_fts, rowid, title, author, synopsis)
+        VALUES ('delete', old.id, old.title, old.author, old.synopsis);
+        INSERT INTO book_fts(rowid, title, author, synopsis)
+        VALUES (new.id, new.title, new.author, new.synopsis);
+    END""",
+]
+
+SQLITE_REBUILD = "INSERT INTO book_fts(book_fts) VALUES ('rebuild')"
+
+SQLITE_DROP = 'DROP TABLE IF EXISTS book_fts'
+
+# title and author are weighted 'A', synopsis 'B'; searches have to use
+# exactly this expression (see `_pg_document`) for the index to apply
+PG_INDEX = """CREATE INDEX {concurrently} IF NOT EXISTS ix_book_fts
+ON book USING gin ((
+    setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+    setweight(to_tsvector('english', coalesce(author, '')), 'A') ||
+    setweight(to_tsvector('english', coalesce(synopsis, '')), 'B')
+))"""
+
+
+def _sqlite_has_fts5(ddl, target, bind, **kw):
+    """Only set up FTS5 on SQLite builds that have it."""
+    if (bind.dialect.name != 'sqlite'):
+        return False
+    options = [r[0] for r in bind.execute('PRAGMA compile_options')]
+    return 'ENABLE_FTS5' in options
+
+
+for statement in SQLITE_DDL:
+    event.listen(
+        Book.__table__,
+        'after_create',
+        DDL(statement).execute_if(callable_=_sqlite_has_fts5)
+    )
+event.listen(
+    Book.__table__,
+    'after_drop',
+    DDL(SQLITE_DROP).execute_if(dialect='sqlite')
+)
+event.listen(
+    Book.__table__,
+    'after_create',
+    DDL(PG_INDEX.format(concurrently='')).execute_if(dialect='postgresql')
+)
+
+
+def create_search_index():
+    """Set up full-text search on an existing database, and (re)index
+    every book. Returns False if the database doesn't support it.
+    """
+    engine = db.engine
+    if (engine.dialect.name == 'postgresql'):
+        # CONCURRENTLY keeps the book table writable while this builds,
+        # but can't run inside a transaction
+        conn = engine.connect().execution_options(
+            isolation_level='AUTOCOMMIT')
+        try:
+            conn.execute(PG_INDEX.format(concurrently='CONCURRENTLY'))
+        finally:
+            conn.close()
+        return True
+    elif (_sqlite_has_fts5(None, None, engine)):
+        with engine.begin() as conn:
+            for statement in SQLITE_DDL:
+                conn.execute(statement)
+            conn.execute(SQLITE_REBUILD)
+        return True
+    return False
+
+
+def search_terms(searchterm):
+    """Split a search into its words, dropping punctuation and anything
+    else that means something to the full-text query syntax.
+    """
+    return re.findall(r'\w+', searchterm, re.UNICODE)
+
+
+def _pg_document():
+    def weighted(column, weight):
+        return db.func.setweight(
+            db.func.to_tsvector(
+                text("'english'"), db.func.coalesce(column, text("''"))),
+            text("'%s'" % weight)
+        )
+    return weighted(Book.title, 'A').op('||')(
+        weighted(Book.author, 'A')).op('||')(
+        weighted(Book.synopsis, 'B'))
+
+
+def search_books(query, searchterm):
+    """Narrow a Book query down to the books matching `searchterm`, best
+    matches first. Every word of the search has to match (as a prefix,
+    so 'dikk' finds 'Dikkens'); hits in the title or author count for
+    more than hits in the synopsis.
+    """
+    words = search_terms(searchterm)
+    if not (words):
+        return query.filter(db.false())
+
+    if (app.config['SEARCH_BACKEND'] == 'memory'):
+        ids = get_index().search(
+            searchterm, limit=app.config['SEARCH_RESULTS_LIMIT'])
+        if not (ids):
+            return query.filter(db.false())
+        rank = db.case(
+            dict((book_id, i) for i, book_id in enumerate(ids)),
+            value=Book.id
+        )
+        return query.filter(Book.id.in_(ids)).order_by(rank)
+
+    dialect = db.engine.dialect.name
+    if (dialect == 'postgresql'):
+        tsquery = db.func.to_tsquery(
+            text("'english'"), ' & '.join(w + ':*' for w in words))
+        document = _pg_document()
+        return query.filter(document.op('@@')(tsquery)).order_by(
+            db.func.ts_rank(document, tsquery).desc(), Book.id)
+    elif (dialect == 'sqlite' and _has_fts_table()):
+        matches = text(
+            'SELECT rowid AS book_id, bm25(book_fts, %s) AS rank '
+            'FROM book_fts WHERE book_fts MATCH :match'
+            % ', '.join(str(w) for w in SQLITE_WEIGHTS)
+        ).columns(
+            book_id=db.Integer, rank=db.Float
+        ).bindparams(
+            match=' '.join('"%s"*' % w for w in words)
+        ).alias('matches')
+        return query.join(matches, Book.id == matches.c.book_id).order_by(
+            matches.c.rank, Book.id)
+    else:
+        # no full-text search here; scan for the whole phrase
+        like = '%' + searchterm + '%'
+        return query.filter(or_(
+            Book.title.ilike(like),
+            Book.author.ilike(like),
+            Book.synopsis.ilike(like)
+        ))
+
+
+def _has_fts_table():
+    return db.session.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' "
+        "AND name = 'book_fts'").first() is not None
@@ -0,0 +1,285 @@
+import cPickle as pickle
+import os
+import re
+import tempfile
+import threading
+
+from collections import defaultdict
+
+from . import app, db
+from .changes import after_commit
+from .models import Book
+
+# An optional, in-process alternative to the database's full-text search
+# (see search.py) for databases that don't have one. Set SEARCH_BACKEND
+# to 'memory' in the instance config to use it.
+#
+# Each process builds an inverted index of every book when it's first
+# needed (or loads it from the snapshot at SEARCH_INDEX_SNAPSHOT, if one
+# exists and still matches the database), then keeps it up to date by
+# watching its own sessions commit Book changes (see changes.py).
+# Changes committed by other processes aren't seen until the index is
+# rebuilt, e.g. on the next restart.
+
+# relative weights of words found in the title, author and synopsis
+FIELD_WEIGHTS = (('title', 10.0), ('author', 10.0), ('synopsis', 1.0))
+
+# bump this when the snapshot layout changes, so old snapshots are
+# rebuilt rather than misread
+SNAPSHOT_VERSION = 1
+
+# longest suffixes first; (suffix, replacement)
+SUFFIXES = (
+    ('ational', 'ate'), ('ization', 'ize'), ('fulness', 'ful'),
+    ('ousness', 'ous'), ('iveness', 'ive'), ('ments', ''), ('ness', ''),
+    ('ment', ''), ('ings', ''), ('ing', ''), ('ies', 'y'), ('ied', 'y'),
+    ('ers', ''), ('ed', ''), ('er', ''), ('ly', ''), ('es', ''), ('s', ''),
+)
+
+
+def tokenize(text):
+    """Return the lowercased words in `text`."""
+    return re.findall(r'\w+', (text or u'').lower(), re.UNICODE)
+
+
+def stem(word):
+    """Strip a common English suffix from `word`, so that 'fights',
+    'fighting' and 'fighter' all index as 'fight'. Deliberately light:
+    a short word keeps its suffix rather than losing its meaning.
+    """
+    for suffix, replacement in SUFFIXES:
+        if (word.endswith(suffix) and len(word) - len(suffix) >= 3):
+            return word[:-len(suffix)] + replacement
+    return word
+
+
+def trigrams(text):
+    """Return the set of three-character substrings of `text`."""
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+class BookIndex(object):
+    """An inverted index over books' titles, authors and synopses.
+
+    Words are stemmed and weighted by the field they're found in. On top
+    of that, titles and authors are indexed by trigram, so any fragment
+    of three or more characters (e.g.: 'ikke') finds them, like a LIKE
+    '%...%' would.
+    """
+
+    def __init__(self):
+        self.docs = {}  # book id -> set of its stems
+        self.names = {}  # book id -> lowercased 'title author'
+        self.words = defaultdict(dict)  # stem -> {book id: score}
+        self.grams = defaultdict(set)  # trigram -> set(book ids)
+        self._lock = threading.RLock()
+
+    def add(self, book_id, title, author, synopsis):
+        """Index a book, replacing whatever was indexed for it before."""
+        with self._lock:
+            self.remove(book_id)
+            fields = {'title': title, 'author': author, 'synopsis': synopsis}
+            stems = set()
+            for field, weight in FIELD_WEIGHTS:
+                for word in tokenize(fields[field]):
+                    stems.add(stem(word))
+                    postings = self.words[stem(word)]
+                    postings[book_id] = postings.get(book_id, 0) + weight
+            name = u' '.join(tokenize(title) + tokenize(author))
+            for gram in trigrams(name):
+                self.grams[gram].add(book_id)
+            self.docs[book_id] = stems
+            self.names[book_id] = name
+
+    def remove(self, book_id):
+        """Drop a book from the index, if it's there."""
+        with self._lock:
+            if (book_id not in self.docs):
+                return
+            for word in self.docs.pop(book_id):
+                postings = self.words[word]
+                postings.pop(book_id, None)
+                if not (postings):
+                    del self.words[word]
+            name = self.names.pop(book_id)
+            for gram in trigrams(name):
+                ids = self.grams.get(gram)
+                if (ids is not None):
+                    ids.discard(book_id)
+                    if not (ids):
+                        del self.grams[gram]
+
+    def _match_word(self, word):
+        """Return {book id: score} for the books matching one word of a
+        search: by stem anywhere, or as a fragment of a title or author.
+        """
+        matches = dict(self.words.get(stem(word), {}))
+        if (len(word) >= 3):
+            candidates = None
+            for gram in trigrams(word):
+                ids = self.grams.get(gram, set())
+                candidates = ids if candidates is None else candidates & ids
+                if not (candidates):
+                    break
+            for book_id in candidates or ():
+                if (book_id not in matches and word in self.names[book_id]):
+                    matches[book_id] = 1.0
+        return matches
+
+    def search(self, searchterm, limit=None):
+        """Return the IDs of the books matching every word of
+        `searchterm`, best matches first.
+        """
+        words = tokenize(searchterm)
+        if not (words):
+            return []
+        with self._lock:
+            scores = None
+            for word in words:
+                matches = self._match_word(word)
+                if (scores is None):
+                    scores = matches
+                else:
+                    scores = dict(
+                        (book_id, score + matches[book_id])
+                        for book_id, score in scores.iteritems()
+                        if book_id in matches
+                    )
+                if not (scores):
+                    return []
+        ranked = sorted(
+            scores, key=lambda book_id: (-scores[book_id], book_id))
+        return ranked[:limit] if limit else ranked
+
+    def __len__(self):
+        return len(self.docs)
+
+    def save(self, path, signature):
+        """Write the index to `path`, tagged with the database
+        `signature` it was built from. The file is replaced atomically,
+        so readers never see a half-written snapshot.
+        """
+        with self._lock:
+            state = {
+                'version': SNAPSHOT_VERSION,
+                'signature': signature,
+                'docs': self.docs,
+                'names': self.names,
+                'words': dict(self.words),
+                'grams': dict(self.grams),
+            }
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(path)))
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, signature):
+        """Return the index saved at `path`, or None if there isn't one
+        or it was built from a different state of the database.
+        """
+        try:
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+        if (state.get('version') != SNAPSHOT_VERSION or
+                state.get('signature') != signature):
+            return None
+        index = cls()
+        index.docs = state['docs']
+        index.names = state['names']
+        index.words.update(state['words'])
+        index.grams.update(state['grams'])
+        return index
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def database_signature():
+    """Return a cheap fingerprint of the book table, used to tell
+    whether a snapshot is still current: the number of books, the
+    highest ID (for additions and deletions) and the latest
+    `date_modified` (for edits to the indexed fields).
+    """
+    count, max_id, last_modified = db.session.query(
+        db.func.count(Book.id),
+        db.func.max(Book.id),
+        db.func.max(Book.date_modified)
+    ).one()
+    return [count, max_id, last_modified]
+
+
+def build_index():
+    """Build a fresh index from every book in the database, reading
+    them in batches.
+    """
+    index = BookIndex()
+    rows = db.session.query(
+        Book.id, Book.title, Book.author, Book.synopsis
+    ).order_by(Book.id).yield_per(1000)
+    for row in rows:
+        index.add(*row)
+    return index
+
+
+def get_index():
+    """Return this process's book index, loading or building it the
+    first time it's asked for.
+    """
+    global _index
+    if (_index is None):
+        with _index_lock:
+            if (_index is None):
+                path = app.config['SEARCH_INDEX_SNAPSHOT']
+                signature = database_signature()
+                index = BookIndex.load(path, signature) if path else None
+                if (index is None):
+                    index = build_index()
+                    if (path):
+                        index.save(path, signature)
+                _index = index
+    return _index
+
+
+def save_snapshot():
+    """Write this process's index to SEARCH_INDEX_SNAPSHOT. Returns the
+    number of books in it.
+    """
+    index = get_index()
+    index.save(app.config['SEARCH_INDEX_SNAPSHOT'], database_signature())
+    return len(index)
+
+
+@app.before_first_request
+def warm_index():
+    """Have the index ready before the first search comes in."""
+    if (app.config['SEARCH_BACKEND'] == 'memory'):
+        get_index()
+
+
+def reset_index():
+    """Forget the index; the next `get_index` builds a new one."""
+    global _index
+    _index = None
+
+
+def _indexed_fields(book):
+    return (book.title, book.author, book.synopsis)
+
+
+@after_commit(Book, capture=_indexed_fields)
+def _apply_book_changes(changes):
+    """Index the books a commit added or edited, and drop the ones it
+    deleted.
+    """
+    if (_index is None):
+        return
+    for book_id, fields in changes.iteritems():
+        if (fields is None):
+            _index.remove(book_id)
+        else:
+            _index.add(book_id, *fields)
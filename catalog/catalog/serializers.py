@@ -0,0 +1,156 @@
+from flask import url_for
+from sqlalchemy.orm import aliased
+
+from . import app, db
+from .models import Book, BookBorrower, User
+
+# The API and the feeds serialize books in bulk. Rather than load each
+# Book with its lender, current loan and borrower as ORM objects and call
+# `Book.serialize` on it, they read just the columns `serialize` uses,
+# with one joined query, and build the same dicts straight from the rows.
+
+Lender = aliased(User, name='lender')
+Borrower = aliased(User, name='borrower')
+
+# the fields of a serialized book (see `Book.serialize`); clients can ask
+# for just some of them, and then only what those need is loaded
+FIELDS = (
+    'title',
+    'author',
+    'date_added',
+    'id',
+    'synopsis',
+    'year_published',
+    'picture',
+    'lender',
+    'is_available',
+    'due_date',
+    'borrower'
+)
+
+# the fields that are just a Book column, besides the ID and title
+BOOK_COLUMNS = (
+    'author',
+    'date_added',
+    'synopsis',
+    'year_published',
+    'picture'
+)
+
+# the fields that come from the book's open loan
+LOAN_FIELDS = frozenset(['is_available', 'due_date', 'borrower'])
+
+
+def parse_fields(value):
+    """Return the set of fields named in a comma-separated `fields`
+    parameter, or None (all of them) if it's empty. Raises ValueError
+    if it names anything that isn't a field.
+    """
+    if not (value):
+        return None
+    fields = frozenset(name for name in value.split(',') if name)
+    if not (fields) or not (fields.issubset(FIELDS)):
+        raise ValueError('Invalid fields: %r' % value)
+    return fields
+
+
+def book_rows(ids=None, fields=None):
+    """Return a query for the rows `serialize_books` turns into
+    serialized books: the book, its lender's email and its open loan,
+    if any. Narrow it down with `ids`, or pass it as the base query to
+    `filtered_books`.
+
+    With `fields`, only the columns and joins those fields need are
+    queried (the ID and title always are; lists are ordered by them).
+    """
+    wanted = FIELDS if fields is None else fields
+    query = db.session.query(
+        Book.id,
+        Book.title,
+        *[getattr(Book, name) for name in BOOK_COLUMNS if name in wanted]
+    ).select_from(Book)
+
+    # every book has a lender, so leaving the join out doesn't change
+    # which books are found
+    if ('lender' in wanted):
+        query = query.add_columns(
+            Lender.email.label('lender_email')
+        ).join(
+            Lender, Book.lender_id == Lender.id
+        )
+    if (LOAN_FIELDS.intersection(wanted)):
+        query = query.add_columns(
+            BookBorrower.id.label('loan_id'),
+            BookBorrower.due_date
+        ).outerjoin(
+            BookBorrower,
+            db.and_(
+                BookBorrower.book_id == Book.id,
+                BookBorrower.returned == db.false()
+            )
+        )
+        if ('borrower' in wanted):
+            query = query.add_columns(
+                Borrower.name.label('borrower_name'),
+                Borrower.email.label('borrower_email')
+            ).outerjoin(
+                Borrower, BookBorrower.user_id == Borrower.id
+            )
+    if (ids is not None):
+        query = query.filter(Book.id.in_(ids)).order_by(Book.title, Book.id)
+    return query
+
+
+def serialize_books(rows, fields=None):
+    """Yield a dict for each of `rows` (from a `book_rows` query), the
+    same as `Book.serialize` gives for that book; or with `fields`, just
+    those fields of it (`rows` has to have been queried for them).
+    """
+    wanted = FIELDS if fields is None else fields
+    pictures = 'picture' in wanted
+    loans = bool(LOAN_FIELDS.intersection(wanted))
+    if (pictures):
+        # every uploaded picture's URL starts the same way; work it out
+        # once rather than calling url_for for each book
+        media_url = url_for('home.media', filename='_', _external=True)[:-1]
+        to_url = app.url_map.converters['path'](app.url_map).to_url
+
+    for row in rows:
+        picture = None
+        if (pictures):
+            if ('http' in row.picture):
+                picture = row.picture
+            else:
+                picture = media_url + to_url(row.picture)
+
+        availability = [None, None, None]
+        if not (loans):
+            pass
+        elif (row.loan_id is None):
+            availability = [True, None, None]
+        else:
+            availability = [
+                False,
+                row.due_date.strftime('%m/%d/%Y'),
+                {
+                    'name': getattr(row, 'borrower_name', None),
+                    'email': getattr(row, 'borrower_email', None)
+                }
+            ]
+
+        book = {
+            'title': row.title,
+            'author': getattr(row, 'author', None),
+            'date_added': getattr(row, 'date_added', None),
+            'id': row.id,
+            'synopsis': getattr(row, 'synopsis', None),
+            'year_published': getattr(row, 'year_published', None),
+            'picture': picture,
+            'lender': getattr(row, 'lender_email', None),
+            'is_available': availability[0],
+            'due_date': availability[1],
+            'borrower': availability[2]
+        }
+        if (fields is not None):
+            book = dict((name, book[name]) for name in fields)
+        yield book
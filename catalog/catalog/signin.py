@@ -0,0 +1,80 @@
+import json
+import os
+import threading
+import time
+
+from . import app
+
+# The sign-in providers' settings: Google's come from the client secrets
+# file downloaded from the Google API console, Facebook's from the
+# FACEBOOK_CONFIG setting (JSON, in the same layout). Both are needed on
+# every page that can show a sign-in button, so rather than read and
+# parse them each time, `settings` keeps them parsed.
+
+
+class ConfigSnapshot(object):
+    """The parsed `web` sections of the Google client secrets file and
+    of FACEBOOK_CONFIG. Each is parsed the first time it's asked for
+    and kept. The file is read again only when its modification time
+    changes, which is checked at most once every CONFIG_CHECK_INTERVAL
+    seconds; if it can't be read then, the settings read before are
+    kept. FACEBOOK_CONFIG is parsed again only if it's replaced.
+    """
+
+    def __init__(self, secrets_file):
+        self.secrets_file = secrets_file
+        self._google = None
+        self._mtime = None
+        self._checked = 0
+        self._facebook = (None, None)
+        self._lock = threading.Lock()
+
+    @property
+    def google(self):
+        now = time.time()
+        interval = app.config['CONFIG_CHECK_INTERVAL']
+        if (self._google is None or now - self._checked >= interval):
+            with self._lock:
+                self._checked = now
+                try:
+                    mtime = os.stat(self.secrets_file).st_mtime
+                    if (mtime != self._mtime):
+                        with open(self.secrets_file, 'r') as f:
+                            self._google = json.load(f)['web']
+                        self._mtime = mtime
+                except (EnvironmentError, ValueError, KeyError):
+                    # a file that's missing, moved or half-written
+                    # (being replaced, say) leaves the last good
+                    # settings in place, if there are any
+                    if (self._google is None):
+                        raise
+                    app.logger.warning(
+                        'Could not read %s; keeping the settings read '
+                        'before', self.secrets_file, exc_info=True)
+        return self._google
+
+    @property
+    def facebook(self):
+        raw = app.config['FACEBOOK_CONFIG']
+        parsed_raw, parsed = self._facebook
+        if (raw is not parsed_raw):
+            parsed = json.loads(raw)['web']
+            self._facebook = (raw, parsed)
+        return parsed
+
+    @property
+    def google_client_id(self):
+        """The Google client ID, or None if Google sign-in is off."""
+        if (app.config['USE_GOOGLE_SIGNIN'] == True):
+            return self.google['client_id']
+        return None
+
+    @property
+    def facebook_app_id(self):
+        """The Facebook app ID, or None if Facebook sign-in is off."""
+        if (app.config['USE_FACEBOOK_SIGNIN'] == True):
+            return self.facebook['app_id']
+        return None
+
+
+settings = ConfigSnapshot(app.config['GOOGLE_CLIENT_SECRETS'])
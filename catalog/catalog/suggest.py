@@ -0,0 +1,163 @@
+import bisect
+import re
+import threading
+import time
+import unicodedata
+
+from . import app, db
+from .changes import after_commit
+from .models import Book
+
+# Search-as-you-type suggestions for the search box. Every book's title
+# and author is kept, normalized, in a sorted list; the suggestions for
+# what's been typed so far are the entries starting with it, found by
+# binary search. Each word of a title or author starts an entry of its
+# own, so 'bud' suggests 'Rarnaby Budge' too.
+#
+# Like the in-memory search index (see search_index.py), the list is
+# built once per process and kept up to date by watching the process's
+# own commits. Other processes' changes aren't seen that way, so the
+# list is also rebuilt from the database every SUGGEST_INDEX_TTL seconds.
+
+
+def normalize(text):
+    """Lowercase `text` and strip its accents and punctuation, so that
+    suggestions match however the user types (or doesn't type) them.
+    """
+    text = unicodedata.normalize('NFKD', unicode(text or u''))
+    text = u''.join(c for c in text if not unicodedata.combining(c))
+    return u' '.join(re.findall(r'\w+', text.lower(), re.UNICODE))
+
+
+class PrefixIndex(object):
+    """A sorted list of (key, kind, value, book id) entries, where `key`
+    is the normalized form of `value` (or of its tail from one of its
+    words on) and `kind` is 'title' or 'author'.
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.book_entries = {}  # book id -> its entries
+        self._lock = threading.Lock()
+
+    def add(self, book_id, title, author):
+        """Add a book's title and author, replacing whatever was there
+        for it before.
+        """
+        entries = self._entries(book_id, title, author)
+        with self._lock:
+            self._remove(book_id)
+            for entry in entries:
+                bisect.insort(self.entries, entry)
+            self.book_entries[book_id] = entries
+
+    def load(self, books):
+        """Add many (book id, title, author) rows at once, sorting once
+        at the end instead of inserting each entry in place.
+        """
+        with self._lock:
+            for book_id, title, author in books:
+                self._remove(book_id)
+                entries = self._entries(book_id, title, author)
+                self.entries.extend(entries)
+                self.book_entries[book_id] = entries
+            self.entries.sort()
+
+    def _entries(self, book_id, title, author):
+        entries = []
+        for kind, value in (('title', title), ('author', author)):
+            words = normalize(value).split(u' ')
+            for i in range(len(words)):
+                key = u' '.join(words[i:])
+                if (key):
+                    entries.append((key, kind, value, book_id))
+        return entries
+
+    def remove(self, book_id):
+        with self._lock:
+            self._remove(book_id)
+
+    def _remove(self, book_id):
+        for entry in self.book_entries.pop(book_id, ()):
+            i = bisect.bisect_left(self.entries, entry)
+            if (i < len(self.entries) and self.entries[i] == entry):
+                del self.entries[i]
+
+    def suggest(self, prefix, limit):
+        """Return up to `limit` distinct (kind, value, book id) matches
+        for `prefix`, in alphabetical order. Authors aren't tied to a
+        book, so their book id is None.
+        """
+        prefix = normalize(prefix)
+        if not (prefix):
+            return []
+        results = []
+        seen = set()
+        with self._lock:
+            i = bisect.bisect_left(self.entries, (prefix,))
+            while (len(results) < limit and i < len(self.entries)):
+                key, kind, value, book_id = self.entries[i]
+                i += 1
+                if not (key.startswith(prefix)):
+                    break
+                if (kind == 'author'):
+                    book_id = None
+                if ((kind, value, book_id) not in seen):
+                    seen.add((kind, value, book_id))
+                    results.append((kind, value, book_id))
+        return results
+
+
+_index = None
+_index_built = 0
+_index_lock = threading.Lock()
+
+
+def build_index():
+    """Build a fresh index of every book's title and author."""
+    index = PrefixIndex()
+    index.load(db.session.query(
+        Book.id, Book.title, Book.author).yield_per(1000))
+    return index
+
+
+def get_index():
+    """Return this process's suggestion index, building it the first
+    time it's asked for, and again once it's SUGGEST_INDEX_TTL seconds
+    old. While one thread rebuilds it, the others keep using the old one.
+    """
+    global _index, _index_built
+    ttl = app.config['SUGGEST_INDEX_TTL']
+    if (_index is not None and time.time() - _index_built < ttl):
+        return _index
+    # only wait for the index if there isn't one yet
+    if not (_index_lock.acquire(_index is None)):
+        return _index
+    try:
+        if (_index is None or time.time() - _index_built >= ttl):
+            _index = build_index()
+            _index_built = time.time()
+    finally:
+        _index_lock.release()
+    return _index
+
+
+def reset_index():
+    """Forget the index; the next `get_index` builds a new one."""
+    global _index
+    _index = None
+
+
+def _suggested_fields(book):
+    return (book.title, book.author)
+
+
+@after_commit(Book, capture=_suggested_fields)
+def _apply_book_changes(changes):
+    if (_index is None):
+        return
+    for book_id, fields in changes.iteritems():
+        if (fields is None):
+            _index.remove(book_id)
+        else:
+            _index.add(book_id, *fields)
@@ -1,17 +1,74 @@
+import base64
+import csv
+import hashlib
 import json
 import os
 import re
 import time
 
-from datetime import datetime as dt
-from flask import g, make_response, url_for, session as login_session, redirect
+from datetime import datetime as dt, timedelta
+from flask import (
+    g,
+    json as flask_json,
+    make_response,
+    redirect,
+    request,
+    session as login_session,
+    stream_with_context,
+    url_for
+)
 from functools import wraps
+from sqlalchemy import and_, false, or_
+from sqlalchemy.orm import joinedload
 from sqlalchemy.orm.exc import NoResultFound
+from StringIO import StringIO
 from werkzeug import secure_filename
-from xml.dom.minidom import Document as xmldoc
 
-from . import app
-from .models import Book, Category
+from . import app, db
+from .cache import TTLCache
+from .compression import negotiate
+from .models import (
+    Book,
+    BookBorrower,
+    Category,
+    book_category,
+    book_favorite,
+    catalog_version
+)
+from .serializers import serialize_books
+from .xmlwriter import XMLWriter
+
+# the sidebar shows the same per-category counts on every page; cache
+# them rather than counting on every request
+_category_counts = TTLCache(maxsize=1, ttl=app.config['CATEGORY_COUNT_TTL'])
+
+# the book lists that are paged (see `filter_books`)
+PAGED_FILTERS = ('mybooks', 'favorites', 'category', 'all')
+
+# the book lists `since` applies to (see `changed_since`). Favoriting a
+# book doesn't modify it, so the favorites list can't be kept in sync
+# that way
+SINCE_FILTERS = ('mybooks', 'category', 'all')
+
+# the columns of the API's CSV output, in order
+CSV_FIELDS = (
+    'id',
+    'title',
+    'author',
+    'year_published',
+    'synopsis',
+    'picture',
+    'date_added',
+    'lender',
+    'is_available',
+    'due_date',
+    'borrower_name',
+    'borrower_email'
+)
+
+# the (UTC) timestamps `since` takes, with or without a trailing Z; the first
+# is also how cursors hold them
+SINCE_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d')
 
 
 def login_required(_next=None):
@@ -61,6 +118,54 @@ def book_exists(func):
     return decorated_view
 
 
+def conditional(func):
+    """Tag a view's responses with an ETag and Last-Modified date made
+    from the catalog version (see `models.CatalogVersion`), and answer
+    requests whose If-None-Match or If-Modified-Since shows the client
+    already has the current response with a 304, without running the
+    view at all. Only for views whose output depends on nothing but the
+    catalog, the URL and the user. This is used as a decorator.
+    """
+    @wraps(func)
+    def decorated_view(*args, **kwargs):
+        version, updated = g.catalog_version = catalog_version()
+        user = g.get('user')
+        # the same response compressed differently (see `compression`)
+        # is a different representation, with its own ETag
+        key = u'%d|%s|%s|%s' % (
+            version, user.id if user else '', request.full_path,
+            negotiate() or '')
+        etag = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        if (updated is not None):
+            # HTTP dates only go down to the second
+            updated = updated.replace(microsecond=0)
+
+        if (request.if_none_match):
+            not_modified = request.if_none_match.contains(etag)
+        elif (request.if_modified_since and updated is not None):
+            not_modified = updated <= request.if_modified_since
+        else:
+            not_modified = False
+
+        if (not_modified):
+            resp = app.response_class(status=304)
+        else:
+            resp = make_response(func(*args, **kwargs))
+            if (resp.status_code != 200):
+                return resp
+        resp.set_etag(etag)
+        resp.last_modified = updated
+        if (app.config['COMPRESS_LEVEL'] > 0):
+            # the ETag depends on the encoding, even for responses too
+            # small to compress and 304s, so caches must keep them apart
+            resp.vary.add('Accept-Encoding')
+        # always check back, rather than guess from Last-Modified
+        resp.cache_control.no_cache = True
+        return resp
+
+    return decorated_view
+
+
 def report_json_error(msg, code=401):
     """During authentication, errors are reported back to the app
     using this function.
@@ -70,30 +175,312 @@ def report_json_error(msg, code=401):
     return response
 
 
-def filter_books(_filter, thisCategory=None):
+def book_list_query():
+    """Return a Book query with the loading profile used by book lists.
+    Every book card in the templates (and every serialized book in the
+    API) touches the lender and the current loan, so join those in up
+    front rather than loading them lazily, one card at a time. Ratings
+    come from the aggregate columns on Book, so they don't need loading
+    at all.
+    """
+    return Book.query.options(
+        joinedload(Book.lender),
+        joinedload(Book.current_loan).joinedload(BookBorrower.borrower)
+    )
+
+
+def filter_books(_filter, thisCategory=None, after=None, limit=None,
+                 query=None):
     """Return a list of books by a user-specified filter. Filtering a
     list of books is done by more than one function, so putting the code
     here saves some repetition.
+
+    Lists are paged through by (title, id), `limit` books at a time,
+    starting after the book identified by the `after` cursor. Returns
+    the books along with the cursor for the next page (None on the last
+    page). A bad cursor raises ValueError. The recent books list is
+    always just the latest 8, so it isn't paged.
+
+    Books are loaded as Book objects, unless `query` gives another query
+    to filter (e.g.: `serializers.book_rows`).
+    """
+    query = filtered_books(_filter, thisCategory, after, query)
+    if (_filter not in PAGED_FILTERS):
+        return query, None
+    return paginate_books(query, limit)
+
+
+def filtered_books(_filter, thisCategory=None, after=None, query=None):
+    """Return a query for the whole of a filter's list of books (see
+    `filter_books`), in list order, starting after the `after` cursor.
     """
-    if (_filter == 'mybooks'):
+    if (query is None):
+        query = book_list_query()
+    if (_filter in ('mybooks', 'favorites') and g.user is None):
+        # the API's lists don't require signing in, and an anonymous
+        # user has no books or favorites of their own
+        query = query.filter(false())
+    elif (_filter == 'mybooks'):
         # books lent by the user
-        books = Book.query.filter_by(lender=g.user).all()
+        query = query.filter(Book.lender_id == g.user.id)
     elif (_filter == 'favorites'):
         # books marked by user as favorites
-        books = Book.query.filter(Book.favorite.contains(g.user)).all()
+        query = query.filter(Book.favorite.contains(g.user))
     elif (_filter == 'category'):
         # books of a certain genre/category
         cat = Category.query.filter_by(name=thisCategory).one()
-        books = Book.query.filter(Book.category.contains(cat)).all()
+        query = query.filter(Book.category.contains(cat))
     elif (_filter == 'all'):
         # all books
-        books = Book.query.all()
+        pass
     else:
         # most recent 8 books (why 8? it's two rows of four in
         # the template at full width)
-        books = Book.query.order_by(Book.date_added.desc()).limit(8)
+        return query.order_by(Book.date_added.desc(), Book.id).limit(8)
+
+    # rather than skipping over earlier pages with OFFSET, each page
+    # starts right after the last book of the previous one (a keyset,
+    # served by the title/id index), so deep pages cost the same as the
+    # first
+    query = query.order_by(Book.title, Book.id)
+    if (after):
+        title, book_id = decode_cursor(after)
+        query = query.filter(or_(
+            Book.title > title,
+            and_(Book.title == title, Book.id > book_id)
+        ))
+    return query
+
+
+def paginate_books(query, limit=None):
+    """Return the first `limit` books of `query`, a list from
+    `filtered_books`, plus the cursor for the following page.
+    """
+    limit = limit or app.config['API_PAGE_SIZE']
+
+    # fetch one extra book to find out if there's another page
+    books = query.limit(limit + 1).all()
+    if (len(books) > limit):
+        return books[:limit], encode_cursor(books[limit - 1])
+    else:
+        return books, None
+
+
+def changed_since(query, since):
+    """Narrow `query`, a list of `serializers.book_rows` from
+    `filtered_books`, down to the books added or modified (see
+    `Book.date_modified`) after `since`, in the order they changed in.
+    `since` is either a UTC timestamp, such as 2016-01-04T18:46:03, or a
+    cursor from `paginate_changes`; anything else raises ValueError.
+    """
+    modified, book_id = decode_since(since)
+    # the cursors `paginate_changes` makes need the date too
+    query = query.add_columns(Book.date_modified).order_by(None).order_by(
+        Book.date_modified, Book.id)
+    if (book_id is None):
+        return query.filter(Book.date_modified > modified)
+    # served by the date_modified/id index, like the list keyset
+    return query.filter(or_(
+        Book.date_modified > modified,
+        and_(Book.date_modified == modified, Book.id > book_id)
+    ))
+
+
+def paginate_changes(query, since, limit=None):
+    """Return the first `limit` books of `query`, a list from
+    `changed_since`, the cursor to ask for the changes after them with
+    (`since` itself, if there aren't any), and whether there are more.
+
+    A book is stamped when it's flushed, not when the change commits, so
+    a transaction still open now can commit a book stamped before the
+    last one returned. The last page's cursor is therefore held back to
+    API_SINCE_LAG seconds ago: changes from then on are returned again
+    next time, rather than possibly never.
+    """
+    limit = limit or app.config['API_PAGE_SIZE']
+
+    books = query.limit(limit + 1).all()
+    more = len(books) > limit
+    books = books[:limit]
+    if (books):
+        since = encode_since(books[-1])
+    if not (more):
+        horizon = since_horizon()
+        if (decode_since(since)[0] > decode_since(horizon)[0]):
+            since = horizon
+    return books, since, more
+
+
+def since_horizon():
+    """Return the cursor for the changes after API_SINCE_LAG seconds
+    ago, the latest a client can be told to ask for changes since (see
+    `paginate_changes`). Streamed changes, which have no last page to
+    take a cursor from, end with it.
+    """
+    horizon = dt.utcnow() - timedelta(seconds=app.config['API_SINCE_LAG'])
+    return horizon.strftime(SINCE_FORMATS[0])
+
+
+def iter_books(query, fields=None):
+    """Yield the serialized books (or just their `fields`) of a
+    `serializers.book_rows` query, reading them from the database in
+    batches of API_STREAM_BATCH_SIZE (through a server-side cursor,
+    where the database has them), so the whole result is never held in
+    memory at once.
+    """
+    return serialize_books(
+        query.yield_per(app.config['API_STREAM_BATCH_SIZE']), fields)
+
+
+def stream_books_json(query, fields=None):
+    """Yield the JSON for the books of `query` a piece at a time, in the
+    same layout `jsonify(Books=...)` gives (see `iter_books`).
+    """
+    yield '{"Books":['
+    for i, book in enumerate(iter_books(query, fields)):
+        yield (',' if i else '') + flask_json.dumps(
+            book, separators=(',', ':'))
+    yield ']}\n'
+
+
+def stream_books_ndjson(query, fields=None):
+    """Yield the books of `query` as newline-delimited JSON: one book,
+    as `jsonify` would write it, per line (see `iter_books`).
+    """
+    for book in iter_books(query, fields):
+        yield flask_json.dumps(book, separators=(',', ':')) + '\n'
+
+
+def stream_books_csv(query, fields=None):
+    """Yield the books of `query` as CSV, a header row and then one row
+    per book (see `iter_books`). The borrower's name and email get a
+    column each; text is UTF-8.
+    """
+    buf = StringIO()
+    writer = csv.writer(buf)
+
+    def row(values):
+        writer.writerow([
+            v.encode('utf-8') if isinstance(v, unicode) else v
+            for v in values
+        ])
+        line = buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+        return line
+
+    columns = [
+        column for column in CSV_FIELDS
+        if fields is None or column in fields or
+        (column.startswith('borrower_') and 'borrower' in fields)
+    ]
+    yield row(columns)
+    for book in iter_books(query, fields):
+        borrower = book.get('borrower') or {}
+        if (book.get('date_added')):
+            book['date_added'] = book['date_added'].isoformat()
+        book['borrower_name'] = borrower.get('name')
+        book['borrower_email'] = borrower.get('email')
+        yield row([book[column] for column in columns])
+
+
+def encode_cursor(book):
+    """Return an opaque, URL-safe cursor pointing just past `book` in
+    (title, id) order.
+    """
+    return base64.urlsafe_b64encode(
+        json.dumps([book.title, book.id], separators=(',', ':')))
+
 
-    return books
+def decode_cursor(cursor):
+    """Return the (title, id) pair held in a cursor made by
+    `encode_cursor`. Raises ValueError if it isn't one.
+    """
+    try:
+        title, book_id = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        return title, int(book_id)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor: %r' % cursor)
+
+
+def encode_since(book):
+    """Return an opaque, URL-safe cursor pointing just past `book` in
+    (date_modified, id) order.
+    """
+    return base64.urlsafe_b64encode(json.dumps(
+        [book.date_modified.strftime(SINCE_FORMATS[0]), book.id],
+        separators=(',', ':')
+    ))
+
+
+def decode_since(since):
+    """Return the (date, id) pair for a timestamp or a cursor made by
+    `encode_since`; the id is None for a timestamp. Raises ValueError if
+    `since` is neither.
+    """
+    for date_format in SINCE_FORMATS:
+        try:
+            return dt.strptime(since.rstrip('Z'), date_format), None
+        except ValueError:
+            pass
+    try:
+        modified, book_id = json.loads(base64.urlsafe_b64decode(str(since)))
+        return dt.strptime(modified, SINCE_FORMATS[0]), int(book_id)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid since: %r' % since)
+
+
+def next_page_url(cursor, arg='after'):
+    """Return the URL of the next page of the current book list, i.e.:
+    the current URL with its `after` cursor (or `arg`) set to `cursor`.
+    """
+    args = request.args.to_dict()
+    args.update(request.view_args)
+    args[arg] = cursor
+    return url_for(request.endpoint, _external=True, **args)
+
+
+@app.template_global('favorite_ids')
+def favorite_book_ids():
+    """Return the IDs of the current user's favorite books as a set,
+    loaded with a single query the first time it's needed during a
+    request. Book lists check every book against this, so membership
+    has to be cheap. Anonymous users have no favorites.
+    """
+    if ('favorite_ids' not in g):
+        user = g.get('user')
+        if (user is None):
+            g.favorite_ids = frozenset()
+        else:
+            rows = db.session.query(book_favorite.c.book_id).filter(
+                book_favorite.c.user_id == user.id)
+            g.favorite_ids = frozenset(r.book_id for r in rows)
+    return g.favorite_ids
+
+
+@app.template_global('category_counts')
+def category_book_counts():
+    """Return a dict mapping each category's ID to the number of books
+    in it. The counts come from a single GROUP BY over book_category
+    and are cached in process; see `invalidate_category_counts`.
+    """
+    counts = _category_counts.get('counts')
+    if (counts is None):
+        rows = db.session.query(
+            book_category.c.category_id,
+            db.func.count(book_category.c.book_id)
+        ).group_by(book_category.c.category_id)
+        counts = dict(rows)
+        _category_counts.set('counts', counts)
+    return counts
+
+
+def invalidate_category_counts():
+    """Throw away the cached category counts. Call this after adding,
+    editing or deleting a book. Other processes pick up the change once
+    their copy expires (after CATEGORY_COUNT_TTL seconds).
+    """
+    _category_counts.clear()
 
 
 def set_image_name(filename):
@@ -124,189 +511,181 @@ def save_uploaded_image(image):
     return filename
 
 
-def xmlify(model, q):
-    """Serialize a Python dict as generic XML using xml.dom.minidom.
-    See: https://docs.python.org/2/library/xml.html
+def xmlify(model, q, next_cursor=None, stream=False, since=None):
+    """Serialize a list of Python dicts as generic XML (see
+    `iter_xml`). With `stream`, the response is sent as it's written
+    instead of all at once.
     """
-    doc = xmldoc()
-    _xml = doc.appendChild(doc.createElement(model + 's'))
-    for obj in q:
-        node = _xml.appendChild(doc.createElement(model))
+    return _xml_response(
+        iter_xml(model, q, next_cursor, since), 'application/xml', stream)
 
+
+def iter_xml(model, q, next_cursor=None, since=None):
+    """Serialize a list of Python dicts as generic XML, one element at a
+    time. If there's another page of results, its cursor is given in the
+    root element's `next` attribute; a list of changes gives the cursor
+    for the changes after it in `since` (see `changed_since`).
+    """
+    w = XMLWriter()
+    yield w.declaration()
+    attrs = {}
+    if (next_cursor):
+        attrs['next'] = next_cursor
+    if (since):
+        attrs['since'] = since
+    yield w.start(model + 's', attrs or None)
+    for obj in q:
+        node = w.start(model)
         for key, value in obj.iteritems():
-            nodesub = node.appendChild(doc.createElement(key))
-            nodesub.appendChild(doc.createTextNode(unicode(value)))
+            node += w.element(key, unicode(value))
+        yield node + w.end()
+    yield w.end()
 
-    resp = app.response_class(
-        doc.toprettyxml(indent='    ', encoding='utf-8'),
-        mimetype='application/xml'
-    )
 
-    return resp
+def atomify(q, next_url=None, updated=None, stream=False):
+    """Serialize a list of Python dicts as an Atom feed (see
+    `iter_atom`). With `stream`, the response is sent as it's written
+    instead of all at once.
+    """
+    return _xml_response(
+        iter_atom(q, next_url, updated), 'application/atom+xml', stream)
 
 
-def atomify(q):
-    """Serialize a Python dict as XML using xml.dom.minidom,
+def iter_atom(q, next_url=None, updated=None):
+    """Serialize a list of Python dicts as XML, one entry at a time,
     this time constructing the document according to the Atom
     Syndication Format. The resulting document can be used by
-    feed readers like Google's Feedburner.
+    feed readers like Google's Feedburner. If there's another page
+    of results, it's linked with rel="next" (RFC 5005). The feed's
+    `updated` date is the time of the last change to the catalog (or
+    now, if that's not known).
     See: https://tools.ietf.org/html/rfc4287
     """
-    doc = xmldoc()
-    _xml = doc.appendChild(doc.createElement('feed'))
-    _xml.setAttribute('xmlns', 'http://www.w3.org/2005/Atom')
-    title = _xml.appendChild(doc.createElement('title'))
-    title.appendChild(doc.createTextNode('Book List from Lending Library'))
-    link = _xml.appendChild(doc.createElement('link'))
-    link.setAttribute('href', url_for('home.booksAPI', _external=True))
-    link.setAttribute('rel', 'self')
-    feed_id = _xml.appendChild(doc.createElement('id'))
-    feed_id.appendChild(
-        doc.createTextNode(url_for('home.catalogHome', _external=True)))
-    update_date = dt.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
-    updated = _xml.appendChild(doc.createElement('updated'))
-    updated.appendChild(doc.createTextNode(update_date))
+    w = XMLWriter()
+    yield w.declaration()
+    head = w.start('feed', {'xmlns': 'http://www.w3.org/2005/Atom'})
+    head += w.element('title', 'Book List from Lending Library')
+    head += w.element('link', attrs={
+        'href': url_for('home.booksAPI', _external=True),
+        'rel': 'self'
+    })
+    if (next_url):
+        head += w.element('link', attrs={'href': next_url, 'rel': 'next'})
+    head += w.element('id', url_for('home.catalogHome', _external=True))
+    update_date = (updated or dt.utcnow()).strftime('%Y-%m-%dT%H:%M:%SZ')
+    head += w.element('updated', update_date)
+    yield head
 
     for obj in q:
-        entry = _xml.appendChild(doc.createElement('entry'))
-
-        entry_title = entry.appendChild(doc.createElement('title'))
-        entry_title.appendChild(doc.createTextNode(obj['title']))
+        entry = w.start('entry')
+        entry += w.element('title', obj['title'])
 
         eLink = url_for('home.bookInfo', book_id=obj['id'], _external=True)
-        entry_link = entry.appendChild(doc.createElement('link'))
-        entry_link.setAttribute('href', eLink)
+        entry += w.element('link', attrs={'href': eLink})
 
         host = re.search(r'//(.+?)/(.+)/', eLink)
         entry_tag = 'tag:' + host.group(1) + ','
         entry_tag += obj['date_added'].strftime('%Y-%m-%d')
         entry_tag += ':/' + host.group(2)
-        entry_id = entry.appendChild(doc.createElement('id'))
-        entry_id.appendChild(doc.createTextNode(entry_tag))
+        entry += w.element('id', entry_tag)
 
         entry_date = obj['date_added'].strftime('%Y-%m-%dT%H:%M:%SZ')
-        entry_updated = entry.appendChild(doc.createElement('updated'))
-        entry_updated.appendChild(doc.createTextNode(entry_date))
-
-        entry_summary = entry.appendChild(doc.createElement('summary'))
-        entry_summary.appendChild(doc.createTextNode(obj['synopsis']))
+        entry += w.element('updated', entry_date)
+        entry += w.element('summary', obj['synopsis'])
 
-        author = entry.appendChild(doc.createElement('author'))
-        author_name = author.appendChild(doc.createElement('name'))
-        author_name.appendChild(doc.createTextNode(obj['author']))
+        entry += w.start('author')
+        entry += w.element('name', obj['author'])
+        entry += w.end()
 
-        year_pub = entry.appendChild(doc.createElement('yearpublished'))
-        year_pub.appendChild(doc.createTextNode(str(obj['year_published'])))
-
-        picture = entry.appendChild(doc.createElement('picture'))
-        picture.appendChild(doc.createTextNode(obj['picture']))
-
-        avail = entry.appendChild(doc.createElement('isavailable'))
-        avail.appendChild(doc.createTextNode(str(obj['is_available'])))
+        entry += w.element('yearpublished', str(obj['year_published']))
+        entry += w.element('picture', obj['picture'])
+        entry += w.element('isavailable', str(obj['is_available']))
 
         if (obj['due_date'] is not None):
             ts = time.strptime(obj['due_date'], '%m/%d/%Y')
             due_date = dt.fromtimestamp(time.mktime(ts))
             entry_due_date = due_date.strftime('%Y-%m-%dT%H:%M:%SZ')
-            due_date = entry.appendChild(doc.createElement('duedate'))
-            due_date.appendChild(doc.createTextNode(entry_due_date))
+            entry += w.element('duedate', entry_due_date)
 
-        lender = entry.appendChild(doc.createElement('lender'))
-        lender_email = lender.appendChild(doc.createElement('email'))
-        lender_email.appendChild(doc.createTextNode(obj['lender']))
+        entry += w.start('lender')
+        entry += w.element('email', obj['lender'])
+        entry += w.end()
 
         if (obj['borrower'] is not None):
-            borrower = entry.appendChild(doc.createElement('borrower'))
-            borrower_name = borrower.appendChild(doc.createElement('name'))
-            borrower_name.appendChild(
-                doc.createTextNode(obj['borrower']['name']))
-            borrower_email = borrower.appendChild(doc.createElement('email'))
-            borrower_email.appendChild(
-                doc.createTextNode(obj['borrower']['email']))
-
-    resp = app.response_class(
-        doc.toprettyxml(indent='    ', encoding='utf-8'),
-        mimetype='application/atom+xml'
-    )
+            entry += w.start('borrower')
+            entry += w.element('name', obj['borrower']['name'])
+            entry += w.element('email', obj['borrower']['email'])
+            entry += w.end()
 
-    return resp
+        yield entry + w.end()
+    yield w.end()
 
 
-def rssify(q):
-    """Serialize a Python dict as XML using xml.dom.minidom,
+def rssify(q, updated=None, stream=False):
+    """Serialize a list of Python dicts as an RSS feed (see
+    `iter_rss`). With `stream`, the response is sent as it's written
+    instead of all at once.
+    """
+    return _xml_response(iter_rss(q, updated), 'application/rss+xml', stream)
+
+
+def iter_rss(q, updated=None):
+    """Serialize a list of Python dicts as XML, one item at a time,
     this time constructing the document according to the RSS
     (Rich Site Summary) format. The resulting document can be
-    used by feed readers like Google's Feedburner.
+    used by feed readers like Google's Feedburner. Its `pubDate` is
+    the time of the last change to the catalog (or now, if that's not
+    known).
     See: http://www.rssboard.org/rss-specification
     """
-    doc = xmldoc()
-    _rss = doc.appendChild(doc.createElement('rss'))
-    _rss.setAttribute('version', '2.0')
-    channel = _rss.appendChild(doc.createElement('channel'))
-    title = channel.appendChild(doc.createElement('title'))
-    title.appendChild(doc.createTextNode('Book List from Lending Library'))
-    desc = channel.appendChild(doc.createElement('description'))
-    desc.appendChild(
-        doc.createTextNode('A list of books from the Lending Library.'))
-    link = channel.appendChild(doc.createElement('link'))
-    link.appendChild(
-        doc.createTextNode(url_for('home.booksAPI', _external=True)))
+    w = XMLWriter()
+    yield w.declaration()
+    head = w.start('rss', {'version': '2.0'})
+    head += w.start('channel')
+    head += w.element('title', 'Book List from Lending Library')
+    head += w.element(
+        'description', 'A list of books from the Lending Library.')
+    head += w.element('link', url_for('home.booksAPI', _external=True))
     date_format = '%a, %d %b %Y %H:%M:%S +0000'
-    update_date = dt.utcnow().strftime(date_format)
-    pub_date = channel.appendChild(doc.createElement('pubDate'))
-    pub_date.appendChild(doc.createTextNode(update_date))
+    update_date = (updated or dt.utcnow()).strftime(date_format)
+    head += w.element('pubDate', update_date)
+    yield head
 
     for obj in q:
-        item = channel.appendChild(doc.createElement('item'))
-
-        item_title = item.appendChild(doc.createElement('title'))
-        item_title.appendChild(doc.createTextNode(obj['title']))
+        item = w.start('item')
+        item += w.element('title', obj['title'])
 
         eLink = url_for('home.bookInfo', book_id=obj['id'], _external=True)
-        item_link = item.appendChild(doc.createElement('link'))
-        item_link.appendChild(doc.createTextNode(eLink))
-
-        item_date = obj['date_added'].strftime(date_format)
-        item_updated = item.appendChild(doc.createElement('pubDate'))
-        item_updated.appendChild(doc.createTextNode(item_date))
-
-        item_summary = item.appendChild(doc.createElement('description'))
-        item_summary.appendChild(doc.createTextNode(obj['synopsis']))
-
-        author = item.appendChild(doc.createElement('author'))
-        author.appendChild(doc.createTextNode(obj['author']))
+        item += w.element('link', eLink)
 
-        year_pub = item.appendChild(doc.createElement('yearpublished'))
-        year_pub.appendChild(doc.createTextNode(str(obj['year_published'])))
-
-        picture = item.appendChild(doc.createElement('picture'))
-        picture.appendChild(doc.createTextNode(obj['picture']))
-
-        avail = item.appendChild(doc.createElement('isavailable'))
-        avail.appendChild(doc.createTextNode(str(obj['is_available'])))
+        item += w.element('pubDate', obj['date_added'].strftime(date_format))
+        item += w.element('description', obj['synopsis'])
+        item += w.element('author', obj['author'])
+        item += w.element('yearpublished', str(obj['year_published']))
+        item += w.element('picture', obj['picture'])
+        item += w.element('isavailable', str(obj['is_available']))
 
         if (obj['due_date'] is not None):
             ts = time.strptime(obj['due_date'], '%m/%d/%Y')
             due_date = dt.fromtimestamp(time.mktime(ts))
-            item_due_date = due_date.strftime(date_format)
-            due_date = item.appendChild(doc.createElement('duedate'))
-            due_date.appendChild(doc.createTextNode(item_due_date))
+            item += w.element('duedate', due_date.strftime(date_format))
 
-        lender = item.appendChild(doc.createElement('lender'))
-        lender.appendChild(doc.createTextNode(obj['lender']))
+        item += w.element('lender', obj['lender'])
 
         if (obj['borrower'] is not None):
             borrower_str = obj['borrower']['email'] + ' ('
             borrower_str += obj['borrower']['name'] + ')'
-            borrower = item.appendChild(doc.createElement('borrower'))
-            borrower.appendChild(doc.createTextNode(borrower_str))
+            item += w.element('borrower', borrower_str)
+
+        yield item + w.end()
+    yield w.end() + w.end()
 
-    resp = app.response_class(
-        doc.toprettyxml(indent='    ', encoding='utf-8'),
-        mimetype='application/rss+xml'
-    )
 
-    return resp
+def _xml_response(chunks, mimetype, stream=False):
+    if (stream):
+        return app.response_class(
+            stream_with_context(chunks), mimetype=mimetype)
+    return app.response_class(''.join(chunks), mimetype=mimetype)
 
 
 @app.template_filter('pluralize')
@@ -1,33 +1,119 @@
-import json
+from flask import (
+    Blueprint,
+    g,
+    has_request_context,
+    request,
+    session as login_session
+)
+from flask.ctx import _AppCtxGlobals
+from sqlalchemy.orm import make_transient_to_detached
 
-from flask import Blueprint, g, session as login_session
-
-from .. import app
+from .. import app, db
+from ..cache import TTLCache
+from ..changes import after_commit
 from ..models import User
+from ..signin import settings as signin
 
 auth = Blueprint('auth', __name__)
 home = Blueprint('home', __name__)
 test = Blueprint('test', __name__)
 
+# requests for files; they never need the user (or anything else
+# `pre_request` sets up)
+FILE_ENDPOINTS = ('static', 'home.media')
+
+# the signed-in users' column values, by ID, so most requests don't have
+# to look the user up; see `load_user`
+_users = TTLCache(
+    maxsize=app.config['USER_CACHE_SIZE'], ttl=app.config['USER_CACHE_TTL'])
+
+
+class RequestGlobals(_AppCtxGlobals):
+    """Flask's `g`, except that `g.user`, the signed-in user (or None),
+    is only looked up the first time a request uses it.
+    """
+
+    def __getattr__(self, name):
+        if (name == 'user'):
+            self.user = current_user()
+            return self.user
+        raise AttributeError(name)
+
+    def get(self, name, default=None):
+        if (name == 'user'):
+            return self.user
+        return super(RequestGlobals, self).get(name, default)
+
+
+app.app_ctx_globals_class = RequestGlobals
+
+
+def current_user():
+    """Return the signed-in user, by the `user_id` in their session, or
+    None if nobody's signed in.
+    """
+    if not (has_request_context()):
+        return None
+    # the user can be needed midway through a change to something else;
+    # looking them up shouldn't flush that change half-made
+    with db.session.no_autoflush:
+        user_id = login_session.get('user_id')
+        if (user_id is None):
+            if ('email' not in login_session):
+                return None
+            # a session from before the ID was kept in it
+            user = User.query.filter_by(email=login_session['email']).first()
+            if (user is None):
+                return None
+            user_id = login_session['user_id'] = user.id
+        return load_user(user_id)
+
+
+def load_user(user_id):
+    """Return the User with `user_id`, or None if there isn't one. The
+    user's row is cached for USER_CACHE_TTL seconds; each call returns
+    a new User object made from it, detached from the database session
+    (its columns can be read, and it can be compared with in queries),
+    so requests never share one.
+
+    To link the user to other objects, use `user.id` (e.g. `lender_id=
+    g.user.id`), or `db.session.merge(user, load=False)` to get the
+    session's own copy: the User itself can't be added to the session
+    once another copy of the row has been loaded into it.
+    """
+    values = _users.get(user_id)
+    if (values is None):
+        user = User.query.get(user_id)
+        if (user is None):
+            return None
+        values = dict(
+            (attr.key, getattr(user, attr.key))
+            for attr in User.__mapper__.column_attrs
+        )
+        _users.set(user_id, values)
+    user = User(**values)
+    make_transient_to_detached(user)
+    return user
+
+
+@after_commit(User)
+def forget_users(changes):
+    """Drop the cached rows of users that have just been changed, so the
+    next `load_user` call reads them again.
+    """
+    for user_id in changes:
+        _users.pop(user_id)
+
 
-@home.before_app_request
-@auth.before_app_request
+@app.before_request
 def pre_request():
-    current_user = None
-    if ('email' in login_session):
-        try:
-            current_user = User.query.filter_by(
-                email=login_session['email']).one()
-        except:
-            pass
-    g.user = current_user
-    if (app.config['USE_GOOGLE_SIGNIN'] == True):
-        g.gclient_id = json.loads(open(
-            'instance/client_secrets.json', 'r').read())['web']['client_id']
-    else:
-        g.gclient_id = None
-
-    if (app.config['USE_FACEBOOK_SIGNIN'] == True):
-        g.fb_appid = json.loads(app.config['FACEBOOK_CONFIG'])['web']['app_id']
-    else:
-        g.fb_appid = None
+    if (request.endpoint in FILE_ENDPOINTS):
+        return
+    # the user is looked up when first needed (see `RequestGlobals`),
+    # as is other per-user data (see `utils.favorite_book_ids`); forget
+    # the last request's
+    g.pop('user', None)
+    g.pop('favorite_ids', None)
+    # parsed once, not on every request; see `signin.ConfigSnapshot`
+    g.gclient_id = signin.google_client_id
+    g.fb_appid = signin.facebook_app_id
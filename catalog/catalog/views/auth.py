@@ -1,7 +1,5 @@
-import httplib2
 import json
 import random
-import requests
 import string
 
 from flask import (
@@ -13,14 +11,17 @@ from flask import (
     url_for
 )
 from oauth2client.client import flow_from_clientsecrets, FlowExchangeError
+from requests import RequestException
 
 from . import auth
-from .. import app, db
+from .. import app, db, outbound
 from ..utils import report_json_error
 from ..models import User
+from ..signin import settings as signin
 
-CLIENT_ID = json.loads(
-    open('instance/client_secrets.json', 'r').read())['web']['client_id']
+# reported when a sign-in provider's API can't be reached in time (see
+# outbound.py); the user can try again, or use the other provider
+PROVIDER_UNAVAILABLE = 'Sign-in service unavailable; please try again later.'
 
 
 @auth.route('/login/')
@@ -70,7 +71,7 @@ def gconnect():
         access_token_uri += '&access_token'
         userinfo_url = 'http://localhost:5000/test/userinfo/'
     else:
-        secret_file = 'instance/client_secrets.json'
+        secret_file = app.config['GOOGLE_CLIENT_SECRETS']
         access_token_uri = 'https://www.googleapis.com/oauth2/v1'
         access_token_uri += '/tokeninfo?access_token'
         userinfo_url = 'https://www.googleapis.com/oauth2/v1/userinfo'
@@ -98,11 +99,16 @@ def gconnect():
         # use to get whatever information we're entitled to (such as
         # the user's name, email and profile picture)
         try:
-            credentials = oauth_flow.step2_exchange(request.args.get('code'))
+            # through the app's HTTP client, not a new httplib2 one
+            credentials = oauth_flow.step2_exchange(
+                request.args.get('code'), http=outbound.Http())
         except FlowExchangeError as e:
             # something squirrely about the auth code? flag it here
             return report_json_error(
                 'Failed to upgrade the authorization code: ' + str(e))
+        except RequestException:
+            # Google is down or slow (see above); it's not the code
+            return report_json_error(PROVIDER_UNAVAILABLE, 503)
 
     access_token = credentials.access_token
     access_token_uri += '=%s' % access_token
@@ -110,9 +116,11 @@ def gconnect():
     # here we visit the Google OAuth url responsible for validating that
     # this app is what it claims to be, and verifying what info it's
     # entitled to have
-    h = httplib2.Http()
-    resp = h.request(access_token_uri, 'GET')[1]
-    result = json.loads(resp)
+    try:
+        result = outbound.get(access_token_uri).json()
+    except (RequestException, ValueError):
+        # Google is down, slow or answering nonsense; don't wait on it
+        return report_json_error(PROVIDER_UNAVAILABLE, 503)
 
     if (result.get('error') is not None):
         # if Google complains, report the error and abort
@@ -125,7 +133,7 @@ def gconnect():
         return report_json_error(
             'Token\'s user ID doesn\'t match given user ID.')
 
-    if (result['issued_to'] != CLIENT_ID):
+    if (result['issued_to'] != signin.google['client_id']):
         # similarly, if the app's client_id doesn't match, abort
         # and report the error
         return report_json_error('Token\'s client ID doesn\'t match app\'s.')
@@ -144,8 +152,13 @@ def gconnect():
     # now we know we're good to go, so grab the user profile info
     # from the appropriate Google URL
     params = {'access_token': access_token, 'alt': 'json'}
-    answer = requests.get(userinfo_url, params=params)
-    data = answer.json()
+    try:
+        data = outbound.get(userinfo_url, params=params).json()
+    except (RequestException, ValueError):
+        # not signed in after all
+        for key in ('provider', 'credentials', 'gplus_id'):
+            login_session.pop(key, None)
+        return report_json_error(PROVIDER_UNAVAILABLE, 503)
 
     login_session['username'] = data['name']
     login_session['picture'] = data['picture']
@@ -183,14 +196,16 @@ def gdisconnect():
         url += '/revoke?token=%s' % access_token
 
     # send the token revoke signal
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[0]
+    try:
+        revoked = outbound.get(url).status_code == 200
+    except RequestException:
+        revoked = False
 
     # delete the user session variables
     del login_session['gplus_id']
     del login_session['credentials']
 
-    if (result['status'] == '200'):
+    if (revoked):
         # if Google gives the thumbs-up, report success
         return report_json_error('Successfully disconnected.', 200)
     else:
@@ -216,9 +231,8 @@ def fbconnect():
     # in order to get the profile data
     access_token = request.data
 
-    fb_config = app.config['FACEBOOK_CONFIG']
-    app_id = json.loads(fb_config)['web']['app_id']
-    app_secret = json.loads(fb_config)['web']['app_secret']
+    app_id = signin.facebook['app_id']
+    app_secret = signin.facebook['app_secret']
     if (app.testing):
         # if we're testing, use mocked server responses
         token_url = 'http://localhost:5000/test/fbget_token/'
@@ -233,31 +247,30 @@ def fbconnect():
     token_url += '&client_secret=%s' % app_secret
     token_url += '&fb_exchange_token=%s' % access_token
 
-    # pull down the user profile info, except for the user's photo
-    h = httplib2.Http()
-    result = h.request(token_url, 'GET')[1]
+    try:
+        # pull down the user profile info, except for the user's photo
+        result = outbound.get(token_url).text
 
-    token = result.split('&')[0]
+        token = result.split('&')[0]
 
-    profile_url += '%s&fields=name,id,email' % token
-    h = httplib2.Http()
-    result = h.request(profile_url, 'GET')[1]
-    data = json.loads(result)
-    login_session['provider'] = 'facebook'
-    login_session['username'] = data['name']
-    login_session['email'] = data['email']
-    login_session['facebook_id'] = data['id']
-    login_session['access_token'] = access_token
+        profile_url += '%s&fields=name,id,email' % token
+        profile = outbound.get(profile_url).json()
 
-    # not sure why, but there's a separate URL for pulling down
-    # the user profile photo; here's where we call that
-    picture_url += '?%s' % token
-    picture_url += '&redirect=0&height=200&width=200'
-    h = httplib2.Http()
-    result = h.request(picture_url, 'GET')[1]
-    data = json.loads(result)
+        # not sure why, but there's a separate URL for pulling down
+        # the user profile photo; here's where we call that
+        picture_url += '?%s' % token
+        picture_url += '&redirect=0&height=200&width=200'
+        picture = outbound.get(picture_url).json()
+    except (RequestException, ValueError):
+        # Facebook is down, slow or answering nonsense; don't wait on it
+        return report_json_error(PROVIDER_UNAVAILABLE, 503)
 
-    login_session['picture'] = data['data']['url']
+    login_session['provider'] = 'facebook'
+    login_session['username'] = profile['name']
+    login_session['email'] = profile['email']
+    login_session['facebook_id'] = profile['id']
+    login_session['access_token'] = access_token
+    login_session['picture'] = picture['data']['url']
 
     user_id = getUserID(login_session['email'])
     if not (user_id):
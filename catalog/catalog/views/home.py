@@ -1,39 +1,64 @@
 import datetime as dt
-import httplib2
-import json
 import os
 import re
 import time
 
 from flask import (
+    Response,
+    abort,
     flash,
     g,
     jsonify,
     redirect,
     render_template,
+    request,
     send_from_directory,
     session as login_session,
+    stream_with_context,
     url_for
 )
-from sqlalchemy import or_
+from requests import RequestException
+from sqlalchemy.exc import IntegrityError
 from urllib import urlencode
 
-from . import home
-from .. import app, db
+from . import _users, home
+from .. import api_cache, app, db, outbound
 from ..models import (
     Book,
     Category,
     BookBorrower,
     BookRating,
     book_favorite,
+    mark_catalog_written,
     User
 )
+from ..feeds import serve_materialized
 from ..forms import BookForm, SearchForm, ReviewForm
+from ..search import search_books
+from ..serializers import book_rows, parse_fields, serialize_books
+from ..suggest import get_index as get_suggestions
 from ..utils import (
+    PAGED_FILTERS,
+    SINCE_FILTERS,
+    _category_counts,
     book_exists,
+    book_list_query,
+    changed_since,
+    conditional,
+    favorite_book_ids,
     filter_books,
+    filtered_books,
+    invalidate_category_counts,
+    iter_books,
     login_required,
+    next_page_url,
+    paginate_changes,
+    report_json_error,
     save_uploaded_image,
+    since_horizon,
+    stream_books_csv,
+    stream_books_json,
+    stream_books_ndjson,
     xmlify,
     atomify,
     rssify
@@ -52,6 +77,20 @@ def aboutCatalog():
     return render_template('about.html')
 
 
+@home.route('/cache/stats/')
+def cacheStats():
+    """Report the size and hit and miss counts of this process's caches
+    as JSON, if SHOW_CACHE_STATS is on.
+    """
+    if not (app.config['SHOW_CACHE_STATS']):
+        abort(404)
+    return jsonify(
+        api=api_cache.responses.stats(),
+        users=_users.stats(),
+        category_counts=_category_counts.stats()
+    )
+
+
 @home.route('/books/', defaults={'bookfilter': None, 'thisCategory': None})
 @home.route('/books/<bookfilter>/', defaults={'thisCategory': None})
 @home.route(
@@ -61,20 +100,31 @@ def showBooks(bookfilter, thisCategory):
     of books. This single view handles a number of different use cases,
     including books tagged as Favorite by users, books lent or
     borrowed by users, as well as books by category/genre. Hence all
-    the routes.
+    the routes. Long lists are split into pages; see `filter_books`.
     """
-    categories = Category.query.outerjoin(Category.books)
+    categories = Category.query
     fType = ''
     books2 = None
     header2 = ''
-
-    books = filter_books(bookfilter, thisCategory)
+    next_url = None
+
+    try:
+        books, next_cursor = filter_books(
+            bookfilter,
+            thisCategory,
+            after=request.args.get('after'),
+            limit=app.config['BOOKS_PAGE_SIZE']
+        )
+    except ValueError:
+        abort(400)
+    if (next_cursor):
+        next_url = next_page_url(next_cursor)
 
     if (bookfilter == 'mybooks'):
         # show books that are either lent or borrowed by the user
         # note that this option is not available if the user is
         # not authenticated
-        books2 = Book.query.filter(Book.borrower.any(
+        books2 = book_list_query().filter(Book.borrower.any(
             BookBorrower.borrower == g.user)).all()
         header = 'Books You\'ve Lent'
         header2 = 'Books You\'ve Borrowed'
@@ -102,26 +152,25 @@ def showBooks(bookfilter, thisCategory):
         categories=categories,
         this_category=thisCategory,
         header=header,
-        header2=header2
+        header2=header2,
+        next_url=next_url
     )
 
 
 @home.route('/books/search/', methods=['GET', 'POST'])
 def searchBooks():
     """View for searching books. Users can search by title, author
-    or synopsis.
+    or synopsis. Results are ranked, best matches first (see
+    `search.search_books`).
     """
     form = SearchForm()
-    categories = Category.query.outerjoin(Category.books)
+    categories = Category.query
     books = None
 
     if (form.validate_on_submit()):
         searchterm = form.searchterm.data
-        books = Book.query.filter(or_(
-            Book.title.ilike('%' + searchterm + '%'),
-            Book.author.ilike('%' + searchterm + '%'),
-            Book.synopsis.ilike('%' + searchterm + '%')
-        )).all()
+        books = search_books(book_list_query(), searchterm).limit(
+            app.config['SEARCH_RESULTS_LIMIT']).all()
 
     return render_template(
         'search.html',
@@ -166,9 +215,13 @@ def addBook():
                 'https://www.googleapis.com/books/v1/volumes?%s'
                 % urlencode(query_dict)
             )
-            h = httplib2.Http()
-            resp = h.request(url, 'GET')[1]
-            result = json.loads(resp)
+            try:
+                result = outbound.get(url).json()
+            except (RequestException, ValueError):
+                # the API is down or slow (or its circuit breaker is
+                # open; see outbound.py); save the book as entered
+                app.logger.warning('Google Books lookup failed.')
+                result = {}
             if ('items' in result and len(result['items']) > 0):
                 g_book = result['items'][0]['volumeInfo']
                 if (picture == ''):
@@ -212,6 +265,7 @@ def addBook():
 
         db.session.add(new_book)
         db.session.commit()
+        invalidate_category_counts()
 
         flash(
             'Thanks for lending your copy of <em>' + new_book.title + '</em>!')
@@ -251,6 +305,7 @@ def editBook(book_id, **kwargs):
         else:
             book.picture = book_pic
         db.session.commit()
+        invalidate_category_counts()
 
         flash('<em>' + book.title + '</em> saved.')
         return redirect(url_for('home.showBooks'))
@@ -266,15 +321,47 @@ def editBook(book_id, **kwargs):
 
 
 @home.route('/books/<int:book_id>/info/', methods=['GET', 'POST'])
+@conditional
 @book_exists
 def bookInfo(book_id, **kwargs):
     """Return a JSON object containing a specific book's data. Used
     to display a book's info in a modal window from the book list
-    page. This function should only be called through AJAX.
+    page. This function should only be called through AJAX. `fields`
+    picks which of the book's fields to return, as for `booksAPI`.
     """
     book = kwargs['book']
 
-    return jsonify(Book=book.serialize)
+    try:
+        fields = parse_fields(request.args.get('fields'))
+    except ValueError:
+        return report_json_error('Invalid fields.', 400)
+    books = list(serialize_books(book_rows([book.id], fields), fields))
+
+    return jsonify(Book=books[0])
+
+
+@home.route('/books/info/')
+@conditional
+def booksInfo():
+    """Return a JSON list of the data of several books at once, given
+    their IDs, comma-separated, in `ids`. Book list pages fetch the info
+    of every book they show with this, in one request, rather than call
+    `bookInfo` each time a book's modal window is opened. IDs of books
+    that don't exist are left out.
+    """
+    try:
+        ids = set(
+            int(book_id) for book_id in request.args.get('ids', '').split(',')
+            if book_id)
+    except ValueError:
+        return report_json_error('Invalid ids.', 400)
+    if (len(ids) > app.config['API_MAX_PAGE_SIZE']):
+        return report_json_error('Too many ids.', 400)
+
+    books = []
+    if (ids):
+        books = list(serialize_books(book_rows(ids=list(ids))))
+    return jsonify(Books=books)
 
 
 @home.route('/books/<int:book_id>/borrow/')
@@ -287,12 +374,25 @@ def borrowBook(book_id, **kwargs):
     """
     book = kwargs['book']
 
+    if (book.current_loan is not None):
+        # somebody beat the user to it
+        flash('Sorry, <em>' + book.title + '</em> is not available.')
+        return redirect(url_for('home.showBooks'))
+
     today = dt.datetime.today()
     due_date = today + dt.timedelta(days=30)  # 30 days...tick tock...
     due_date_str = due_date.strftime('%m/%d/%Y')
     bb = BookBorrower(book_id=book.id, user_id=g.user.id, due_date=due_date)
     db.session.add(bb)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # the open loan index allows only one loan per book, so a
+        # concurrent borrower who committed first wins
+        db.session.rollback()
+        flash('Sorry, <em>' + book.title + '</em> is not available.')
+        return redirect(url_for('home.showBooks'))
+
     msg = 'You have borrowed <em>' + book.title + '</em>. It is due back by '
     msg += due_date_str + '.'  # provide the due date to the user
     flash(msg)
@@ -305,14 +405,15 @@ def borrowBook(book_id, **kwargs):
 def returnBook(book_id, **kwargs):
     """Provide ability to return a borrowed book."""
     book = kwargs['book']
-    bb = BookBorrower.query.filter_by(
-        book_id=book_id, user_id=g.user.id, returned=False).one()
+    bb = book.current_loan
 
-    if not (bb.returned):
-        # assuming book has not already been returned...
-        bb.returned = True
-        db.session.add(bb)
-        db.session.commit()
+    if (bb is None or bb.user_id != g.user.id):
+        # the book isn't checked out, or not by this user
+        return redirect(url_for('home.showBooks'))
+
+    bb.returned = True
+    db.session.add(bb)
+    db.session.commit()
 
     flash('<em>' + book.title + '</em> returned successfully.')
     return redirect(url_for('home.showBooks'))
@@ -358,9 +459,16 @@ def favoriteBook(book_id, **kwargs):
     """
     book = kwargs['book']
 
-    db.session.execute(
-        book_favorite.insert().values([book.id, g.user.id, ]))
-    db.session.commit()
+    if (book.id not in favorite_book_ids()):
+        try:
+            db.session.execute(
+                book_favorite.insert().values([book.id, g.user.id, ]))
+            mark_catalog_written(db.session)
+            db.session.commit()
+        except IntegrityError:
+            # the favorites index allows each favorite once, so a
+            # concurrent request for the same one got there first
+            db.session.rollback()
 
     return redirect(url_for('home.showBooks'))
 
@@ -378,11 +486,12 @@ def deleteBook(book_id, **kwargs):
     form = BookForm(obj=book)
 
     if (form.validate_on_submit()):
-        if (book.lender == g.user):
+        if (book.lender_id == g.user.id):
             # the user must also be the lender
             # no sneaking off deleting other user's books
             db.session.delete(book)
             db.session.commit()
+            invalidate_category_counts()
 
             flash('<em>' + book.title + '</em> removed.')
 
@@ -412,22 +521,194 @@ def deleteBook(book_id, **kwargs):
     '/books/API/category/<thisCategory>/<apiFormat>/',
     defaults={'bookfilter': 'category'}
 )
+@serve_materialized
+@conditional
 def booksAPI(bookfilter, thisCategory, apiFormat):
     """Provide an API for, you know, lots of...um...API uses.
     In our case, the API provides a list of books, according to a
     variety of filter criteria. The output can be in JSON, Atom,
-    raw XML or RSS format.
+    raw XML, RSS, NDJSON or CSV format.
+
+    Lists are returned a page at a time: `limit` sets the page size
+    and `after` takes the cursor of the page to continue from. When
+    there's another page, its cursor is included in the output (see
+    `xmlify` and `atomify`) and its URL in a `Link` header.
+
+    With `since` (a timestamp or the cursor the last request gave),
+    only the books added or modified after it are returned, in the order
+    they changed in, a page at a time, along with the cursor to pass as
+    `since` next time (see `changed_since`), in the output and in an
+    `X-Since` header. Clients keeping a copy of a list in sync can ask
+    for just the changes; those of the last API_SINCE_LAG seconds can
+    come twice (see `paginate_changes`). Deleted books aren't reported.
+    The recent and favorites lists ignore `since`.
+
+    `fields` picks which fields of each book to return, comma-separated
+    (see `serializers.FIELDS`); the rest aren't even queried. Feeds
+    always have them all.
+
+    With `stream=1`, lists aren't paged: the whole list (from `after`,
+    or of the changes since `since`, with the next cursor only in the
+    `X-Since` header) is streamed out as it's read (see `iter_books`).
+    The NDJSON (one JSON book per line) and CSV formats, meant for
+    piping into other tools, are always streamed.
+
+    Responses carry an ETag and Last-Modified date, and conditional
+    requests are answered with a 304 when nothing's changed (see
+    `conditional`). Feeds can also be served from files kept up to
+    date in the background (see `feeds`).
     """
-    books = filter_books(bookfilter, thisCategory)
+    # feeds are dated by the last change to the catalog
+    updated = g.catalog_version[1]
+
+    # the recent books list is just the latest 8 anyway, and the
+    # favorites list changes without its books changing
+    since = request.args.get('since')
+    if (bookfilter not in SINCE_FILTERS):
+        since = None
+    # only the fields asked for are queried and returned; feed entries
+    # need all of them
+    try:
+        fields = parse_fields(request.args.get('fields'))
+    except ValueError:
+        return report_json_error('Invalid fields.', 400)
+    if (apiFormat in ('Atom', 'RSS')):
+        fields = None
+
+    if (request.args.get('stream') or apiFormat in ('NDJSON', 'CSV')):
+        try:
+            query = filtered_books(
+                bookfilter,
+                thisCategory,
+                request.args.get('after'),
+                query=book_rows(fields=fields)
+            )
+            if (since is not None):
+                query = changed_since(query, since)
+        except ValueError:
+            return report_json_error('Invalid cursor.', 400)
+        # taken before the changes are read, so none made while they
+        # stream are skipped next time
+        next_since = since_horizon() if since is not None else None
+        if (apiFormat == 'XML'):
+            resp = xmlify('book', iter_books(query, fields), stream=True)
+        elif (apiFormat == 'Atom'):
+            resp = atomify(iter_books(query), updated=updated, stream=True)
+        elif (apiFormat == 'RSS'):
+            resp = rssify(iter_books(query), updated=updated, stream=True)
+        elif (apiFormat == 'NDJSON'):
+            resp = Response(
+                stream_with_context(stream_books_ndjson(query, fields)),
+                mimetype='application/x-ndjson'
+            )
+        elif (apiFormat == 'CSV'):
+            resp = Response(
+                stream_with_context(stream_books_csv(query, fields)),
+                mimetype='text/csv'
+            )
+        else:
+            resp = Response(
+                stream_with_context(stream_books_json(query, fields)),
+                mimetype='application/json'
+            )
+        if (next_since is not None):
+            # the output's already on its way; the cursor can only go
+            # in a header
+            resp.headers['X-Since'] = next_since
+        return resp
+
+    # whole responses are cached; see `api_cache`
+    key = api_cache.cache_key(bookfilter, thisCategory, apiFormat)
+    resp = api_cache.get_response(key)
+    if (resp is not None):
+        return resp
+
+    limit = min(
+        request.args.get('limit', app.config['API_PAGE_SIZE'], type=int),
+        app.config['API_MAX_PAGE_SIZE']
+    )
+    if (limit < 1):
+        return report_json_error('Invalid limit.', 400)
+    try:
+        if (since is not None):
+            query = changed_since(
+                filtered_books(
+                    bookfilter, thisCategory, query=book_rows(fields=fields)),
+                since
+            )
+            rows, since, more = paginate_changes(query, since, limit)
+            next_cursor = None
+            next_url = next_page_url(since, 'since') if more else None
+        else:
+            rows, next_cursor = filter_books(
+                bookfilter,
+                thisCategory,
+                after=request.args.get('after'),
+                limit=limit,
+                query=book_rows(fields=fields)
+            )
+            next_url = next_page_url(next_cursor) if next_cursor else None
+    except ValueError:
+        return report_json_error('Invalid cursor.', 400)
+    books = list(serialize_books(rows, fields))
 
     if (apiFormat == 'XML'):
-        return xmlify('book', [b.serialize for b in books])
+        resp = xmlify('book', books, next_cursor, since=since)
     elif (apiFormat == 'Atom'):
-        return atomify([b.serialize for b in books])
+        resp = atomify(books, next_url, updated)
     elif (apiFormat == 'RSS'):
-        return rssify([b.serialize for b in books])
+        resp = rssify(books, updated)
+    elif (since is not None):
+        resp = jsonify(Books=books, since=since)
+    elif (next_cursor):
+        resp = jsonify(Books=books, next=next_cursor)
     else:
-        return jsonify(Books=[b.serialize for b in books])
+        resp = jsonify(Books=books)
+
+    if (next_url):
+        resp.headers['Link'] = '<%s>; rel="next"' % next_url
+    if (since is not None):
+        # feeds have nowhere else to put it
+        resp.headers['X-Since'] = since
+    return api_cache.set_response(key, resp)
+
+
+@home.route('/books/API/search/')
+def searchAPI():
+    """Search books from scripts: returns the ID, title and author of
+    the books matching the `q` parameter, best matches first (see
+    `search.search_books`).
+    """
+    searchterm = request.args.get('q', '')
+    books = search_books(
+        db.session.query(Book.id, Book.title, Book.author),
+        searchterm
+    ).limit(app.config['SEARCH_RESULTS_LIMIT']).all()
+    return jsonify(
+        query=searchterm,
+        Books=[
+            {'id': b.id, 'title': b.title, 'author': b.author} for b in books
+        ]
+    )
+
+
+@home.route('/books/suggest/')
+def suggestBooks():
+    """Suggest titles and authors for the search box as the user
+    types, from the in-memory prefix index in `suggest` (no database
+    queries). The same prefix always gets the same answer until a book
+    changes, so browsers may cache responses for SUGGEST_MAX_AGE
+    seconds.
+    """
+    suggestions = get_suggestions().suggest(
+        request.args.get('q', ''), app.config['SUGGEST_LIMIT'])
+    resp = jsonify(suggestions=[
+        {'type': kind, 'value': value, 'id': book_id}
+        for kind, value, book_id in suggestions
+    ])
+    resp.cache_control.public = True
+    resp.cache_control.max_age = app.config['SUGGEST_MAX_AGE']
+    return resp
 
 
 @home.route('/media/<path:filename>')
@@ -1,3 +1,5 @@
+import time
+
 from flask import make_response, redirect, request, url_for, jsonify
 from functools import wraps
 from oauth2client._helpers import _urlsafe_b64encode
@@ -144,3 +146,46 @@ def fbGetPicture():
         }
     }
     return jsonify(userinfo_response)
+
+
+@test.route('/test/books/v1/volumes')
+@check_testing
+def booksVolumes():
+    """This view simulates a Google Books API response to a search
+    for a book by title and author. Returns a JSON response with a
+    single matching volume.
+    """
+    volumes_response = {
+        'items': [{
+            'volumeInfo': {
+                'title': 'War and Peace',
+                'description': 'A long Russian novel.',
+                'publishedDate': '1869',
+                'imageLinks': {
+                    'thumbnail': 'http://books.google.com/war.png&edge=curl'
+                }
+            }
+        }]
+    }
+    return jsonify(volumes_response)
+
+
+@test.route('/test/slow/')
+@check_testing
+def slow():
+    """This view simulates an API that's taking too long to answer.
+    Returns a plain response after two seconds.
+    """
+    time.sleep(2)
+    return make_response('Finally.', 200)
+
+
+@test.route('/test/cookies/')
+@check_testing
+def cookies():
+    """This view simulates a provider that sets a cookie. Returns the
+    cookies the request came with, as JSON, and sets another one.
+    """
+    resp = jsonify(cookies=request.cookies)
+    resp.set_cookie('provider_session', 'somebody-else')
+    return resp
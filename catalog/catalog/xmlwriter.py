@@ -0,0 +1,74 @@
+class XMLWriter(object):
+    """Writes an XML document a piece at a time, as UTF-8 encoded
+    strings, so that a feed can be sent (or saved) as it's serialized
+    rather than built up as a tree of DOM nodes first.
+
+    The layout is exactly that of xml.dom.minidom's
+    `toprettyxml(indent='    ', encoding='utf-8')`, which the feeds were
+    made with before, so their bytes don't change: sorted attributes,
+    text-only elements on one line and elements without children
+    closed with '/>'. Each method returns the next piece of the
+    document; joined up in order, they make the whole of it.
+    """
+
+    def __init__(self, indent='    '):
+        self.indent = indent
+        self.stack = []
+        # a start tag isn't written until the element turns out to have
+        # children, since childless elements are written as '<tag/>'
+        self.pending = None
+
+    def declaration(self):
+        return '<?xml version="1.0" encoding="utf-8"?>\n'
+
+    def start(self, tag, attrs=None):
+        """Open an element, to be closed with `end`."""
+        out = self._flush()
+        self.pending = self._tag(tag, attrs)
+        self.stack.append(tag)
+        return out
+
+    def end(self):
+        """Close the element opened last."""
+        tag = self.stack.pop()
+        if (self.pending is not None):
+            out = self.pending + '/>\n'
+            self.pending = None
+            return out
+        return self._prefix() + '</%s>\n' % tag
+
+    def element(self, tag, text=None, attrs=None):
+        """Write a whole element: one holding just `text`, or an empty
+        one if `text` is None.
+        """
+        out = self._flush()
+        if (text is None):
+            return out + self._tag(tag, attrs) + '/>\n'
+        return out + '%s>%s</%s>\n' % (
+            self._tag(tag, attrs), escape(text), tag)
+
+    def _prefix(self):
+        return self.indent * len(self.stack)
+
+    def _tag(self, tag, attrs):
+        out = self._prefix() + '<' + tag
+        for name in sorted(attrs or ()):
+            out += ' %s="%s"' % (name, escape(attrs[name]))
+        return out
+
+    def _flush(self):
+        out = ''
+        if (self.pending is not None):
+            out = self.pending + '>\n'
+            self.pending = None
+        return out
+
+
+def escape(data):
+    """Escape text or an attribute value the way minidom does, and
+    encode it as UTF-8.
+    """
+    if (isinstance(data, str)):
+        data = data.decode('utf-8')
+    return data.replace(u'&', u'&amp;').replace(u'<', u'&lt;').replace(
+        u'"', u'&quot;').replace(u'>', u'&gt;').encode('utf-8')
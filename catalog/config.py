@@ -4,3 +4,101 @@ MEDIA_FOLDER = 'media'
 
 # only allow files of 32 MB or less to be uploaded
 MAX_CONTENT_LENGTH = 32 * 1024 * 1024
+
+# the client secrets file for Google sign-in, from the Google API
+# console; it's read again when it changes, which is checked for every
+# CONFIG_CHECK_INTERVAL seconds (see signin.py)
+GOOGLE_CLIENT_SECRETS = 'instance/client_secrets.json'
+CONFIG_CHECK_INTERVAL = 10
+
+# number of seconds the per-category book counts shown in the sidebar
+# are cached for; adding, editing or deleting a book refreshes them
+CATEGORY_COUNT_TTL = 300
+
+# book lists are paged; number of books per page in the book list views,
+# and in the API when the client doesn't ask for a `limit` (clients can't
+# ask for more than API_MAX_PAGE_SIZE)
+BOOKS_PAGE_SIZE = 48
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+
+# the signed-in users are looked up by ID and cached, up to
+# USER_CACHE_SIZE of them, each for USER_CACHE_TTL seconds
+USER_CACHE_SIZE = 1024
+USER_CACHE_TTL = 300
+
+# the cursor a `since` request returns for its last page is never later
+# than API_SINCE_LAG seconds ago, so changes still being committed then
+# aren't skipped (they may be returned twice instead)
+API_SINCE_LAG = 60
+
+# the API caches up to API_CACHE_SIZE responses, each for at most
+# API_CACHE_TTL seconds (0 turns the cache off). Any write to the
+# catalog makes the cached responses out of date straight away, in
+# every process (see api_cache.py)
+API_CACHE_SIZE = 256
+API_CACHE_TTL = 60
+
+# set to True to have /cache/stats/ report how well each process's
+# in-memory caches are doing (entries, hits and misses), as JSON
+SHOW_CACHE_STATS = False
+
+# number of books read from the database at a time when the API streams
+# a whole list (`stream=1`)
+API_STREAM_BATCH_SIZE = 500
+
+# responses are compressed (gzip or deflate, whichever the client
+# accepts) at COMPRESS_LEVEL, from 1 (fastest) to 9 (smallest); 0 turns
+# compression off. Responses shorter than COMPRESS_MIN_SIZE bytes
+# aren't worth it and are sent as they are
+COMPRESS_LEVEL = 6
+COMPRESS_MIN_SIZE = 500
+
+# set FEED_DIR to a directory to keep the Atom and RSS feeds of the
+# all, recent and category book lists in it as files, rebuilt in the
+# background whenever books or loans change, and serve feed readers
+# those (see feeds.py). FEED_BASE_URL is the address of the site the
+# feeds' links are written with (e.g. 'http://books.example.com/'); the
+# files are only served to requests made to it
+FEED_DIR = None
+FEED_BASE_URL = None
+
+# calls to other services (sign-in, the Google Books API) share pooled,
+# keep-alive connections (see outbound.py): up to HTTP_POOL_SIZE are
+# kept open to each host, for up to HTTP_POOL_HOSTS hosts. Set
+# HTTP_STUB_URL (e.g. 'http://localhost:5000/test/') to send all of them
+# to a stub server instead, as the tests do
+HTTP_POOL_HOSTS = 10
+HTTP_POOL_SIZE = 10
+HTTP_STUB_URL = None
+
+# seconds an outbound call may take to connect, and to wait for data,
+# before it's given up on. After HTTP_BREAKER_THRESHOLD failed calls in a
+# row to an endpoint, calls to it fail at once for HTTP_BREAKER_RESET
+# seconds (then one is tried again); adding a book then skips the
+# Google Books lookup, and sign-in reports the provider unavailable
+HTTP_CONNECT_TIMEOUT = 3.05
+HTTP_READ_TIMEOUT = 5
+HTTP_BREAKER_THRESHOLD = 5
+HTTP_BREAKER_RESET = 30
+
+# maximum number of (best matching) books a search returns
+SEARCH_RESULTS_LIMIT = 100
+
+# 'database' searches with the database's full-text search (see
+# search.py); 'memory' keeps an inverted index of the books in each
+# process instead (see search_index.py), optionally saved to and loaded
+# from SEARCH_INDEX_SNAPSHOT so restarts don't have to rebuild it
+SEARCH_BACKEND = 'database'
+SEARCH_INDEX_SNAPSHOT = None
+
+# number of suggestions the search box offers as the user types, and
+# how many seconds browsers may cache them for
+SUGGEST_LIMIT = 10
+SUGGEST_MAX_AGE = 60
+
+# the suggestions come from a list of titles and authors each process
+# keeps (see suggest.py); it follows the process's own edits as they're
+# made, and is rebuilt every SUGGEST_INDEX_TTL seconds to pick up the
+# other processes'
+SUGGEST_INDEX_TTL = 300
@@ -1,22 +1,50 @@
+import csv
 import datetime as dt
+import json
+import os
 import re
+import shutil
+import sys
+import tempfile
+import time
 import unittest
 import urllib
 import urlparse
+import zlib
 import xml.etree.ElementTree as ET
 
+from xml.dom.minidom import Document as xmldoc
+
 from flask.ext.testing import TestCase
 
-from catalog import app, db
-from catalog.models import Book, User, Category, BookBorrower, BookRating
+from catalog import api_cache, app, db, feeds, outbound, views
+from catalog.search_index import BookIndex, database_signature, reset_index
+from catalog import suggest
+from catalog.serializers import book_rows, serialize_books
+from catalog.signin import ConfigSnapshot
+from catalog.utils import invalidate_category_counts
+from catalog.xmlwriter import XMLWriter
+from catalog.models import (
+    Book,
+    User,
+    Category,
+    BookBorrower,
+    BookRating,
+    book_favorite,
+    catalog_version,
+    invalid_indexes
+)
 from catalog.forms import SearchForm, BookForm, ReviewForm
 from test_utils import (
+    count_queries,
     delete_test_file,
     get_google_client_id,
     save_google_secrets_test_files
 )
 
+from sqlalchemy.dialects import mssql, mysql, oracle, postgresql, sqlite
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.schema import CreateIndex
 from StringIO import StringIO
 
 
@@ -157,6 +185,8 @@ class CatalogTestCase(TestCase):
         app.config['PRESERVE_CONTEXT_ON_EXCEPTION'] = False
         app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
         app.config['WTF_CSRF_ENABLED'] = False
+        api_cache.responses.clear()
+        views._users.clear()
         with app.app_context():
             db.drop_all()
             db.create_all()
@@ -240,6 +270,43 @@ class CatalogTestCase(TestCase):
         self.assertEqual(availability[2]['name'], 'admin')
         self.assertEqual(availability[2]['email'], 'admin@catalog.com')
 
+    def test_serialize_books(self):
+        """Test `serialize_books`, which serializes books in bulk from a
+        single query. Its output should match `Book.serialize`, loans
+        and uploaded pictures included.
+        """
+        user = User.query.filter_by(email='admin@catalog.com').one()
+        book = Book.query.filter_by(title='Rarnaby Budge').one()
+        book.picture = 'cover art.jpg'
+        db.session.add(BookBorrower(
+            user_id=user.id,
+            book_id=book.id,
+            due_date=dt.date.today() + dt.timedelta(days=30)
+        ))
+        # a returned loan shouldn't count
+        db.session.add(BookBorrower(
+            user_id=user.id,
+            book_id=book.id,
+            due_date=dt.date.today(),
+            returned=True
+        ))
+        db.session.commit()
+
+        with app.test_request_context('/'):
+            expected = [
+                b.serialize for b in Book.query.order_by(Book.title, Book.id)
+            ]
+            with count_queries() as queries:
+                actual = list(serialize_books(
+                    book_rows().order_by(Book.title, Book.id)))
+            self.assertEqual(actual, expected)
+            self.assertEqual(len(queries), 1)
+
+            self.assertEqual(
+                list(serialize_books(book_rows(ids=[book.id]))),
+                [book.serialize]
+            )
+
     def test_book_calc_rating(self):
         """Test the Book model's `calc_rating()` function. It should
         return a float rounded to 2 decimal points.
@@ -278,6 +345,70 @@ class CatalogTestCase(TestCase):
         # (3.2+2.1)/2 = 5.3/2 = 2.65
         self.assertEqual(book.calc_rating(), 2.65)
 
+    def test_book_rating_aggregates(self):
+        """Test that the Book model's `rating_count` and `rating_sum`
+        aggregates follow BookRating inserts, updates and deletes, and
+        that the `rebuild-ratings` command recomputes them from scratch.
+        """
+        book = Book.query.filter_by(title='Rarnaby Budge').one()
+        user = User.query.filter_by(email='admin@catalog.com').one()
+
+        br = BookRating(
+            user_id=user.id, book_id=book.id, rating=4, review='Swell.')
+        db.session.add(br)
+        db.session.commit()
+        self.assertEqual(book.rating_count, 1)
+        self.assertEqual(float(book.rating_sum), 4)
+
+        br.rating = 2
+        db.session.commit()
+        self.assertEqual(book.rating_count, 1)
+        self.assertEqual(float(book.rating_sum), 2)
+
+        db.session.delete(br)
+        db.session.commit()
+        self.assertEqual(book.rating_count, 0)
+        self.assertEqual(float(book.rating_sum), 0)
+
+        # knock the aggregates out of whack, then rebuild them
+        db.session.add(BookRating(
+            user_id=user.id, book_id=book.id, rating=3, review='Fine.'))
+        db.session.commit()
+        book.rating_count = 42
+        db.session.commit()
+
+        result = app.test_cli_runner().invoke(args=['rebuild-ratings'])
+        self.assertIn('Rating aggregates rebuilt.', result.output)
+        book = Book.query.filter_by(title='Rarnaby Budge').one()
+        self.assertEqual(book.rating_count, 1)
+        self.assertEqual(book.calc_rating(), 3)
+
+    def test_create_indexes(self):
+        """Test the `create-indexes` command. It should leave a complete
+        database alone, and create whatever indexes are missing (or, on
+        PostgreSQL, invalid).
+        """
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['create-indexes'])
+        self.assertIn('All indexes present.', result.output)
+
+        db.session.execute('DROP INDEX ix_book_borrower_open_loan')
+        db.session.execute('DROP INDEX ux_book_favorite_book_user')
+        db.session.commit()
+
+        result = runner.invoke(args=['create-indexes'])
+        self.assertIn(
+            'Created index ix_book_borrower_open_loan.', result.output)
+        self.assertIn(
+            'Created index ux_book_favorite_book_user.', result.output)
+
+        indexes = db.inspect(db.engine).get_indexes('book_borrower')
+        self.assertIn(
+            'ix_book_borrower_open_loan', [i['name'] for i in indexes])
+
+        # only PostgreSQL leaves invalid indexes to rebuild
+        self.assertEqual(invalid_indexes(db.engine), set())
+
     """""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
      TEST HOME VIEWS
     """""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
@@ -322,7 +453,7 @@ class CatalogTestCase(TestCase):
         # no filter
         self.assertEqual(f_type, '')
 
-        # one for each book-category combo; 2 total
+        # one for each category; 2 total
         self.assertEqual(cats.count(), 2)
 
         # category name should match
@@ -370,7 +501,7 @@ class CatalogTestCase(TestCase):
         # category filter
         self.assertEqual(f_type, 'category')
 
-        # one for each book-category combo
+        # one for each category
         self.assertEqual(cats.count(), 2)
 
         # check the selected category name
@@ -460,6 +591,151 @@ class CatalogTestCase(TestCase):
         # no secondary header
         self.assertEqual(header2, '')
 
+    def test_home_show_books_query_count(self):
+        """Test that the `home.showBooks` view uses a fixed number of
+        queries no matter how many books are listed, i.e.: lenders,
+        ratings and borrowers are loaded in batches rather than once
+        per book.
+        """
+        user = User.query.filter_by(email='admin@catalog.com').one()
+
+        with self.client.session_transaction() as session:
+            # fake the login by adding a session variable
+            session['email'] = 'admin@catalog.com'
+
+        # the first request looks the user up (and caches them); count
+        # the queries of a later one
+        self.client.get('/books/all/')
+        with count_queries() as statements:
+            self.client.get('/books/all/')
+        base_count = len(statements)
+
+        for i in range(10):
+            book = Book(
+                title='Rarnaby Budge, Volume %d' % i,
+                author='Charles Dikkens',
+                lender=user,
+                picture=''
+            )
+            db.session.add(book)
+            db.session.flush()
+            db.session.add(BookRating(
+                book_id=book.id, user_id=user.id, rating=3.0, review='Meh.'))
+            db.session.add(BookBorrower(
+                book_id=book.id, user_id=user.id, due_date=dt.date.today()))
+        db.session.commit()
+
+        with count_queries() as statements:
+            response = self.client.get('/books/all/')
+        self.assert200(response)
+
+        # 12 books now, but the query count shouldn't budge
+        self.assertEqual(len(self.get_context_variable('books')), 12)
+        self.assertEqual(len(statements), base_count)
+
+    def test_pre_request_user(self):
+        """Test how requests find the signed-in user. The user should
+        be looked up by the ID in the session, only when needed, and
+        cached between requests; requests for files should never touch
+        the database.
+        """
+        user = User.query.filter_by(email='admin@catalog.com').one()
+        with self.client.session_transaction() as session:
+            session['email'] = 'admin@catalog.com'
+            session['user_id'] = user.id
+
+        misses = views._users.misses
+        response = self.client.get('/books/API/mybooks/?fields=id')
+        self.assertEqual(len(response.json['Books']), 2)
+        self.assertEqual(views._users.misses, misses + 1)
+
+        # the user is cached now
+        db.session.expunge_all()
+        with count_queries() as statements:
+            self.client.get('/books/mybooks/')
+        self.assertEqual([q for q in statements if 'FROM user' in q], [])
+        self.assertEqual(views._users.misses, misses + 1)
+
+        # and not even needed for pages that don't depend on them
+        views._users.clear()
+        with count_queries() as statements:
+            self.client.get('/about/')
+        self.assertEqual(statements, [])
+
+        with count_queries() as statements:
+            self.client.get('/static/app.css')
+            self.client.get('/media/nothing.jpg')
+        self.assertEqual(statements, [])
+
+        # sessions without the user's ID find the user by email
+        with self.client.session_transaction() as session:
+            del session['user_id']
+        response = self.client.get('/books/API/mybooks/?fields=id')
+        self.assertEqual(len(response.json['Books']), 2)
+        with self.client.session_transaction() as session:
+            self.assertEqual(session['user_id'], user.id)
+
+        # changing the user drops their cached row
+        user = User.query.get(user.id)
+        self.assertEqual(views.load_user(user.id).name, user.name)
+        user.name = 'Administrator'
+        db.session.commit()
+        self.assertIsNone(views._users.get(user.id))
+        self.assertEqual(views.load_user(user.id).name, 'Administrator')
+
+        # the cached user can be linked to objects once merged
+        book = Book.query.first()
+        book.favorite.append(
+            db.session.merge(views.load_user(user.id), load=False))
+        db.session.commit()
+        self.assertIn(user, book.favorite)
+
+    def test_home_books_api_anonymous_lists(self):
+        """Test that the API's per-user lists are empty, not an error,
+        when nobody's signed in.
+        """
+        for bookfilter in ('mybooks', 'favorites'):
+            response = self.client.get('/books/API/%s/' % bookfilter)
+            self.assert200(response)
+            self.assertEqual(response.json['Books'], [])
+
+    def test_home_show_books_category_counts(self):
+        """Test the per-category book counts in the sidebar. They should
+        be counted once, cached for later pages and refreshed when a book
+        is added.
+        """
+        invalidate_category_counts()
+        category = Category.query.filter_by(name='Silly Books').one()
+
+        with count_queries() as statements:
+            response = self.client.get('/books/')
+        self.assertIn('Silly Books&nbsp;(1)', response.data)
+        self.assertIn('Serious Books&nbsp;(1)', response.data)
+        self.assertEqual(
+            len([q for q in statements if 'FROM book_category' in q]), 1)
+
+        # the next page is served from the cache
+        with count_queries() as statements:
+            self.client.get('/books/search/')
+        self.assertEqual(
+            len([q for q in statements if 'FROM book_category' in q]), 0)
+
+        with self.client.session_transaction() as session:
+            # fake the login by adding session variables
+            session['username'] = 'admin'
+            session['email'] = 'admin@catalog.com'
+
+        response = self.client.post(
+            '/books/add/',
+            data={
+                'title': 'Grate Expectations',
+                'author': 'Edmund Wells',
+                'category': [category.id, ]
+            },
+            follow_redirects=True
+        )
+        self.assertIn('Silly Books&nbsp;(2)', response.data)
+
     def test_home_search_books_get(self):
         """Test the `home.searchBooks` view in GET mode.
         """
@@ -516,6 +792,165 @@ class CatalogTestCase(TestCase):
         # the book should be the correct one
         self.assertEqual(b_list[0], book)
 
+    def test_home_search_books_ranking(self):
+        """Test the full-text search behind the `home.searchBooks` view.
+        Every word should have to match, title matches should rank
+        above synopsis matches, and the index should follow edits.
+        """
+        user = User.query.filter_by(email='admin@catalog.com').one()
+        book = Book(
+            title='Fight Club',
+            author='Chuck Palahniuk',
+            synopsis='The first rule is: you do not talk about it.',
+            lender=user,
+            picture=''
+        )
+        db.session.add(book)
+        db.session.commit()
+
+        def search(searchterm):
+            self.client.post(
+                '/books/search/', data={'searchterm': searchterm})
+            return [b.title for b in self.get_context_variable('books')]
+
+        # both words must match
+        self.assertEqual(search('rarnaby budge'), ['Rarnaby Budge'])
+        self.assertEqual(search('budge fight'), [])
+
+        # words match as prefixes
+        self.assertEqual(search('dikk'), ['Rarnaby Budge'])
+
+        # title matches beat synopsis matches, however many
+        rarnaby = Book.query.filter_by(title='Rarnaby Budge').one()
+        rarnaby.synopsis = 'A fight! A fight! A fight!'
+        db.session.commit()
+        results = search('fight')
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[-1], 'Rarnaby Budge')
+
+        # deleted books drop out of the index
+        db.session.delete(book)
+        db.session.commit()
+        self.assertNotIn('Fight Club', search('fight'))
+
+    def test_home_search_books_memory_index(self):
+        """Test searching with the in-process index (SEARCH_BACKEND =
+        'memory'): stemming, matching fragments of titles and authors,
+        following commits (but not rollbacks), the JSON search API and
+        saving the index to disk.
+        """
+        app.config['SEARCH_BACKEND'] = 'memory'
+        reset_index()
+        self.addCleanup(app.config.__setitem__, 'SEARCH_BACKEND', 'database')
+        self.addCleanup(reset_index)
+
+        def search(searchterm):
+            response = self.client.get(
+                '/books/API/search/?' + urllib.urlencode({'q': searchterm}))
+            return [b['title'] for b in response.json['Books']]
+
+        self.assertEqual(search('fights'), ['101 Ways to Start a Fight'])
+        self.assertEqual(search('ikke'), ['Rarnaby Budge'])
+        self.assertEqual(search('budge fight'), [])
+
+        user = User.query.filter_by(email='admin@catalog.com').one()
+        book = Book(
+            title='Fight Club',
+            author='Chuck Palahniuk',
+            synopsis='The first rule is: you do not talk about it.',
+            lender=user,
+            picture=''
+        )
+        db.session.add(book)
+        db.session.commit()
+        self.assertEqual(
+            search('fighting'), ['101 Ways to Start a Fight', 'Fight Club'])
+
+        book.title = 'Rule Club'
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(search('rule'), ['Fight Club'])
+
+        self.client.post('/books/search/', data={'searchterm': 'palahniuk'})
+        self.assertEqual(
+            [b.title for b in self.get_context_variable('books')],
+            ['Fight Club']
+        )
+
+        db.session.delete(book)
+        db.session.commit()
+        self.assertEqual(search('club'), [])
+
+        # a saved index loads back only for the database it was built from
+        filepath = 'search_index_test.pickle'
+        self.addCleanup(delete_test_file, filepath)
+        index = BookIndex()
+        index.add(1, 'Rarnaby Budge', 'Charles Dikkens', '')
+        index.save(filepath, [1, 1])
+        self.assertEqual(BookIndex.load(filepath, [1, 1]).search('dikk'), [1])
+        self.assertIsNone(BookIndex.load(filepath, [2, 2]))
+
+        # editing an indexed field makes saved indexes stale
+        signature = database_signature()
+        book = Book.query.filter_by(title='Rarnaby Budge').one()
+        book.synopsis = 'A tale of the riots of 1780.'
+        db.session.commit()
+        self.assertNotEqual(database_signature(), signature)
+
+    def test_home_suggest_books(self):
+        """Test the `home.suggestBooks` view. Titles and authors should
+        be suggested from the start of any of their words, without
+        touching the database, and follow books as they change.
+        """
+        suggest.reset_index()
+        self.addCleanup(suggest.reset_index)
+
+        def suggestions(q):
+            response = self.client.get(
+                '/books/suggest/?' + urllib.urlencode({'q': q}))
+            return [
+                (s['type'], s['value']) for s in response.json['suggestions']
+            ]
+
+        self.assertEqual(suggestions('RARN'), [('title', 'Rarnaby Budge')])
+        with count_queries() as queries:
+            self.assertEqual(
+                suggestions('gent'), [('author', 'An Irish Gentleman')])
+        self.assertEqual(queries, [])
+        self.assertEqual(suggestions('xyz'), [])
+        self.assertEqual(suggestions(' '), [])
+
+        response = self.client.get('/books/suggest/?q=rarn')
+        self.assertIn('max-age', response.headers['Cache-Control'])
+
+        book = Book.query.filter_by(title='Rarnaby Budge').one()
+        book.title = u'R\xe9rnaby Budge'
+        db.session.commit()
+        self.assertEqual(suggestions('rarn'), [])
+        self.assertEqual(
+            suggestions('rern'), [('title', u'R\xe9rnaby Budge')])
+
+        db.session.delete(book)
+        db.session.commit()
+        self.assertEqual(suggestions('budge'), [])
+
+        # changes made by other processes show up once the index is
+        # SUGGEST_INDEX_TTL seconds old
+        table = Book.__table__
+        db.session.execute(table.update().where(
+            table.c.title == '101 Ways to Start a Fight').values(
+                title='101 Ways to End a Fight'))
+        db.session.commit()
+        self.assertEqual(suggestions('end'), [])
+        ttl = app.config['SUGGEST_INDEX_TTL']
+        app.config['SUGGEST_INDEX_TTL'] = 0
+        self.addCleanup(app.config.__setitem__, 'SUGGEST_INDEX_TTL', ttl)
+        self.assertEqual(
+            suggestions('end'), [('title', '101 Ways to End a Fight')])
+
+        result = app.test_cli_runner().invoke(args=['create-search-index'])
+        self.assertIn('Search index created.', result.output)
+
     def test_home_add_book_get(self):
         """Test the `home.addBook` view in GET mode.
         """
@@ -610,6 +1045,143 @@ class CatalogTestCase(TestCase):
         # book should have the right category
         self.assertIn(category, new_book.category)
 
+    def test_home_add_book_google_api(self):
+        """Test that `home.addBook` fills in what the user left blank
+        from the Google Books API, called through the shared HTTP client
+        (pointed at the mock server), as is oauth2client's `outbound.Http`.
+        """
+        url = '/books/add/'
+        category = Category.query.filter_by(name='Serious Books').one()
+
+        with self.client.session_transaction() as session:
+            session['username'] = 'admin'
+            session['email'] = 'admin@catalog.com'
+
+        app.config['USE_GOOGLE_API'] = True
+        app.config['HTTP_STUB_URL'] = 'http://localhost:5000/test/'
+        outbound.reset_client()
+        try:
+            for title in ('War and Peace', 'Anna Karenina'):
+                response = self.client.post(
+                    url,
+                    data={
+                        'title': title,
+                        'author': 'Leo Tolstoy',
+                        'category': [category.id, ]
+                    }
+                )
+                self.assertStatus(response, 302)
+
+            # libraries that want an httplib2.Http (oauth2client's token
+            # exchange) get one that calls through the client too
+            resp, content = outbound.Http().request(
+                'https://www.googleapis.com/books/v1/volumes?q=x')
+            self.assertEqual(resp.status, 200)
+            self.assertEqual(resp['content-type'], 'application/json')
+            self.assertIn('War and Peace', content)
+
+            # a cookie a provider sets isn't sent with later calls
+            for i in range(2):
+                resp = outbound.get('https://www.facebook.com/cookies/')
+                self.assertEqual(resp.json(), {'cookies': {}})
+            self.assertEqual(len(outbound.client().cookies), 0)
+
+            # all the calls went through the one client, and its one pool
+            # for the stub server
+            adapter = outbound.client().get_adapter('https://example.com/')
+            self.assertIsInstance(adapter, outbound.StubAdapter)
+            self.assertEqual(len(adapter.poolmanager.pools), 1)
+        finally:
+            app.config['USE_GOOGLE_API'] = False
+            app.config['HTTP_STUB_URL'] = None
+            outbound.reset_client()
+
+        # the blanks were filled in from the (stub) API's answer
+        new_book = Book.query.filter_by(title='War and Peace').one()
+        self.assertEqual(new_book.synopsis, 'A long Russian novel.')
+        self.assertEqual(new_book.year_published, 1869)
+        self.assertEqual(new_book.picture, 'http://books.google.com/war.png')
+
+    def test_home_add_book_google_api_down(self):
+        """Test that outbound calls time out, that an endpoint's circuit
+        breaker opens after repeated failures, and that `home.addBook`
+        saves the book as entered when the Google Books API can't be
+        reached.
+        """
+        url = '/books/add/'
+        category = Category.query.filter_by(name='Serious Books').one()
+        volumes_url = 'https://www.googleapis.com/books/v1/volumes'
+
+        with self.client.session_transaction() as session:
+            session['username'] = 'admin'
+            session['email'] = 'admin@catalog.com'
+
+        saved = dict(
+            (key, app.config[key])
+            for key in ('HTTP_READ_TIMEOUT', 'HTTP_BREAKER_THRESHOLD')
+        )
+        app.config['USE_GOOGLE_API'] = True
+        app.config['HTTP_STUB_URL'] = 'http://localhost:5000/test/'
+        app.config['HTTP_READ_TIMEOUT'] = 0.2
+        app.config['HTTP_BREAKER_THRESHOLD'] = 2
+        outbound.reset_client()
+        try:
+            # a slow answer is given up on after the read timeout
+            start = time.time()
+            with self.assertRaises(outbound.RequestException):
+                outbound.get('https://www.example.com/slow/')
+            self.assertLess(time.time() - start, 1)
+
+            # nothing listens on port 1; each lookup fails, and the
+            # book is saved anyway
+            app.config['HTTP_STUB_URL'] = 'http://localhost:1/'
+            outbound.reset_client()
+            for title in ('War and Peace', 'Anna Karenina'):
+                response = self.client.post(
+                    url,
+                    data={
+                        'title': title,
+                        'author': 'Leo Tolstoy',
+                        'category': [category.id, ]
+                    }
+                )
+                self.assertStatus(response, 302)
+            breaker = outbound.breaker_for(volumes_url)
+            self.assertTrue(breaker.is_open)
+
+            # once it's open, the API isn't called at all, even when
+            # it's back
+            app.config['HTTP_STUB_URL'] = 'http://localhost:5000/test/'
+            outbound.reset_client(breakers=False)
+            with self.assertRaises(outbound.CircuitOpen):
+                outbound.get(volumes_url)
+            response = self.client.post(
+                url,
+                data={
+                    'title': 'Resurrection',
+                    'author': 'Leo Tolstoy',
+                    'category': [category.id, ]
+                }
+            )
+            self.assertStatus(response, 302)
+            self.assertEqual(breaker.failures, 2)
+
+            # after HTTP_BREAKER_RESET seconds, a call is tried again,
+            # and closes the breaker when it works
+            breaker.opened_at -= breaker.reset
+            outbound.get(volumes_url)
+            self.assertFalse(breaker.is_open)
+        finally:
+            app.config.update(saved)
+            app.config['USE_GOOGLE_API'] = False
+            app.config['HTTP_STUB_URL'] = None
+            outbound.reset_client()
+
+        for title in ('War and Peace', 'Anna Karenina', 'Resurrection'):
+            book = Book.query.filter_by(title=title).one()
+            self.assertFalse(book.synopsis)
+            self.assertIsNone(book.year_published)
+
     def test_home_edit_book_get(self):
         """Test the `home.editBook` view in GET mode.
         """
@@ -741,6 +1313,33 @@ class CatalogTestCase(TestCase):
         self.assertEqual(response.json['Book']['id'], book.id)
         self.assertEqual(response.json['Book']['lender'], book.lender.email)
 
+    def test_home_books_info(self):
+        """Test the `home.booksInfo` view. It should return the same
+        info as `home.bookInfo` for each of the books asked for, with a
+        single query for the books.
+        """
+        books = Book.query.order_by(Book.title).all()
+        ids = ','.join(str(b.id) for b in books)
+
+        with count_queries() as queries:
+            response = self.client.get('/books/info/?ids=8675309,' + ids)
+        self.assertEqual(len([q for q in queries if 'FROM book' in q]), 1)
+        self.assertEqual(response.content_type, 'application/json')
+        self.assertEqual(
+            [b['title'] for b in response.json['Books']],
+            [b.title for b in books])
+        single = self.client.get('/books/' + str(books[0].id) + '/info/')
+        self.assertEqual(response.json['Books'][0], single.json['Book'])
+
+        # book list pages give the IDs to fetch
+        response = self.client.get('/books/')
+        self.assertIn('data-book-id="%d"' % books[0].id, response.data)
+
+        response = self.client.get('/books/info/')
+        self.assertEqual(response.json['Books'], [])
+        response = self.client.get('/books/info/?ids=1,splunge')
+        self.assert400(response)
+
     def test_home_borrow_book(self):
         """Test the `home.borrowBook` view.
         """
@@ -793,6 +1392,42 @@ class CatalogTestCase(TestCase):
         # make sure user sees the flash message
         self.assertIn(msg, response.data)
 
+    def test_home_borrow_book_unavailable(self):
+        """Test the `home.borrowBook` view for a book that somebody else
+        already has checked out. No second loan should be recorded.
+        """
+        user = User.query.filter_by(email='admin@catalog.com').one()
+        user2 = User(name='customer', email='customer@bookshopsketch.com')
+        book = Book.query.filter_by(title='Rarnaby Budge').one()
+        due_date = dt.date.today() + dt.timedelta(days=30)
+
+        db.session.add(user2)
+        db.session.commit()
+        db.session.add(BookBorrower(
+            book_id=book.id, user_id=user2.id, due_date=due_date))
+        db.session.commit()
+
+        with self.client.session_transaction() as session:
+            # fake the login by adding session variables
+            session['username'] = 'admin'
+            session['email'] = 'admin@catalog.com'
+
+        response = self.client.get('/books/' + str(book.id) + '/borrow/')
+        self.assert_redirects(response, '/books/')
+
+        # still only the one loan, and it isn't ours
+        self.assertEqual(
+            BookBorrower.query.filter_by(book_id=book.id).count(), 1)
+        self.assertEqual(book.current_loan.borrower, user2)
+        self.assertRaises(
+            NoResultFound,
+            BookBorrower.query.filter_by(borrower=user).one
+        )
+
+        response = self.client.get('/books/')
+        self.assertIn(
+            'Sorry, <em>Rarnaby Budge</em> is not available.', response.data)
+
     def test_home_return_book(self):
         """Test the `home.returnBook` view.
         """
@@ -840,6 +1475,40 @@ class CatalogTestCase(TestCase):
         # make sure user sees the flash message
         self.assertIn(msg, response.data)
 
+        # a returned book can be borrowed again, and returned again
+        self.client.get('/books/' + str(book.id) + '/borrow/')
+        loans = BookBorrower.query.filter_by(book_id=book.id)
+        self.assertEqual(loans.count(), 2)
+        self.assertEqual(loans.filter_by(returned=False).count(), 1)
+        self.client.get(url)
+        self.assertEqual(loans.filter_by(returned=False).count(), 0)
+
+    def test_models_open_loan_index(self):
+        """Test the DDL for the "one open loan per book" index. It
+        should be unique and partial where partial indexes exist, and
+        a plain index elsewhere, so returned loans don't block new ones.
+        """
+        index = [
+            i for i in BookBorrower.__table__.indexes
+            if i.name == 'ix_book_borrower_open_loan'
+        ][0]
+        for dialect in (postgresql.dialect(), sqlite.dialect()):
+            ddl = str(CreateIndex(index).compile(dialect=dialect))
+            self.assertIn('CREATE UNIQUE INDEX', ddl)
+            self.assertIn('WHERE', ddl)
+        for dialect in (mysql.dialect(), mssql.dialect(), oracle.dialect()):
+            ddl = str(CreateIndex(index).compile(dialect=dialect))
+            self.assertTrue(ddl.startswith('CREATE INDEX'), ddl)
+            self.assertNotIn('WHERE', ddl)
+
+        # other unique indexes are left alone
+        index = [
+            i for i in book_favorite.indexes
+            if i.name == 'ux_book_favorite_book_user'
+        ][0]
+        ddl = str(CreateIndex(index).compile(dialect=mysql.dialect()))
+        self.assertIn('CREATE UNIQUE INDEX', ddl)
+
     def test_home_review_book_get_not_reviewed(self):
         """Test the `home.reviewBook` view. This test is for
         a user who has not yet reviewed the book in question.
@@ -994,6 +1663,51 @@ class CatalogTestCase(TestCase):
         revised_book = Book.query.filter_by(title='Rarnaby Budge').one()
         self.assertIn(user, revised_book.favorite)
 
+    def test_home_favorite_book_listing(self):
+        """Test that book lists mark the user's favorite books, using
+        one query for the favorites however many books are listed, and
+        that marking a book favorite twice doesn't duplicate it.
+        """
+        book = Book.query.filter_by(title='Rarnaby Budge').one()
+        user = User.query.filter_by(email='admin@catalog.com').one()
+        marker = 'One of your favorite books'
+
+        # anonymous users have no favorites
+        response = self.client.get('/books/all/')
+        self.assert200(response)
+        self.assertNotIn(marker, response.data)
+
+        with self.client.session_transaction() as session:
+            # fake the login by adding session variables
+            session['username'] = 'admin'
+            session['email'] = 'admin@catalog.com'
+
+        url = '/books/' + str(book.id) + '/favorite/'
+        self.client.get(url)
+        self.client.get(url)
+        revised_book = Book.query.filter_by(title='Rarnaby Budge').one()
+        self.assertEqual(revised_book.favorite, [user, ])
+
+        # a concurrent request that saved the favorite between this
+        # request's check and its insert loses on the unique index
+        home_views = sys.modules['catalog.views.home']
+        check = home_views.favorite_book_ids
+        home_views.favorite_book_ids = lambda: frozenset()
+        try:
+            response = self.client.get(url)
+        finally:
+            home_views.favorite_book_ids = check
+        self.assert_redirects(response, '/books/')
+        revised_book = Book.query.filter_by(title='Rarnaby Budge').one()
+        self.assertEqual(revised_book.favorite, [user, ])
+
+        with count_queries() as statements:
+            response = self.client.get('/books/all/')
+        self.assertEqual(response.data.count(marker), 1)
+        favorite_queries = [
+            q for q in statements if 'FROM book_favorite' in q]
+        self.assertEqual(len(favorite_queries), 1)
+
     def test_home_delete_book(self):
         """Test the `home.deleteBook` view.
         """
@@ -1081,6 +1795,492 @@ class CatalogTestCase(TestCase):
         # response should have the Content-Type header `application/json`
         self.assertEqual(response.content_type, 'application/json')
 
+    def test_home_books_api_pages(self):
+        """Test paging through the `home.booksAPI` view's output with
+        the `limit` and `after` parameters.
+        """
+        response = self.client.get('/books/API/all/?limit=1')
+        self.assert200(response)
+        self.assertEqual(len(response.json['Books']), 1)
+        self.assertEqual(
+            response.json['Books'][0]['title'], '101 Ways to Start a Fight')
+
+        # the next page can be found by cursor or Link header
+        cursor = response.json['next']
+        next_url = 'http://localhost/books/API/all/?after=' + cursor
+        next_url += '&limit=1'
+        link = dict(urlparse.parse_qsl(urlparse.urlsplit(
+            response.headers['Link'][1:].split('>')[0]).query))
+        self.assertEqual(link, {'after': cursor, 'limit': '1'})
+
+        response = self.client.get(next_url)
+        self.assertEqual(len(response.json['Books']), 1)
+        self.assertEqual(response.json['Books'][0]['title'], 'Rarnaby Budge')
+
+        # that's the last page
+        self.assertNotIn('next', response.json)
+        self.assertNotIn('Link', response.headers)
+
+        # XML output carries the cursor too
+        response = self.client.get('/books/API/all/XML/?limit=1')
+        root = ET.fromstring(response.data)
+        self.assertEqual(root.get('next'), cursor)
+
+        response = self.client.get('/books/API/all/?after=splunge')
+        self.assert400(response)
+
+    def test_home_books_api_since(self):
+        """Test `since` on the `home.booksAPI` view. Only books added
+        or modified after it should be returned, along with the cursor
+        to pass next time; edits and loans count as modifications.
+        """
+        app.config['API_SINCE_LAG'] = 0
+        self.addCleanup(app.config.__setitem__, 'API_SINCE_LAG', 60)
+        response = self.client.get('/books/API/all/?since=2000-01-01')
+        self.assertEqual(len(response.json['Books']), 2)
+        since = response.json['since']
+
+        # nothing's changed since
+        response = self.client.get('/books/API/all/?since=' + since)
+        self.assertEqual(response.json['Books'], [])
+        self.assertEqual(response.json['since'], since)
+
+        # lending a book out modifies it
+        with self.client.session_transaction() as session:
+            session['username'] = 'admin'
+            session['email'] = 'admin@catalog.com'
+        book = Book.query.filter_by(title='Rarnaby Budge').one()
+        self.client.get('/books/' + str(book.id) + '/borrow/')
+        response = self.client.get('/books/API/all/?since=' + since)
+        self.assertEqual(
+            [b['title'] for b in response.json['Books']], ['Rarnaby Budge'])
+        self.assertFalse(response.json['Books'][0]['is_available'])
+        since = response.json['since']
+        # modification times are UTC, like the timestamps `since` takes
+        db.session.refresh(book)
+        self.assertLess(
+            abs(book.date_modified - dt.datetime.utcnow()),
+            dt.timedelta(minutes=1))
+
+        # so does editing one, but not rating it
+        book2 = Book.query.filter_by(title='101 Ways to Start a Fight').one()
+        book2.synopsis = 'His name still eludes me.'
+        db.session.add(BookRating(rating=5, book_id=book.id, user_id=1))
+        db.session.commit()
+        response = self.client.get('/books/API/all/XML/?since=' + since)
+        root = ET.fromstring(response.data)
+        self.assertEqual(
+            [e.text for e in root.findall('book/title')],
+            ['101 Ways to Start a Fight'])
+        since = root.get('since')
+        response = self.client.get('/books/API/all/?since=' + since)
+        self.assertEqual(response.json['Books'], [])
+
+        # changes come a page at a time, with a Link to the next page
+        response = self.client.get(
+            '/books/API/all/?since=2000-01-01T00:00:00Z&limit=1')
+        self.assertEqual(
+            [b['title'] for b in response.json['Books']], ['Rarnaby Budge'])
+        link = dict(urlparse.parse_qsl(urlparse.urlsplit(
+            response.headers['Link'][1:].split('>')[0]).query))
+        self.assertEqual(
+            link, {'since': response.json['since'], 'limit': '1'})
+
+        # feeds give the cursor in a header, on the last page too
+        response = self.client.get('/books/API/all/RSS/?since=' + since)
+        self.assertNotIn('Link', response.headers)
+        self.assertEqual(response.headers['X-Since'], since)
+
+        # so do streamed changes, with a cursor from before they're read
+        response = self.client.get('/books/API/all/NDJSON/?since=' + since)
+        self.assertEqual(response.data, '')
+        response = self.client.get(
+            '/books/API/all/?since=' + response.headers['X-Since'])
+        self.assertEqual(response.json['Books'], [])
+        response = self.client.get(
+            '/books/API/all/NDJSON/?since=2000-01-01')
+        self.assertEqual(len(response.data.splitlines()), 2)
+        self.assertLessEqual(
+            response.headers['X-Since'], dt.datetime.utcnow().isoformat())
+        response = self.client.get('/books/API/all/?stream=1&since=' + since)
+        self.assertEqual(json.loads(response.data)['Books'], [])
+        self.assertIn('X-Since', response.headers)
+        # not without `since`
+        response = self.client.get('/books/API/all/NDJSON/')
+        self.assertNotIn('X-Since', response.headers)
+
+        # the last page's cursor is held back, so changes made just
+        # before it (maybe still uncommitted) are returned again
+        app.config['API_SINCE_LAG'] = 60
+        response = self.client.get('/books/API/all/?since=2000-01-01')
+        self.assertEqual(len(response.json['Books']), 2)
+        since = response.json['since']
+        self.assertLess(
+            dt.datetime.strptime(since, '%Y-%m-%dT%H:%M:%S.%f'),
+            dt.datetime.utcnow() - dt.timedelta(seconds=59))
+        response = self.client.get('/books/API/all/?since=' + since)
+        self.assertEqual(len(response.json['Books']), 2)
+
+        # favoriting doesn't modify a book, so favorites ignore `since`
+        self.client.get('/books/' + str(book2.id) + '/favorite/')
+        response = self.client.get('/books/API/favorites/?since=' + since)
+        self.assertEqual(
+            [b['title'] for b in response.json['Books']],
+            ['101 Ways to Start a Fight'])
+        self.assertNotIn('since', response.json)
+        self.assertNotIn('X-Since', response.headers)
+
+        response = self.client.get('/books/API/all/?since=splunge')
+        self.assert400(response)
+
+    def test_home_books_api_ndjson_csv(self):
+        """Test the NDJSON and CSV formats of the `home.booksAPI` view.
+        Both should hold every book in the list, one per line.
+        """
+        books = self.client.get('/books/API/all/').json['Books']
+
+        response = self.client.get('/books/API/all/NDJSON/')
+        self.assertEqual(response.content_type, 'application/x-ndjson')
+        lines = response.data.splitlines()
+        self.assertEqual([json.loads(line) for line in lines], books)
+
+        response = self.client.get('/books/API/category/Silly Books/CSV/')
+        self.assertEqual(response.content_type, 'text/csv; charset=utf-8')
+        rows = list(csv.DictReader(StringIO(response.data)))
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['title'], 'Rarnaby Budge')
+        self.assertEqual(rows[0]['lender'], 'admin@catalog.com')
+        self.assertEqual(rows[0]['is_available'], 'True')
+        self.assertEqual(rows[0]['borrower_email'], '')
+
+    def test_home_books_api_fields(self):
+        """Test `fields` on the `home.booksAPI` and `home.bookInfo`
+        views. Only the fields asked for should be returned, and the
+        lender and loan tables should only be queried for fields that
+        need them.
+        """
+        with count_queries() as queries:
+            response = self.client.get('/books/API/all/?fields=id,title')
+        self.assertEqual(
+            response.json['Books'],
+            [{'id': 2, 'title': '101 Ways to Start a Fight'},
+             {'id': 1, 'title': 'Rarnaby Budge'}])
+        books_query = [q for q in queries if 'FROM book' in q][0]
+        self.assertNotIn('JOIN', books_query)
+        self.assertNotIn('synopsis', books_query)
+
+        response = self.client.get(
+            '/books/API/all/?fields=lender,is_available&limit=1')
+        self.assertEqual(
+            response.json['Books'],
+            [{'lender': 'admin@catalog.com', 'is_available': True}])
+        response = self.client.get('/books/API/all/XML/?fields=author')
+        root = ET.fromstring(response.data)
+        self.assertEqual(
+            [[e.tag for e in book] for book in root], [['author']] * 2)
+        response = self.client.get(
+            '/books/API/all/CSV/?fields=title,borrower')
+        self.assertEqual(
+            response.data.splitlines()[0],
+            'title,borrower_name,borrower_email')
+        response = self.client.get('/books/API/all/NDJSON/?fields=id')
+        self.assertEqual(response.data, '{"id":2}\n{"id":1}\n')
+
+        # feeds always have every field
+        response = self.client.get('/books/API/all/RSS/?fields=id')
+        self.assertIn('<author>', response.data)
+
+        response = self.client.get('/books/1/info/?fields=title,picture')
+        self.assertEqual(
+            sorted(response.json['Book'].keys()), ['picture', 'title'])
+
+        response = self.client.get('/books/API/all/?fields=title,splunge')
+        self.assert400(response)
+        response = self.client.get('/books/1/info/?fields=,')
+        self.assert400(response)
+
+    def test_home_books_api_stream(self):
+        """Test the `home.booksAPI` view's streaming JSON mode: the whole
+        list, read a batch at a time, with the same books as the paged
+        output.
+        """
+        app.config['API_STREAM_BATCH_SIZE'] = 1
+        self.addCleanup(app.config.__setitem__, 'API_STREAM_BATCH_SIZE', 500)
+
+        response = self.client.get('/books/API/all/?stream=1&limit=1')
+        self.assert200(response)
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.content_type, 'application/json')
+        paged = self.client.get('/books/API/all/')
+        self.assertEqual(response.json, paged.json)
+
+        # streams can be resumed from a page cursor
+        cursor = self.client.get('/books/API/all/?limit=1').json['next']
+        response = self.client.get(
+            '/books/API/all/?stream=1&after=' + cursor)
+        self.assertEqual(
+            [b['title'] for b in response.json['Books']], ['Rarnaby Budge'])
+
+        response = self.client.get('/books/API/all/?stream=1&after=splunge')
+        self.assert400(response)
+
+    def test_home_books_api_conditional(self):
+        """Test conditional requests to the `home.booksAPI` and
+        `home.bookInfo` views. Unchanged responses should be answered
+        with a 304 without reading any books; any write to the catalog
+        should change the ETag.
+        """
+        url = '/books/API/all/RSS/'
+        response = self.client.get(url)
+        self.assert200(response)
+        etag = response.headers['ETag']
+        last_modified = response.headers['Last-Modified']
+
+        # the feed is dated by the catalog, so it doesn't change by itself
+        self.assertEqual(self.client.get(url).data, response.data)
+
+        with count_queries() as queries:
+            response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, '')
+        self.assertEqual(len(queries), 1)
+
+        response = self.client.get(
+            url, headers={'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 304)
+
+        # other URLs have other ETags
+        response = self.client.get(
+            '/books/API/all/Atom/', headers={'If-None-Match': etag})
+        self.assert200(response)
+
+        # loans, ratings and favorites all count as changes
+        user = User.query.filter_by(email='admin@catalog.com').one()
+        book = Book.query.filter_by(title='Rarnaby Budge').one()
+        db.session.add(BookBorrower(
+            user_id=user.id, book_id=book.id, due_date=dt.date.today()))
+        db.session.commit()
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assert200(response)
+        etag = response.headers['ETag']
+
+        # the version is bumped once the write commits, not while its
+        # transaction holds locks; rolled back writes don't bump it
+        version = catalog_version()[0]
+        book.synopsis = 'Rolled back.'
+        db.session.flush()
+        self.assertEqual(catalog_version()[0], version)
+        db.session.rollback()
+        db.session.commit()
+        self.assertEqual(catalog_version()[0], version)
+        book.synopsis = 'Committed.'
+        db.session.commit()
+        self.assertEqual(catalog_version()[0], version + 1)
+
+        with self.client.session_transaction() as session:
+            session['username'] = 'admin'
+            session['email'] = 'admin@catalog.com'
+        info_url = '/books/' + str(book.id) + '/info/'
+        info_etag = self.client.get(info_url).headers['ETag']
+        self.client.get('/books/' + str(book.id) + '/favorite/')
+        response = self.client.get(
+            info_url, headers={'If-None-Match': info_etag})
+        self.assert200(response)
+        self.assertNotEqual(response.headers['ETag'], info_etag)
+
+    def test_home_books_api_cache(self):
+        """Test the `home.booksAPI` response cache. Repeat requests
+        should be answered from the cache, and writes to the catalog
+        should make the cached responses out of date.
+        """
+        with self.client.session_transaction() as session:
+            session['username'] = 'admin'
+            session['email'] = 'admin@catalog.com'
+        book = Book.query.filter_by(title='Rarnaby Budge').one()
+        hits = api_cache.responses.hits
+
+        response = self.client.get('/books/API/category/Silly Books/')
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        with count_queries() as queries:
+            cached = self.client.get('/books/API/category/Silly Books/')
+        self.assertEqual(cached.headers['X-Cache'], 'HIT')
+        self.assertEqual(cached.data, response.data)
+        self.assertEqual(cached.headers['ETag'], response.headers['ETag'])
+        self.assertEqual(api_cache.responses.hits, hits + 1)
+        self.assertEqual([q for q in queries if 'FROM book' in q], [])
+
+        # other formats and parameters are cached separately
+        response = self.client.get('/books/API/category/Silly Books/XML/')
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        response = self.client.get('/books/API/favorites/')
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        self.assertEqual(response.json['Books'], [])
+
+        # borrowing the book changes the lists it's in...
+        self.client.get('/books/' + str(book.id) + '/borrow/')
+        response = self.client.get('/books/API/category/Silly Books/')
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        self.assertIn(
+            False, [b['is_available'] for b in response.json['Books']])
+
+        # ...and every other list: any write makes a new catalog version,
+        # and cached responses are served with the current ETag, so a
+        # client that has it gets a 304, not a stale copy
+        response = self.client.get('/books/API/favorites/')
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        etag = response.headers['ETag']
+        cached = self.client.get('/books/API/favorites/')
+        self.assertEqual(cached.headers['X-Cache'], 'HIT')
+        self.assertEqual(cached.headers['ETag'], etag)
+        response = self.client.get(
+            '/books/API/favorites/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        self.client.get('/books/' + str(book.id) + '/favorite/')
+        response = self.client.get('/books/API/favorites/')
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        self.assertEqual(
+            [b['title'] for b in response.json['Books']], ['Rarnaby Budge'])
+
+        # the hit and miss counts can be looked at, when turned on
+        self.assert404(self.client.get('/cache/stats/'))
+        app.config['SHOW_CACHE_STATS'] = True
+        self.addCleanup(app.config.__setitem__, 'SHOW_CACHE_STATS', False)
+        response = self.client.get('/cache/stats/')
+        self.assertEqual(
+            response.json['api']['hits'], api_cache.responses.hits)
+        self.assertEqual(
+            sorted(response.json['users']), ['hits', 'misses', 'size'])
+
+    def test_home_books_api_compressed(self):
+        """Test compression of `home.booksAPI` responses and pages.
+        Clients that accept gzip or deflate should get the same output
+        compressed, under a different ETag; cached responses should be
+        served as they were compressed.
+        """
+        url = '/books/API/all/XML/'
+        plain = self.client.get(url)
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertIn('Accept-Encoding', plain.headers['Vary'])
+
+        headers = {'Accept-Encoding': 'gzip, deflate'}
+        response = self.client.get(url, headers=headers)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        self.assertEqual(
+            zlib.decompress(response.data, 16 + zlib.MAX_WBITS), books_xml)
+        self.assertLess(len(response.data), len(plain.data))
+        self.assertNotEqual(response.headers['ETag'], plain.headers['ETag'])
+
+        cached = self.client.get(url, headers=headers)
+        self.assertEqual(cached.headers['X-Cache'], 'HIT')
+        self.assertEqual(cached.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(cached.data, response.data)
+        self.assertEqual(cached.headers['ETag'], response.headers['ETag'])
+
+        response = self.client.get(
+            url, headers={'Accept-Encoding': 'deflate'})
+        self.assertEqual(response.headers['Content-Encoding'], 'deflate')
+        self.assertEqual(zlib.decompress(response.data), books_xml)
+
+        # streamed lists are compressed as they're sent
+        response = self.client.get(url + '?stream=1', headers=headers)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(
+            zlib.decompress(response.data, 16 + zlib.MAX_WBITS), books_xml)
+
+        # and so are pages
+        plain = self.client.get('/books/')
+        response = self.client.get('/books/', headers=headers)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(
+            zlib.decompress(response.data, 16 + zlib.MAX_WBITS), plain.data)
+
+        # responses too small to compress, and 304s, still have ETags
+        # that depend on the encoding, and say so
+        book = Book.query.filter_by(title='Rarnaby Budge').one()
+        info_url = '/books/%d/info/?fields=id' % book.id
+        response = self.client.get(info_url, headers=headers)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        response = self.client.get(info_url, headers={
+            'Accept-Encoding': 'gzip',
+            'If-None-Match': response.headers['ETag']
+        })
+        self.assertEqual(response.status_code, 304)
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+
+    def test_home_books_api_materialized_feeds(self):
+        """Test feed materialization. Feeds should be written to
+        FEED_DIR in the background and served from there without
+        touching the database, and rebuilt when books or loans change.
+        """
+        feed_dir = tempfile.mkdtemp()
+        app.config['FEED_DIR'] = feed_dir
+        app.config['FEED_BASE_URL'] = 'http://localhost/'
+        try:
+            url = '/books/API/all/Atom/'
+            # the first request is served the usual way, and has the
+            # feed built
+            response = self.client.get(url)
+            self.assertIn('X-Cache', response.headers)
+            feeds.wait()
+            self.assertTrue(
+                os.path.exists(os.path.join(feed_dir, 'all.atom')))
+
+            with count_queries() as queries:
+                materialized = self.client.get(url)
+            self.assertEqual(queries, [])
+            self.assertNotIn('X-Cache', materialized.headers)
+            self.assertEqual(materialized.data, response.data)
+            self.assertEqual(
+                materialized.content_type,
+                'application/atom+xml; charset=utf-8')
+
+            response = self.client.get(
+                url, headers={'If-None-Match': materialized.headers['ETag']})
+            self.assertEqual(response.status_code, 304)
+            response = self.client.get(
+                url, headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(
+                zlib.decompress(response.data, 16 + zlib.MAX_WBITS),
+                materialized.data)
+
+            # other pages and parameters are built as usual
+            response = self.client.get(url + '?limit=1')
+            self.assertIn('X-Cache', response.headers)
+
+            # borrowing a book rebuilds the feeds it's in
+            with self.client.session_transaction() as session:
+                session['username'] = 'admin'
+                session['email'] = 'admin@catalog.com'
+            book = Book.query.filter_by(title='Rarnaby Budge').one()
+            self.client.get('/books/' + str(book.id) + '/borrow/')
+            feeds.wait()
+            response = self.client.get('/books/API/category/Silly Books/RSS/')
+            self.assertNotIn('X-Cache', response.headers)
+            self.assertIn('<isavailable>False</isavailable>', response.data)
+            response = self.client.get(url)
+            self.assertNotEqual(response.data, materialized.data)
+
+            # a rebuild from an older catalog version leaves a newer
+            # feed in place
+            path = feeds.feed_path('all', None, 'Atom')
+            self.assertFalse(feeds.replace_feed(path, [(path, 'old')], 0))
+            self.assertEqual(self.client.get(url).data, response.data)
+
+            # there's nothing to build for categories that don't exist
+            response = self.client.get('/books/API/category/Nope/RSS/')
+            self.assert404(response)
+            feeds.wait()
+            self.assertFalse(os.path.exists(
+                feeds.feed_path('category', u'Nope', 'RSS')))
+        finally:
+            app.config['FEED_DIR'] = None
+            app.config['FEED_BASE_URL'] = None
+            shutil.rmtree(feed_dir)
+
     def test_home_books_api_xml(self):
         """Test the `home.booksAPI` view. This test is for XML
         output.
@@ -1137,6 +2337,49 @@ class CatalogTestCase(TestCase):
         self.assertEqual(
             response.content_type, 'application/rss+xml; charset=utf-8')
 
+    def test_home_books_api_stream_xml(self):
+        """Test streaming the `home.booksAPI` view's XML output. It
+        should be the same as the paged output, without the cursor.
+        """
+        response = self.client.get('/books/API/all/XML/?stream=1')
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(books_xml, response.data)
+        self.assertEqual(
+            response.content_type, 'application/xml; charset=utf-8')
+
+    def test_xml_writer(self):
+        """Test that `XMLWriter` lays documents out exactly the way
+        minidom's `toprettyxml` does, escaping included.
+        """
+        doc = xmldoc()
+        root = doc.appendChild(doc.createElement('books'))
+        root.setAttribute('rel', 'a "quoted" & <odd> value')
+        root.setAttribute('href', u'caf\xe9')
+        book = root.appendChild(doc.createElement('book'))
+        title = book.appendChild(doc.createElement('title'))
+        title.appendChild(doc.createTextNode(u'Fish & Chips <\xe9>'))
+        empty = book.appendChild(doc.createElement('synopsis'))
+        empty.appendChild(doc.createTextNode(''))
+        book.appendChild(doc.createElement('picture'))
+        root.appendChild(doc.createElement('book'))
+
+        w = XMLWriter()
+        written = w.declaration()
+        written += w.start('books', {
+            'rel': 'a "quoted" & <odd> value',
+            'href': u'caf\xe9'
+        })
+        written += w.start('book')
+        written += w.element('title', u'Fish & Chips <\xe9>')
+        written += w.element('synopsis', '')
+        written += w.element('picture')
+        written += w.end()
+        written += w.start('book') + w.end()
+        written += w.end()
+
+        self.assertEqual(
+            doc.toprettyxml(indent='    ', encoding='utf-8'), written)
+
     def test_home_media(self):
         """Test the `home.media` view, which is used for displaying
         user-uploaded static files (just book cover art in this app)
@@ -1190,6 +2433,57 @@ class CatalogTestCase(TestCase):
      TEST AUTH VIEWS
     """""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 
+    def test_signin_config_snapshot(self):
+        """Test `signin.ConfigSnapshot`, which keeps the sign-in
+        providers' settings parsed. The secrets file should only be read
+        again once it changes (and kept if it can't be), and
+        FACEBOOK_CONFIG once it's replaced.
+        """
+        fd, path = tempfile.mkstemp()
+        os.write(fd, '{"web": {"client_id": "first"}}')
+        os.close(fd)
+        # a whole-second modification time, which survives being set
+        # again with os.utime exactly
+        os.utime(path, (1500000000, 1500000000))
+        interval = app.config['CONFIG_CHECK_INTERVAL']
+        fb_config = app.config['FACEBOOK_CONFIG']
+        try:
+            snapshot = ConfigSnapshot(path)
+            self.assertEqual(snapshot.google['client_id'], 'first')
+
+            with open(path, 'w') as f:
+                f.write('{"web": {"client_id": "second"}}')
+            stat = os.stat(path)
+            # not checked for changes again until the interval is up...
+            self.assertEqual(snapshot.google['client_id'], 'first')
+            app.config['CONFIG_CHECK_INTERVAL'] = 0
+            # ...and then only read if the modification time changed
+            os.utime(path, (stat.st_atime, snapshot._mtime))
+            self.assertEqual(snapshot.google['client_id'], 'first')
+            os.utime(path, (stat.st_atime, snapshot._mtime + 1))
+            self.assertEqual(snapshot.google['client_id'], 'second')
+
+            # a file that can't be read leaves the last settings read
+            with open(path, 'w') as f:
+                f.write('{"web": ')
+            os.utime(path, (stat.st_atime, snapshot._mtime + 2))
+            self.assertEqual(snapshot.google['client_id'], 'second')
+            os.remove(path)
+            self.assertEqual(snapshot.google['client_id'], 'second')
+            with self.assertRaises(EnvironmentError):
+                ConfigSnapshot(path).google
+            open(path, 'w').close()
+
+            facebook = snapshot.facebook
+            self.assertIs(snapshot.facebook, facebook)
+            app.config['FACEBOOK_CONFIG'] = (
+                '{"web": {"app_id": "456", "app_secret": "def"}}')
+            self.assertEqual(snapshot.facebook['app_id'], '456')
+        finally:
+            app.config['CONFIG_CHECK_INTERVAL'] = interval
+            app.config['FACEBOOK_CONFIG'] = fb_config
+            os.remove(path)
+
     def test_auth_show_login(self):
         """Test the `auth.showLogin` view, which is used to display the
         login.html template containing the Google+ and Facebook sign-in
@@ -1422,6 +2716,58 @@ class CatalogTestCase(TestCase):
         delete_test_file('instance/client_secrets_test.json')
         delete_test_file('instance/client_secrets_bogus_test.json')
 
+    def test_auth_gconnect_provider_down(self):
+        """Using mocked server responses, ensure that a Google sign-in
+        server that can't be reached gets a 503 from `auth.gconnect`,
+        not a 500, and that once its circuit breaker opens it isn't
+        called at all.
+        """
+        # if we're not using Google+ for signin, don't run the test
+        if (app.config['USE_GOOGLE_SIGNIN'] == False):
+            return
+
+        response = self.client.get('/login/')
+        self.assert200(response)
+
+        with self.client.session_transaction() as session:
+            session_state = session['state']
+
+        save_google_secrets_test_files()
+
+        url = '/oauth2callback?state=' + session_state + '&code=8675309'
+        url += '&next=/books/&secret=instance/client_secrets_test.json'
+        url += '&id=110169484474386276334&issued='
+        url += get_google_client_id()
+        token_url = 'http://localhost:5000/test/get_access_token/'
+
+        threshold = app.config['HTTP_BREAKER_THRESHOLD']
+        app.config['HTTP_BREAKER_THRESHOLD'] = 2
+        # nothing listens on port 1
+        app.config['HTTP_STUB_URL'] = 'http://localhost:1/'
+        outbound.reset_client()
+        try:
+            for i in range(2):
+                response = self.client.get(url)
+                self.assertStatus(response, 503)
+                self.assertEqual(response.content_type, 'application/json')
+            self.assertTrue(outbound.breaker_for(token_url).is_open)
+
+            # with the breaker open, the exchange fails straight away
+            app.config['HTTP_STUB_URL'] = None
+            outbound.reset_client(breakers=False)
+            response = self.client.get(url)
+            self.assertStatus(response, 503)
+            self.assertEqual(outbound.breaker_for(token_url).failures, 2)
+            with self.client.session_transaction() as session:
+                self.assertNotIn('user_id', session)
+        finally:
+            app.config['HTTP_BREAKER_THRESHOLD'] = threshold
+            app.config['HTTP_STUB_URL'] = None
+            outbound.reset_client()
+
+        delete_test_file('instance/client_secrets_test.json')
+        delete_test_file('instance/client_secrets_bogus_test.json')
+
     def test_auth_gconnect_bad_userid(self):
         """Using mocked server responses, ensure user can connect to
         the application using Google sign-in api. This test is to make
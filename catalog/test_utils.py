@@ -1,7 +1,10 @@
 import json
 import os
 
-from catalog import app
+from contextlib import contextmanager
+from sqlalchemy import event
+
+from catalog import app, db
 
 
 def delete_test_file(filename):
@@ -45,3 +48,22 @@ def save_google_secrets_test_files():
         f3.write(json.dumps(cs))
 
     return
+
+
+@contextmanager
+def count_queries():
+    """Count the SQL statements executed inside the `with` block. Yields
+    a list that ends up holding one entry per statement, so tests can
+    check how many queries a view needs.
+    """
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(
+            db.engine, 'before_cursor_execute', before_cursor_execute)